@@ -0,0 +1,36 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from xray.annotations import AnnotationIndex
+
+
+class AnnotationIndexTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.data_desc = pd.DataFrame({
+            'image_id': ['b', 'a', 'b', 'c', 'a', 'b'],
+            'class_id': [3, 14, 5, 0, 14, 3],
+            'rad_id': ['R8', 'R9', 'R10', 'R8', 'R11', 'R9'],
+            'x_min': [1., np.nan, 3., 4., np.nan, 6.],
+            'y_min': [1., np.nan, 3., 4., np.nan, 6.],
+            'x_max': [2., np.nan, 5., 6., np.nan, 8.],
+            'y_max': [2., np.nan, 5., 6., np.nan, 8.],
+        })
+
+    def test_lookup_matches_frame_scan(self):
+        index = AnnotationIndex.from_frame(self.data_desc)
+        for image_id in ['a', 'b', 'c']:
+            boxes, labels, rad_ids = index.lookup(image_id)
+            rows = self.data_desc.loc[self.data_desc.image_id == image_id]
+            np.testing.assert_array_equal(boxes, rows[['x_min', 'y_min', 'x_max', 'y_max']].values)
+            np.testing.assert_array_equal(labels, rows.class_id.values)
+            assert boxes.dtype == np.float32 and labels.dtype == np.int8 and rad_ids.dtype == np.int8
+        np.testing.assert_array_equal(index.lookup('b')[2], [8, 10, 9])
+
+    def test_restricted_image_ids(self):
+        index = AnnotationIndex.from_frame(self.data_desc, image_ids=['c', 'missing', 'b'])
+        assert len(index) == 3
+        assert len(index.slice(1)[0]) == 0
+        np.testing.assert_array_equal(index.slice(0)[1], [0])
+        np.testing.assert_array_equal(index.slice(2)[1], [3, 5, 3])
@@ -0,0 +1,54 @@
+import unittest
+
+import cv2
+import numpy as np
+import torch
+
+from xray.batch_augmentation import BatchAugmentation
+
+
+class BatchAugmentationTest(unittest.TestCase):
+    def setUp(self) -> None:
+        generator = torch.Generator().manual_seed(0)
+        self.images = [
+            torch.randint(0, 120, (3, 32, 48), dtype=torch.uint8, generator=generator) for _ in range(4)
+        ]
+        self.targets = [
+            {'boxes': torch.tensor([[2, 3, 10, 12], [0, 0, 1, 1]]), 'labels': torch.tensor([4, 0])}
+            for _ in range(4)
+        ]
+
+    def test_equalize_matches_opencv(self):
+        lut = BatchAugmentation.equalize_lut(BatchAugmentation.histogram(self.images))
+        equalized = BatchAugmentation.apply_lut(self.images, lut)
+        for image, result in zip(self.images, equalized):
+            for channel in range(3):
+                expected = cv2.equalizeHist(image[channel].numpy())
+                np.testing.assert_array_equal(result[channel].numpy(), expected)
+
+    def test_zero_probability_is_identity(self):
+        images, targets = BatchAugmentation(prob=0.0)(self.images, self.targets)
+        for image, original in zip(images, self.images):
+            assert torch.equal(image, original)
+        for target, original in zip(targets, self.targets):
+            assert torch.equal(target['boxes'], original['boxes'])
+
+    def test_flips_move_boxes_with_pixels(self):
+        augmentation = BatchAugmentation(prob=1.0)
+        images = [torch.zeros((1, 32, 48), dtype=torch.uint8) for _ in range(3)]
+        for image in images:
+            image[:, 3:12, 2:10] = 255
+        horizontal = torch.tensor([True, False, True])
+        vertical = torch.tensor([False, True, True])
+        flipped = [
+            augmentation.flip_image(image, h, v)
+            for image, h, v in zip(images, horizontal.tolist(), vertical.tolist())
+        ]
+        targets = augmentation.flip_boxes(
+            self.targets[:3], torch.tensor([[32, 48]] * 3), horizontal, vertical
+        )
+        for image, target in zip(flipped, targets):
+            x_min, y_min, x_max, y_max = target['boxes'][0].tolist()
+            assert image[0, y_min:y_max, x_min:x_max].min() == 255
+            assert image.sum() == 255 * 9 * 8
+            assert target['boxes'][1].tolist() == [0, 0, 1, 1]
@@ -0,0 +1,100 @@
+import json
+import os
+import random
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+
+import xray.utils
+from xray.checkpoint import (
+    BEST_CHECKPOINT, BEST_MODEL, CHECKPOINT_DIR, RESULTS_FILE, CheckpointManager, is_finished,
+    load_checkpoint, mark_finished, resolve_checkpoint, run_folder
+)
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.folder = self.tmp.name
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    @staticmethod
+    def _training_state():
+        torch.manual_seed(0)
+        model = torch.nn.Linear(4, 2)
+        optimizer = torch.optim.SGD(model.parameters(), lr=0.1, momentum=0.9)
+        lr_scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=1, gamma=0.5)
+        losses = xray.utils.LossAccumulator()
+        return model, optimizer, lr_scheduler, losses
+
+    @staticmethod
+    def _step(model, optimizer, lr_scheduler, losses):
+        loss = model(torch.randn(3, 4)).pow(2).sum()
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        lr_scheduler.step()
+        losses.update({name: loss for name in xray.utils.LOSS_NAMES}, loss)
+
+    def test_keeps_last_and_best(self):
+        model, optimizer, lr_scheduler, losses = self._training_state()
+        with CheckpointManager(self.folder, keep_last=2) as manager:
+            for epoch in range(4):
+                self._step(model, optimizer, lr_scheduler, losses)
+                state = CheckpointManager.snapshot(model, optimizer, lr_scheduler, epoch=epoch)
+                manager.save(state, epoch, is_best=epoch == 1)
+            manager.wait()
+            names = [os.path.basename(path) for path in manager.checkpoints()]
+
+        assert names == ['epoch_0002.pth', 'epoch_0003.pth']
+        best = torch.load(os.path.join(self.folder, CHECKPOINT_DIR, BEST_CHECKPOINT))
+        assert best['epoch'] == 1
+        weights = torch.load(os.path.join(self.folder, BEST_MODEL))
+        assert set(weights) == set(model.state_dict())
+        assert resolve_checkpoint(self.folder).endswith('epoch_0003.pth')
+        assert run_folder(self.folder) == os.path.abspath(self.folder)
+
+    def test_keeps_unevaluated_checkpoints(self):
+        model, optimizer, lr_scheduler, _ = self._training_state()
+        with CheckpointManager(self.folder, keep_last=1, keep_unevaluated=True) as manager:
+            for epoch in range(3):
+                if epoch == 2:
+                    with open(os.path.join(self.folder, CHECKPOINT_DIR, RESULTS_FILE), 'w') as f:
+                        f.write(json.dumps({'checkpoint': 'epoch_0000.pth'}) + '\n')
+                manager.save(CheckpointManager.snapshot(model, optimizer, lr_scheduler, epoch=epoch), epoch)
+                manager.wait()
+            names = [os.path.basename(path) for path in manager.checkpoints()]
+
+        assert names == ['epoch_0001.pth', 'epoch_0002.pth']
+
+    def test_resume_continues_exactly(self):
+        model, optimizer, lr_scheduler, losses = self._training_state()
+        self._step(model, optimizer, lr_scheduler, losses)
+        random.seed(1)
+        np.random.seed(1)
+        with CheckpointManager(self.folder) as manager:
+            manager.save(CheckpointManager.snapshot(model, optimizer, lr_scheduler, losses=losses, epoch=0), 0)
+
+        self._step(model, optimizer, lr_scheduler, losses)
+        expected = (model.weight.detach().clone(), losses.summary()['loss'], random.random(), np.random.rand())
+
+        resumed = self._training_state()
+        state = load_checkpoint(resolve_checkpoint(self.folder), *resumed[:3], losses=resumed[3])
+        assert state['epoch'] == 0
+        assert resumed[2].get_last_lr() == [0.05]
+        self._step(*resumed)
+
+        torch.testing.assert_close(resumed[0].weight, expected[0])
+        assert resumed[3].summary()['loss'] == expected[1]
+        assert (random.random(), np.random.rand()) == expected[2:]
+
+    def test_finished_marker_is_cleared_by_a_new_manager(self):
+        CheckpointManager(self.folder).close()
+        mark_finished(self.folder)
+        assert is_finished(self.folder)
+        CheckpointManager(self.folder).close()
+        assert not is_finished(self.folder)
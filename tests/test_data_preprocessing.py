@@ -0,0 +1,72 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from xray.data_preprocessing import (
+    PreprocessingManifest, _normalize_float, _normalize_with_table, source_signature
+)
+
+
+class PreprocessingManifestTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        self.source = os.path.join(self.directory, 'image.dicom')
+        with open(self.source, 'wb') as f:
+            f.write(b'pixels')
+        self.manifest_path = os.path.join(self.directory, 'manifest.jsonl')
+        self.params = dict(max_size=1024, voi_lut=True, fix_monochrome=True)
+
+    def record_done(self):
+        manifest = PreprocessingManifest(self.manifest_path)
+        manifest.record([
+            dict(source_signature(self.source), image_id='image', status='done', params=self.params)
+        ])
+
+    def test_unchanged_source_is_current(self):
+        self.record_done()
+        manifest = PreprocessingManifest(self.manifest_path)
+        assert manifest.is_current('image', self.source, self.params)
+        assert not manifest.is_current('image', self.source, dict(self.params, max_size=512))
+        assert not manifest.is_current('other', self.source, self.params)
+
+    def test_levels_are_recorded_separately(self):
+        self.record_done()
+        manifest = PreprocessingManifest(self.manifest_path)
+        params = dict(self.params, max_size=512)
+        manifest.record([dict(source_signature(self.source), image_id='image', status='failed', params=params)])
+        manifest = PreprocessingManifest(self.manifest_path)
+        assert manifest.is_current('image', self.source, self.params)
+        assert not manifest.is_current('image', self.source, dict(self.params, max_size=512))
+
+    def test_touched_and_changed_sources(self):
+        self.record_done()
+        os.utime(self.source, ns=(1, 1))
+        assert PreprocessingManifest(self.manifest_path).is_current('image', self.source, self.params)
+
+        with open(self.source, 'wb') as f:
+            f.write(b'pixelz')
+        os.utime(self.source, ns=(2, 2))
+        assert not PreprocessingManifest(self.manifest_path).is_current('image', self.source, self.params)
+
+    def test_torn_line_is_ignored(self):
+        self.record_done()
+        with open(self.manifest_path, 'a') as f:
+            f.write('{"image_id": "ima')
+        assert PreprocessingManifest(self.manifest_path).is_current('image', self.source, self.params)
+
+
+class NormalizeTest(unittest.TestCase):
+    def test_table_matches_float_path(self):
+        rng = np.random.default_rng(0)
+        for dtype, low, high in [(np.uint16, 0, 4096), (np.int16, -1024, 3000), (np.uint8, 10, 200)]:
+            data = rng.integers(low, high, (37, 29)).astype(dtype)
+            for invert in [False, True]:
+                np.testing.assert_array_equal(
+                    _normalize_with_table(data, invert=invert), _normalize_float(data, invert=invert)
+                )
+
+    def test_constant_image(self):
+        data = np.full((4, 5), 7, dtype=np.uint16)
+        np.testing.assert_array_equal(_normalize_with_table(data), np.zeros((4, 5), dtype=np.uint8))
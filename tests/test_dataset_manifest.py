@@ -0,0 +1,59 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from xray.dataset_manifest import DatasetManifest, get_manifest
+from xray.image_store import ImageStoreWriter, image_store_dir
+
+
+class DatasetManifestTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        image_ids = [f'img{i}' for i in range(10)]
+        pd.DataFrame({
+            'image_id': image_ids + ['img0'],
+            'width': list(range(100, 110)) + [100],
+            'height': list(range(200, 210)) + [200],
+        }).to_csv(os.path.join(self.directory, 'train.csv'), index=False)
+
+        with ImageStoreWriter(image_store_dir(self.directory, 'train', 1024)) as writer:
+            for image_id in reversed(image_ids):
+                writer.add(image_id, np.zeros((2, 2), dtype=np.uint8))
+        with ImageStoreWriter(image_store_dir(self.directory, 'test', 1024)) as writer:
+            writer.add('t0', np.zeros((2, 2), dtype=np.uint8), original_shape=(30, 40))
+
+    def test_create_and_load(self):
+        manifest = DatasetManifest.create(self.directory, self.directory, split=0.8)
+        path = os.path.join(self.directory, 'manifest.npz')
+        manifest.save(path)
+        loaded = DatasetManifest.load(path)
+
+        train, eval_ = loaded.ids('train'), loaded.ids('eval')
+        assert len(train) == 8 and len(eval_) == 2
+        assert sorted(train + eval_) == [f'img{i}' for i in range(10)]
+        assert loaded.ids('test') == ['t0']
+        assert DatasetManifest.create(self.directory, self.directory).ids('train') == train
+
+        row = loaded.image_ids.tolist().index('img3')
+        assert (loaded.widths[row], loaded.heights[row]) == (103, 203)
+        assert loaded.store_positions[row] == 6
+        test_row = loaded.select('test')[0]
+        assert (loaded.widths[test_row], loaded.heights[test_row]) == (40, 30)
+        assert loaded.sizes('test').values.tolist() == [['t0', 30, 40]]
+
+    def test_rebuilt_when_inputs_change(self):
+        path = os.path.join(self.directory, 'manifest.npz')
+        manifest = get_manifest(path, self.directory, self.directory)
+        assert get_manifest(path, self.directory, self.directory) is manifest
+
+        pd.DataFrame({'image_id': ['img3'], 'width': [1000], 'height': [2000]}).to_csv(
+            os.path.join(self.directory, 'train.csv'), index=False
+        )
+        rebuilt = get_manifest(path, self.directory, self.directory)
+        row = rebuilt.image_ids.tolist().index('img3')
+        assert (rebuilt.widths[row], rebuilt.heights[row]) == (1000, 2000)
+        assert DatasetManifest.load(path).fingerprint == rebuilt.fingerprint
+        assert get_manifest(path, self.directory, self.directory, rebuild=True) is not rebuilt
@@ -0,0 +1,43 @@
+import unittest
+
+import numpy as np
+import torch
+
+import xray.distributed
+import xray.utils
+from xray.distributed import ShardSampler
+from xray.predictions import DetectionBuffer
+
+
+def _collectives(rank, world_size, port, results):
+    xray.distributed.init_process_group(rank, world_size, master_port=port)
+    losses = xray.utils.LossAccumulator()
+    loss = torch.tensor(rank + 1.0)
+    losses.update({name: loss for name in xray.utils.LOSS_NAMES}, loss)
+    detections = DetectionBuffer(with_scores=False)
+    detections.add(f'img{rank}', np.zeros((rank, 4)), np.full(rank, rank))
+    results[rank] = dict(
+        detections=xray.distributed.gather_detections(detections).image_ids,
+        gathered=xray.distributed.gather_lists([rank] * (rank + 1)),
+        steps=xray.distributed.min_over_processes(10 + rank),
+        loss=xray.distributed.reduce_losses(losses)['loss']
+    )
+    xray.distributed.cleanup()
+
+
+class DistributedTest(unittest.TestCase):
+    def test_shards_cover_dataset_once(self):
+        shards = [list(ShardSampler(10, rank, 3)) for rank in range(3)]
+        assert sorted(i for shard in shards for i in shard) == list(range(10))
+        assert [len(ShardSampler(10, rank, 3)) for rank in range(3)] == [4, 3, 3]
+
+    def test_collectives_with_gloo(self):
+        with torch.multiprocessing.Manager() as manager:
+            results = manager.dict()
+            torch.multiprocessing.spawn(_collectives, args=(2, 29517, results), nprocs=2)
+            results = dict(results)
+        for rank in range(2):
+            assert results[rank]['gathered'] == [0, 1, 1]
+            assert results[rank]['detections'] == ['img0', 'img1']
+            assert results[rank]['steps'] == 10
+            assert results[rank]['loss'] == 1.5
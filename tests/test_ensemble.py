@@ -0,0 +1,63 @@
+import unittest
+
+import numpy as np
+import torch
+
+from xray.evalutation import build_rcnn
+from xray.ensemble import Ensemble, unflip, weighted_box_fusion
+from xray.predictions import DetectionBuffer
+
+
+class WeightedBoxFusionTest(unittest.TestCase):
+    def test_fuses_overlapping_boxes_of_a_label(self):
+        first, second = DetectionBuffer(), DetectionBuffer()
+        first.add('a', np.array([[0, 0, 10, 10], [50, 50, 60, 60]]), np.array([1, 1]), np.array([.8, .6]))
+        first.add('b', np.zeros((0, 4)), np.array([], dtype=np.int64), np.array([]))
+        second.add('a', np.array([[1, 1, 11, 11], [0, 0, 10, 10]]), np.array([1, 2]), np.array([.4, .5]))
+        second.add('b', np.array([[0, 0, 5, 5]]), np.array([3]), np.array([.9]))
+
+        fused = weighted_box_fusion([first, second], iou_threshold=.55)
+        assert fused.image_ids == ['a', 'b']
+        # The two overlapping label 1 boxes are fused, every other box is on its own.
+        low, high = (0 * .8 + 1 * .4) / 1.2, (10 * .8 + 11 * .4) / 1.2
+        np.testing.assert_allclose(fused[0]['boxes'][0], [low, low, high, high], rtol=1e-6)
+        np.testing.assert_allclose(fused[0]['scores'], [.6, .3, .25], rtol=1e-6)
+        assert fused[0]['labels'].tolist() == [1, 1, 2]
+        np.testing.assert_allclose(fused[1]['scores'], [.45], rtol=1e-6)
+
+    def test_weights(self):
+        first, second = DetectionBuffer(), DetectionBuffer()
+        first.add('a', np.array([[0, 0, 10, 10]]), np.array([1]), np.array([.5]))
+        second.add('a', np.array([[0, 0, 10, 20]]), np.array([1]), np.array([.5]))
+
+        fused = weighted_box_fusion([first, second], weights=[3, 1], iou_threshold=.4)
+        np.testing.assert_allclose(fused[0]['boxes'], [[0, 0, 10, 12.5]], rtol=1e-6)
+        np.testing.assert_allclose(fused[0]['scores'], [(1.5 + .5) / 2 * 2 / 4], rtol=1e-6)
+
+
+class EnsembleTest(unittest.TestCase):
+    def test_unflips_views(self):
+        predictions = DetectionBuffer()
+        predictions.add('a', np.array([[10, 20, 30, 60]]), np.array([1]), np.array([.5]), shape=(100, 50))
+        assert unflip(predictions, 'hflip').boxes.tolist() == [[20, 20, 40, 60]]
+        assert unflip(predictions, 'vflip').boxes.tolist() == [[10, 40, 30, 80]]
+        with self.assertRaises(KeyError):
+            unflip(predictions, 'rotate')
+
+    def test_views_of_a_symmetric_image(self):
+        torch.manual_seed(0)
+        model = build_rcnn(image_size=64)
+        model.roi_heads.score_thresh = 0.0
+        ensemble = Ensemble([model], views=['none', 'hflip'])
+        ensemble.eval()
+        half = torch.rand(3, 64, 32)
+        images = [torch.cat([half, half.flip(2)], dim=2), torch.rand(3, 64, 64)]
+        with torch.no_grad():
+            none, hflip = ensemble.predict_views(images, ['a', 'b'])
+            fused = ensemble(images)
+
+        # The flipped image is the image, so its boxes come back mirrored.
+        assert none.n_rows > 0 and ensemble.forward_seconds[0] > 0
+        np.testing.assert_allclose(hflip[0]['boxes'], unflip(none, 'hflip')[0]['boxes'], atol=1e-3)
+        np.testing.assert_allclose(hflip[0]['scores'], none[0]['scores'], atol=1e-5)
+        assert len(fused) == 2 and set(fused[0]) == {'boxes', 'labels', 'scores'}
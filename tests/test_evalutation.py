@@ -0,0 +1,81 @@
+import copy
+import unittest
+
+import torch
+from torchvision.models.detection import fasterrcnn_resnet50_fpn
+
+import xray.utils
+from xray.evalutation import model_eval_forward, to_single_channel
+
+
+class SingleChannelTest(unittest.TestCase):
+    def test_folded_conv_matches_rgb_conv(self):
+        model = fasterrcnn_resnet50_fpn(pretrained_backbone=False)
+        rgb_model = copy.deepcopy(model)
+        to_single_channel(model)
+
+        image = torch.rand(1, 64, 64)
+        with torch.no_grad():
+            rgb_features = rgb_model.backbone.body.conv1(
+                rgb_model.transform.normalize(image.expand(3, -1, -1)).unsqueeze(0)
+            )
+            features = model.backbone.body.conv1(model.transform.normalize(image).unsqueeze(0))
+
+        assert model.backbone.body.conv1.in_channels == 1
+        # Only the zero-padded border differs.
+        torch.testing.assert_close(features[..., 2:-2, 2:-2], rgb_features[..., 2:-2, 2:-2], atol=1e-4, rtol=1e-4)
+
+
+class MixedPrecisionTest(unittest.TestCase):
+    def setUp(self) -> None:
+        torch.manual_seed(0)
+        self.model = fasterrcnn_resnet50_fpn(
+            pretrained_backbone=False, num_classes=15, min_size=128, max_size=128
+        )
+        self.images = [torch.randint(0, 256, (3, 128, 128), dtype=torch.uint8) for _ in range(2)]
+        self.targets = [{
+            'boxes': torch.tensor([[10., 20., 60., 90.]]),
+            'labels': torch.tensor([3]),
+            'file_name': f'image{i}'
+        } for i in range(2)]
+
+    def test_bf16_training_step(self):
+        self.model.train()
+        with xray.utils.autocast('cpu', 'bf16'):
+            loss_dict = self.model(xray.utils.to_float_images(self.images), self.targets)
+        total_loss = sum(loss.float() for loss in loss_dict.values())
+        assert torch.isfinite(total_loss)
+
+        scaler = xray.utils.grad_scaler('cpu', 'bf16')
+        scaler.scale(total_loss).backward()
+        assert all(
+            p.grad.dtype == torch.float32 for p in self.model.parameters() if p.grad is not None
+        )
+
+    def test_bf16_evaluation_returns_float32(self):
+        loader = [(self.images, self.targets)]
+        results, targets = model_eval_forward(self.model, loader, score_threshold=0, precision='bf16')
+        assert len(results) == len(targets) == 2
+        assert all(result['boxes'].dtype == 'float32' for result in results)
+
+    def test_bf16_boxes_match_fp32(self):
+        model = xray.utils.float32_boxes(fasterrcnn_resnet50_fpn(
+            pretrained_backbone=False, num_classes=15, min_size=800, max_size=800
+        ))
+        # Constant head outputs, so both precisions keep the same boxes in the same order.
+        heads = [model.rpn.head.cls_logits, model.rpn.head.bbox_pred, model.roi_heads.box_head.fc6,
+                 model.roi_heads.box_head.fc7, model.roi_heads.box_predictor.cls_score,
+                 model.roi_heads.box_predictor.bbox_pred]
+        with torch.no_grad():
+            for layer in heads:
+                layer.weight.zero_()
+                layer.bias.fill_(0.25)
+            model.roi_heads.box_predictor.cls_score.bias[3] = 2.0
+        loader = [([torch.randint(0, 256, (3, 800, 800), dtype=torch.uint8)], self.targets[:1])]
+
+        fp32, _ = model_eval_forward(model, loader, score_threshold=0)
+        bf16, _ = model_eval_forward(model, loader, score_threshold=0, precision='bf16')
+        assert len(bf16[0]['boxes']) > 0
+        # bf16 anchors or decoding would round coordinates above 512 to multiples of 4.
+        boxes, expected = torch.as_tensor(bf16[0]['boxes']), torch.as_tensor(fp32[0]['boxes'])
+        torch.testing.assert_close(boxes, expected, atol=0.5, rtol=0)
@@ -0,0 +1,75 @@
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+
+import xray.feature_cache
+from xray.evalutation import build_rcnn
+from xray.feature_cache import DetectionHeads, FeatureCacheDataset, build_feature_cache, is_current
+
+
+class _ImageDataset:
+    def __init__(self, n_images: int = 3):
+        rng = np.random.default_rng(0)
+        self.images = [
+            torch.from_numpy(rng.integers(0, 256, size=(3, 80, 100 - 10 * i), dtype=np.uint8))
+            for i in range(n_images)
+        ]
+        self.available_files = [f'img{i}' for i in range(n_images)]
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, item):
+        return self.images[item], {
+            'boxes': torch.tensor([[10, 10, 40, 50], [5, 20, 30, 60]]),
+            'labels': torch.tensor([3, 0]),
+            'file_name': self.available_files[item]
+        }
+
+
+class FeatureCacheTest(unittest.TestCase):
+    def setUp(self) -> None:
+        torch.manual_seed(0)
+        self.model = build_rcnn(image_size=64)
+        self.dataset = _ImageDataset()
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def test_cached_features_match_the_backbone(self):
+        build_feature_cache(self.model, self.dataset, self.tmp.name, 64, dtype='fp16', flip=True, batch_size=2)
+        assert is_current(self.tmp.name, self.dataset.available_files, 64, self.model, 'fp16', flip=True)
+        assert not is_current(self.tmp.name, self.dataset.available_files, 96, self.model, 'fp16', flip=True)
+        assert not is_current(self.tmp.name, self.dataset.available_files, 64, self.model, 'fp32', flip=True)
+        assert not is_current(self.tmp.name, self.dataset.available_files, 64, self.model, 'fp16', flip=False)
+
+        cache = FeatureCacheDataset(self.tmp.name, flip_prob=0.0)
+        assert len(cache) == 3 and cache.size == 64
+        features, target = cache[1]
+        image_list, _ = self.model.transform([self.dataset.images[1].float() / 255])
+        padded = torch.nn.functional.pad(image_list.tensors, (0, 64 - image_list.tensors.shape[-1]))
+        with torch.no_grad():
+            expected = self.model.backbone(padded)
+        for level, feature in features.items():
+            torch.testing.assert_close(feature.float(), expected[level][0], rtol=1e-2, atol=1e-2)
+        assert target['image_size'] == tuple(image_list.image_sizes[0])
+        assert target['boxes'].shape == (2, 4)
+
+        flipped = FeatureCacheDataset(self.tmp.name, flip_prob=1.0)[1][1]
+        torch.testing.assert_close(flipped['boxes'][:, 0], target['image_size'][1] - target['boxes'][:, 2])
+
+    def test_heads_train_from_the_cache(self):
+        build_feature_cache(self.model, self.dataset, self.tmp.name, 64, dtype='fp32')
+        cache = FeatureCacheDataset(self.tmp.name)
+        batch, targets = xray.feature_cache.collate([cache[0], cache[2]])
+        batch, targets = xray.feature_cache.batch_to_device(batch, targets, 'cpu')
+
+        heads = DetectionHeads(self.model, cache.size).train()
+        loss_dict = heads(batch, targets)
+        assert set(loss_dict) == {'loss_classifier', 'loss_box_reg', 'loss_objectness', 'loss_rpn_box_reg'}
+        sum(loss_dict.values()).backward()
+        assert self.model.roi_heads.box_predictor.cls_score.weight.grad is not None
+        assert self.model.backbone.body.conv1.weight.grad is None
@@ -0,0 +1,57 @@
+import pickle
+import tempfile
+import unittest
+
+import numpy as np
+
+from xray.image_store import ImageStore, ImageStoreWriter, image_store_dir, select_size, store_sizes
+
+
+class ImageStoreTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        self.images = {
+            'a': np.arange(12, dtype=np.uint8).reshape(3, 4),
+            'b': np.full((5, 2), 7, dtype=np.uint8),
+        }
+
+    def test_roundtrip(self):
+        with ImageStoreWriter(self.directory) as writer:
+            writer.add('a', self.images['a'], boxes=np.array([[0, 0, 2, 2]]), labels=np.array([3]))
+            writer.add('b', self.images['b'], original_shape=(50, 20))
+
+        store = ImageStore(self.directory)
+        assert len(store) == 2
+        np.testing.assert_array_equal(store.image('a'), self.images['a'])
+        np.testing.assert_array_equal(store.image('b'), self.images['b'])
+        np.testing.assert_array_equal(store.original_shapes, [[3, 4], [50, 20]])
+        boxes, labels, _ = store.annotations.lookup('a')
+        np.testing.assert_array_equal(boxes, [[0, 0, 2, 2]])
+        np.testing.assert_array_equal(labels, [3])
+        assert len(store.annotations.lookup('b')[0]) == 0
+
+        unpickled = pickle.loads(pickle.dumps(store))
+        np.testing.assert_array_equal(unpickled.image('b'), self.images['b'])
+
+    def test_append_and_replace(self):
+        with ImageStoreWriter(self.directory) as writer:
+            writer.add('a', self.images['a'])
+        with ImageStoreWriter(self.directory, append=True) as writer:
+            writer.add('b', self.images['b'])
+            writer.add('a', self.images['a'] + 1)
+
+        store = ImageStore(self.directory)
+        assert store.image_ids.tolist() == ['a', 'b']
+        np.testing.assert_array_equal(store.image('a'), self.images['a'] + 1)
+        np.testing.assert_array_equal(store.image('b'), self.images['b'])
+
+    def test_select_size(self):
+        for size in [1024, 512, 384]:
+            with ImageStoreWriter(image_store_dir(self.directory, 'train', size)) as writer:
+                writer.add('a', self.images['a'])
+        assert store_sizes(self.directory) == [384, 512, 1024]
+        assert select_size(self.directory, 'train', 512) == 512
+        assert select_size(self.directory, 'train', 600) == 1024
+        assert select_size(self.directory, 'train', 2048) == 1024
+        with self.assertRaises(FileNotFoundError):
+            select_size(self.directory, 'test', 512)
@@ -0,0 +1,53 @@
+import csv
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+import torch
+from PIL import Image
+
+from xray.evalutation import build_rcnn
+from xray.inference import ImageFolder, finished_images, run_inference
+
+
+def _read_rows(path):
+    with open(path, newline='') as f:
+        return list(csv.reader(f))
+
+
+class RunInferenceTest(unittest.TestCase):
+    def test_continues_an_interrupted_output(self):
+        torch.manual_seed(0)
+        model = build_rcnn(image_size=64)
+        with tempfile.TemporaryDirectory() as folder:
+            images = os.path.join(folder, 'test')
+            os.makedirs(images)
+            for i in range(5):
+                Image.fromarray(np.random.randint(0, 255, (64, 64), dtype=np.uint8)).save(
+                    os.path.join(images, f'img{i}.png')
+                )
+            output = os.path.join(folder, 'submission.csv')
+            with open(output, 'w') as f:
+                f.write('image_id,PredictionString\nimg0,14 1.0 0.0 0.0 1.0 1.0\nimg1,14 1.0 0.0')
+
+            done = finished_images(output)
+            assert done == {'img0'}
+            sizes = pd.DataFrame({'image_id': ['img2'], 'height': [128], 'width': [256]})
+            with self.assertRaises(KeyError):
+                ImageFolder(images, image_size=64, original_sizes=sizes, skip=done)
+            sizes = pd.DataFrame({
+                'image_id': [f'img{i}' for i in range(1, 5)], 'height': [128] * 4, 'width': [256] * 4
+            })
+            dataset = ImageFolder(images, image_size=32, original_sizes=sizes, skip=done)
+            assert dataset.available_files == ['img1', 'img2', 'img3', 'img4']
+            image, target = dataset[1]
+            assert image.shape == (3, 32, 32) and target['original_shape'] == (128, 256)
+
+            written = run_inference(model, dataset, output, batch_size=2, num_workers=0, score_threshold=0.0)
+            rows = _read_rows(output)
+            assert written == 4
+            assert rows[0] == ['image_id', 'PredictionString']
+            assert [row[0] for row in rows[1:]] == ['img0', 'img1', 'img2', 'img3', 'img4']
+            assert all(len(row[1].split(' ')) % 6 == 0 for row in rows[1:])
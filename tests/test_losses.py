@@ -0,0 +1,80 @@
+import unittest
+
+import torch
+
+from xray.utils import LOSS_NAMES, LossAccumulator, NonFiniteGradientMask, grad_scaler
+
+
+class LossAccumulatorTest(unittest.TestCase):
+    def test_non_finite_steps_are_counted_not_summed(self):
+        losses = LossAccumulator()
+        for value in [1.0, float('nan'), 3.0, float('inf')]:
+            loss = torch.tensor(value)
+            losses.update({name: loss / 4 for name in LOSS_NAMES}, loss)
+
+        summary = losses.summary()
+        assert summary['loss'] == 2.0
+        assert summary['losses'] == {name: 0.5 for name in LOSS_NAMES}
+        assert (summary['steps'], summary['skipped']) == (2, 2)
+
+        losses.reset()
+        assert losses.summary()['loss'] == 0.0
+
+    def test_gradients_of_non_finite_steps_are_nan(self):
+        model = torch.nn.Linear(3, 1)
+        grad_mask = NonFiniteGradientMask(model.parameters())
+        losses = LossAccumulator()
+        for value in [1.0, float('nan')]:
+            loss = model(torch.full((1, 3), 1.0)).sum() * value
+            finite = losses.update({name: loss for name in LOSS_NAMES}, loss)
+            grad_mask.mask(loss, finite).backward()
+            assert torch.isfinite(model.weight.grad).all() == (value == 1.0)
+
+    def test_non_finite_steps_leave_parameters_and_momentum(self):
+        # The pass-through scaler of fp32, and an enabled one as for fp16 on CUDA (on the CPU,
+        # which needs torch.amp.GradScaler).
+        scalers = [grad_scaler('cpu')] + ([torch.amp.GradScaler('cpu')] if hasattr(torch.amp, 'GradScaler') else [])
+        for scaler in scalers:
+            torch.manual_seed(0)
+            model = torch.nn.Linear(3, 1)
+            optimizer = torch.optim.SGD(model.parameters(), lr=0.1, momentum=0.9, weight_decay=0.1)
+            grad_mask = NonFiniteGradientMask(model.parameters())
+            losses = LossAccumulator()
+            # The non-finite batch is the second of an accumulation window of two.
+            for values in [[1.0], [1.0, float('inf')]]:
+                for value in values:
+                    loss = model(torch.ones(1, 3)).sum() * value
+                    finite = losses.update({name: loss for name in LOSS_NAMES}, loss)
+                    scaler.scale(grad_mask.mask(loss, finite)).backward()
+                grad_mask.step(optimizer, scaler)
+                optimizer.zero_grad()
+                if len(values) == 1:
+                    parameters = [p.detach().clone() for p in model.parameters()]
+                    momentum = [optimizer.state[p]['momentum_buffer'].clone() for p in model.parameters()]
+                    scale = scaler.get_scale()
+
+            for p, before, buffer in zip(model.parameters(), parameters, momentum):
+                torch.testing.assert_close(p.detach(), before, rtol=0, atol=0)
+                torch.testing.assert_close(optimizer.state[p]['momentum_buffer'], buffer, rtol=0, atol=0)
+            if scaler.is_enabled():
+                assert scaler.get_scale() < scale
+
+    @unittest.skipUnless(torch.cuda.is_available(), 'needs CUDA')
+    def test_steps_do_not_synchronize(self):
+        model = torch.nn.Linear(3, 1).cuda()
+        optimizer = torch.optim.SGD(model.parameters(), lr=0.1, momentum=0.9)
+        grad_mask = NonFiniteGradientMask(model.parameters())
+        losses = LossAccumulator('cuda')
+        inputs = torch.ones(1, 3, device='cuda')
+        for scaler in [grad_scaler('cuda'), grad_scaler('cuda', 'fp16')]:
+            torch.cuda.set_sync_debug_mode('error')
+            try:
+                for value in [1.0, float('nan'), 1.0]:
+                    loss = model(inputs).sum() * value
+                    finite = losses.update({name: loss for name in LOSS_NAMES}, loss)
+                    scaler.scale(grad_mask.mask(loss, finite)).backward()
+                    grad_mask.step(optimizer, scaler)
+                    optimizer.zero_grad()
+            finally:
+                torch.cuda.set_sync_debug_mode('default')
+            assert torch.isfinite(model.weight).all()
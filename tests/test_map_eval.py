@@ -0,0 +1,85 @@
+import contextlib
+import io
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from xray.coco_eval import VinBigDataEval
+from xray.map_eval import OnlineMAPEvaluator, evaluate
+from xray.predictions import DetectionBuffer
+
+
+def _random_data(n_images: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    predictions, targets = DetectionBuffer(), DetectionBuffer(with_scores=False)
+    for i in range(n_images):
+        labels = rng.integers(0, 15, rng.integers(1, 4))
+        corners = rng.uniform(0, 200, (len(labels), 2))
+        boxes = np.concatenate([corners, corners + rng.uniform(5, 60, (len(labels), 2))], axis=1)
+        targets.add(f'img{i}', boxes, labels)
+
+        source = rng.integers(0, len(labels), rng.integers(0, 6))
+        predicted = np.trunc(boxes[source] + rng.normal(0, 6, (len(source), 4)))
+        predicted_labels = np.where(rng.uniform(size=len(source)) < .8, labels[source], rng.integers(0, 15, len(source)))
+        # Rounded scores, so that there are ties.
+        predictions.add(f'img{i}', predicted, predicted_labels, np.round(rng.uniform(.5, 1, len(source)), 2))
+    return predictions, targets
+
+
+def _images(buffer: DetectionBuffer, start: int, stop: int) -> DetectionBuffer:
+    result = DetectionBuffer(with_scores=buffer.with_scores)
+    for i in range(start, stop):
+        image = buffer[i]
+        result.add(image['file_name'], image['boxes'], image['labels'], image.get('scores'))
+    return result
+
+
+def _vinbigdata_map(predictions: DetectionBuffer, targets: DetectionBuffer) -> float:
+    true_df = pd.DataFrame(targets.boxes, columns=['x_min', 'y_min', 'x_max', 'y_max'])
+    true_df['class_id'] = targets.labels
+    true_df['image_id'] = np.array(targets.image_ids)[targets.image_index()]
+    pred_df = pd.DataFrame({
+        'image_id': np.array(predictions.image_ids)[predictions.image_index()],
+        'PredictionString': [
+            f'{label} {score} {x0} {y0} {x1} {y1}' for label, score, (x0, y0, x1, y1)
+            in zip(predictions.labels, predictions.scores.tolist(), predictions.boxes.tolist())
+        ]
+    })
+    with contextlib.redirect_stdout(io.StringIO()):
+        return VinBigDataEval(true_df).evaluate(pred_df).stats[0]
+
+
+class MAPEvaluationTest(unittest.TestCase):
+    def test_matches_vinbigdata_eval(self):
+        for seed in range(3):
+            predictions, targets = _random_data(60, seed)
+            self.assertAlmostEqual(evaluate(predictions, targets).map, _vinbigdata_map(predictions, targets), places=12)
+
+    def test_average_precision(self):
+        targets = DetectionBuffer(with_scores=False)
+        targets.add('a', np.array([[0, 0, 10, 10], [20, 20, 30, 30]]), np.array([1, 1]))
+        predictions = DetectionBuffer()
+        predictions.add(
+            'a', np.array([[0, 0, 10, 10], [50, 50, 60, 60], [20, 20, 30, 31]]), np.array([1, 1, 1]),
+            np.array([.9, .8, .7])
+        )
+        # Precision 1 up to recall 0.5 (51 thresholds), then 2/3 up to recall 1 (50 thresholds).
+        result = evaluate(predictions, targets, coco_compatible=False)
+        self.assertAlmostEqual(result.map, (51 + 50 * 2 / 3) / 101)
+        assert list(result.class_ap) == [1]
+
+    def test_online_evaluation_matches_evaluate(self):
+        predictions, targets = _random_data(60, seed=3)
+        evaluators = []
+        # Two shards of 30 images, fed in batches of 7.
+        for shard, start in enumerate([0, 30]):
+            evaluator = OnlineMAPEvaluator(shard=shard)
+            for batch in range(start, start + 30, 7):
+                stop = min(batch + 7, start + 30)
+                evaluator.update(_images(predictions, batch, stop), _images(targets, batch, stop))
+            evaluators.append(evaluator)
+
+        expected = evaluate(predictions, targets)
+        self.assertEqual(OnlineMAPEvaluator.concatenate(evaluators).result(), expected)
+        self.assertEqual(evaluators[0].result(), evaluate(_images(predictions, 0, 30), _images(targets, 0, 30)))
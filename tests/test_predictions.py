@@ -0,0 +1,64 @@
+import pickle
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from xray.predictions import DetectionBuffer, nms, original_shapes, postprocess, to_submission
+
+
+def _boxes(n, value):
+    return np.full((n, 4), value, dtype=np.float32)
+
+
+class DetectionBufferTest(unittest.TestCase):
+    def test_grows_past_its_preallocation(self):
+        buffer = DetectionBuffer(n_images=1, per_image=2)
+        buffer.extend(['a', 'b'], [3, 0], _boxes(3, 1), np.array([1, 2, 3]), np.array([.9, .8, .7]))
+        buffer.add('c', _boxes(2, 2), np.array([4, 5]), np.array([.6, .5]))
+
+        assert len(buffer) == 3 and buffer.n_rows == 5
+        assert buffer[0]['labels'].tolist() == [1, 2, 3] and buffer[0]['file_name'] == 'a'
+        assert buffer[1]['boxes'].shape == (0, 4)
+        assert buffer[-1]['scores'].tolist() == [np.float32(.6), np.float32(.5)]
+        assert [d['file_name'] for d in buffer] == ['a', 'b', 'c']
+
+    def test_pickles_used_rows_and_concatenates(self):
+        first = DetectionBuffer(n_images=100, with_scores=False)
+        first.add('a', _boxes(1, 1), np.array([1]))
+        second = pickle.loads(pickle.dumps(first))
+        assert len(second._labels) == 1
+        second.add('b', _boxes(2, 3), np.array([2, 3]))
+
+        merged = DetectionBuffer.concatenate([first, second])
+        assert merged.image_ids == ['a', 'a', 'b']
+        assert merged.offsets[:4].tolist() == [0, 1, 2, 4]
+        assert merged.labels.tolist() == [1, 1, 2, 3] and merged.scores is None
+        assert 'scores' not in merged[2]
+
+
+class PostprocessTest(unittest.TestCase):
+    def test_submission_rows(self):
+        predictions = DetectionBuffer()
+        predictions.add(
+            'a', np.array([[10, 20, 30, 40], [11, 21, 30, 40], [5, 5, 9, 9]]), np.array([3, 3, 0]),
+            np.array([.9, .8, .7]), shape=(100, 50)
+        )
+        predictions.add('b', np.zeros((0, 4)), np.zeros(0), np.zeros(0), shape=(10, 10))
+        desc = pd.DataFrame({'image_id': ['b', 'a', 'a'], 'height': [20, 200, 200], 'width': [20, 500, 500]})
+
+        submission = to_submission(postprocess(predictions, original_shapes(['a', 'b'], desc)))
+        assert submission.image_id.tolist() == ['a', 'b']
+        assert submission.PredictionString.tolist() == [
+            '14 1.0000 0.0 0.0 1.0 1.0 2 0.9000 100.0 40.0 300.0 80.0',
+            '14 1.0000 0.0 0.0 1.0 1.0'
+        ]
+        with self.assertRaises(KeyError):
+            original_shapes(['c'], desc)
+
+    def test_nms_is_class_agnostic_by_default(self):
+        predictions = DetectionBuffer()
+        predictions.add('a', np.array([[0, 0, 10, 10], [1, 1, 10, 10]]), np.array([1, 2]), np.array([.5, .6]))
+        predictions.add('b', np.array([[0, 0, 10, 10]]), np.array([1]), np.array([.5]))
+        assert nms(predictions).labels.tolist() == [2, 1, 1]
+        assert nms(predictions, per_class=False).labels.tolist() == [2, 1]
@@ -0,0 +1,59 @@
+import unittest
+
+import torch
+from torch.utils.data import DataLoader
+
+import xray.utils
+from xray.prefetch import BatchPrefetcher
+
+
+class _Dataset:
+    def __len__(self):
+        return 10
+
+    def __getitem__(self, item):
+        return torch.full((1, 4, 4), item, dtype=torch.uint8), {
+            'boxes': torch.tensor([[0, 0, item + 1, item + 1]]),
+            'labels': torch.tensor([item % 3]),
+            'file_name': f'img{item}'
+        }
+
+
+class _Failing(_Dataset):
+    def __getitem__(self, item):
+        if item == 5:
+            raise ValueError('broken image')
+        return super().__getitem__(item)
+
+
+def _loader(dataset):
+    return DataLoader(dataset, batch_size=3, collate_fn=xray.utils.my_custom_collate)
+
+
+class BatchPrefetcherTest(unittest.TestCase):
+    def test_yields_the_loader_batches_in_order(self):
+        expected = list(_loader(_Dataset()))
+        for depth in [0, 1, 3]:
+            batches = list(BatchPrefetcher(_loader(_Dataset()), depth=depth))
+            assert len(batches) == len(expected) == 4
+            for (images, targets), (expected_images, expected_targets) in zip(batches, expected):
+                assert all(torch.equal(a, b) for a, b in zip(images, expected_images))
+                assert [t['file_name'] for t in targets] == [t['file_name'] for t in expected_targets]
+                assert all(torch.equal(a['boxes'], b['boxes']) for a, b in zip(targets, expected_targets))
+
+    def test_custom_prepare_and_early_stop(self):
+        prefetcher = BatchPrefetcher(
+            _loader(_Dataset()), depth=2,
+            prepare=lambda images, targets: (xray.utils.images_to_device(images, 'cpu'), targets)
+        )
+        for step, (images, targets) in enumerate(prefetcher):
+            assert images[0].dtype == torch.float32
+            assert prefetcher.last_prepare_time >= 0
+            if step == 1:
+                break
+        # A new pass starts from the beginning again.
+        assert next(iter(prefetcher))[1][0]['file_name'] == 'img0'
+
+    def test_loader_errors_are_raised(self):
+        with self.assertRaises(ValueError):
+            list(BatchPrefetcher(_loader(_Failing()), depth=2))
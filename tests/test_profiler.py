@@ -0,0 +1,54 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from xray.profiler import PipelineProfiler, SampleTimer
+
+
+def _batches(n_batches: int, batch_size: int = 2):
+    for _ in range(n_batches):
+        time.sleep(0.01)
+        targets = []
+        for _ in range(batch_size):
+            timer = SampleTimer(enabled=True)
+            with timer('decode'):
+                pass
+            targets.append({'file_name': 'x', 'timings': timer.timings})
+        yield [None] * batch_size, targets
+
+
+class PipelineProfilerTest(unittest.TestCase):
+    def test_records_steps_stages_and_samples(self):
+        profiler = PipelineProfiler(enabled=True)
+        for step, (images, targets) in enumerate(profiler.iterate(_batches(4))):
+            if step == 3:
+                break
+            with profiler.stage('forward'):
+                time.sleep(0.002)
+
+        assert len(profiler.steps) == 3
+        summary = profiler.summary('train')
+        assert summary['images'] == 6
+        assert summary['bound'] == 'loader'
+        assert summary['stages']['data_wait']['p50_ms'] >= 10
+        assert summary['stages']['forward']['mean_ms'] >= 2
+        assert set(summary['samples']) == {'decode'}
+
+        with tempfile.TemporaryDirectory() as folder:
+            profiler.write(folder)
+            assert {'profile_steps.csv', 'profile_samples.csv', 'profile_summary.json'} <= set(os.listdir(folder))
+            with open(os.path.join(folder, 'profile_summary.json')) as f:
+                assert json.load(f)['train']['steps'] == 3
+
+    def test_disabled_records_nothing(self):
+        profiler = PipelineProfiler()
+        for images, targets in profiler.iterate(_batches(2)):
+            with profiler.stage('forward'):
+                pass
+        assert profiler.steps == [] and profiler.summary() == {}
+        timer = SampleTimer()
+        with timer('decode'):
+            pass
+        assert timer.timings == {}
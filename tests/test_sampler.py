@@ -0,0 +1,31 @@
+import unittest
+
+import numpy as np
+import torch
+
+from xray.sampler import GroupedBatchSampler, aspect_ratio_groups
+
+
+class GroupedBatchSamplerTest(unittest.TestCase):
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        self.aspect_ratios = rng.choice([0.6, 0.8, 1.0, 1.3], size=103)
+        self.groups = aspect_ratio_groups(self.aspect_ratios)
+
+    def test_batches_are_grouped_and_cover_all_images(self):
+        sampler = GroupedBatchSampler(self.groups, 8, generator=torch.Generator().manual_seed(0))
+        batches = list(sampler)
+        assert len(batches) == len(sampler)
+        assert sorted(i for batch in batches for i in batch) == list(range(103))
+        for batch in batches:
+            assert 0 < len(batch) <= 8
+            assert len(set(self.groups[batch])) == 1
+
+    def test_drop_last(self):
+        sampler = GroupedBatchSampler(self.groups, 8, drop_last=True)
+        batches = list(sampler)
+        assert len(batches) == len(sampler)
+        assert all(len(batch) == 8 for batch in batches)
+
+    def test_groups_split_aspect_ratios(self):
+        assert len(set(aspect_ratio_groups([0.6, 0.8, 1.0, 1.3]).tolist())) == 4
@@ -0,0 +1,123 @@
+import os
+import re
+from typing import Iterable, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+def parse_rad_id(rad_id) -> int:
+    if isinstance(rad_id, str):
+        found = re.findall(r'\d+', rad_id)
+        return int(found[0]) if found else -1
+    if rad_id is None or (isinstance(rad_id, float) and np.isnan(rad_id)):
+        return -1
+    return int(rad_id)
+
+
+class AnnotationIndex:
+    """Per-image annotations in contiguous arrays; ``offsets[i]:offsets[i + 1]`` are the rows of ``image_ids[i]``."""
+
+    def __init__(
+        self,
+        image_ids: np.ndarray,
+        offsets: np.ndarray,
+        boxes: np.ndarray,
+        labels: np.ndarray,
+        rad_ids: np.ndarray
+    ):
+        assert len(offsets) == len(image_ids) + 1
+        assert len(boxes) == len(labels) == len(rad_ids) == offsets[-1]
+
+        self.image_ids = np.asarray(image_ids)
+        self.offsets = np.ascontiguousarray(offsets, dtype=np.int64)
+        self.boxes = np.ascontiguousarray(boxes, dtype=np.float32).reshape(-1, 4)
+        self.labels = np.ascontiguousarray(labels, dtype=np.int8)
+        self.rad_ids = np.ascontiguousarray(rad_ids, dtype=np.int8)
+        self.positions = {image_id: i for i, image_id in enumerate(self.image_ids.tolist())}
+
+    @classmethod
+    def from_frame(
+        cls,
+        data_desc: pd.DataFrame,
+        image_ids: Optional[Iterable[str]] = None,
+        box_columns=('x_min', 'y_min', 'x_max', 'y_max'),
+        label_column: str = 'class_id'
+    ) -> 'AnnotationIndex':
+        """Build the index from a ``train.csv``-like frame, keeping (and ordering by) ``image_ids`` if given."""
+        frame_ids = data_desc['image_id'].values.astype(str)
+        order = np.argsort(frame_ids, kind='stable')
+        sorted_ids = frame_ids[order]
+        unique_ids, starts, counts = np.unique(sorted_ids, return_index=True, return_counts=True)
+
+        boxes = data_desc[list(box_columns)].values.astype(np.float32)[order]
+        labels = data_desc[label_column].values.astype(np.int8)[order]
+        if 'rad_id' in data_desc.columns:
+            rad_ids = np.array(
+                [parse_rad_id(r) for r in data_desc['rad_id'].values], dtype=np.int8
+            )[order]
+        else:
+            rad_ids = np.full(len(order), -1, dtype=np.int8)
+
+        if image_ids is None:
+            return cls(
+                unique_ids, np.append(starts, len(order)), boxes, labels, rad_ids
+            )
+
+        image_ids = np.asarray(list(image_ids)).astype(str)
+        unique_positions = {image_id: i for i, image_id in enumerate(unique_ids.tolist())}
+        positions = np.array(
+            [unique_positions.get(image_id, -1) for image_id in image_ids.tolist()], dtype=np.int64
+        )
+        present = positions >= 0
+        sel_starts = np.zeros(len(image_ids), dtype=np.int64)
+        sel_counts = np.zeros(len(image_ids), dtype=np.int64)
+        sel_starts[present] = starts[positions[present]]
+        sel_counts[present] = counts[positions[present]]
+
+        offsets = np.zeros(len(image_ids) + 1, dtype=np.int64)
+        np.cumsum(sel_counts, out=offsets[1:])
+        rows = np.repeat(sel_starts - offsets[:-1], sel_counts) + np.arange(offsets[-1])
+        return cls(image_ids, offsets, boxes[rows], labels[rows], rad_ids[rows])
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def __contains__(self, image_id: str):
+        return image_id in self.positions
+
+    def slice(self, position: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        start, end = self.offsets[position], self.offsets[position + 1]
+        return self.boxes[start:end], self.labels[start:end], self.rad_ids[start:end]
+
+    def lookup(self, image_id: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Return ``(boxes, labels, rad_ids)`` views for ``image_id`` (empty if unknown)."""
+        position = self.positions.get(image_id)
+        if position is None:
+            return (
+                np.zeros((0, 4), dtype=np.float32),
+                np.zeros((0,), dtype=np.int8),
+                np.zeros((0,), dtype=np.int8)
+            )
+        return self.slice(position)
+
+    def save(self, path: str):
+        """Atomically write the index to ``path`` as an uncompressed ``.npz`` file."""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(
+                f,
+                image_ids=self.image_ids.astype(str),
+                offsets=self.offsets,
+                boxes=self.boxes,
+                labels=self.labels,
+                rad_ids=self.rad_ids
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'AnnotationIndex':
+        with np.load(path) as data:
+            return cls(
+                data['image_ids'], data['offsets'], data['boxes'], data['labels'], data['rad_ids']
+            )
@@ -0,0 +1,187 @@
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+import torch
+
+
+class BatchAugmentation:
+    """Batched ``xray.utils.get_augmentation`` on collated uint8 images, on their device."""
+
+    def __init__(
+        self,
+        prob: float = 0.6,
+        brightness_limit: float = 0.2,
+        contrast_limit: float = 0.2,
+        shift_limit: float = 20,
+        generator: Optional[torch.Generator] = None
+    ):
+        self.prob = prob
+        self.brightness_limit = brightness_limit
+        self.contrast_limit = contrast_limit
+        self.shift_limit = shift_limit
+        self.generator = generator
+
+    def _uniform(self, shape, low, high, device=None):
+        return (low + (high - low) * torch.rand(shape, generator=self.generator)).to(device)
+
+    def _apply_mask(self, batch_size):
+        return torch.rand(batch_size, generator=self.generator) < self.prob
+
+    @staticmethod
+    def histogram(images: List[torch.Tensor]) -> torch.Tensor:
+        """Per-channel 256-bin histograms of ``(C, H, W)`` uint8 images as ``(N, C, 256)``."""
+        if images[0].device.type == 'cpu':
+            # OpenCV's kernels are several times faster than scatter_add on the CPU.
+            return torch.from_numpy(np.stack([
+                [cv2.calcHist([plane], [0], None, [256], [0, 256]).reshape(256) for plane in image.numpy()]
+                for image in images
+            ]).astype(np.int32))
+
+        histogram = torch.zeros(
+            (len(images), images[0].shape[0], 256), dtype=torch.int32, device=images[0].device
+        )
+        for indices in _group_by_shape(images):
+            batch = torch.stack([images[i] for i in indices])
+            flat = batch.flatten(2).long()
+            ones = torch.ones(1, dtype=torch.int32, device=batch.device).expand_as(flat)
+            histogram[indices] = torch.zeros_like(histogram[indices]).scatter_add_(2, flat, ones)
+        return histogram
+
+    @staticmethod
+    def equalize_lut(histogram: torch.Tensor) -> torch.Tensor:
+        """Lookup table of ``cv2.equalizeHist`` for every histogram in ``(..., 256)``."""
+        histogram = histogram.long()
+        cdf = histogram.cumsum(dim=-1)
+        total = cdf[..., -1:]
+        first_value = torch.argmax((histogram > 0).to(torch.uint8), dim=-1, keepdim=True)
+        cdf_min = histogram.gather(-1, first_value)
+        # float32 arithmetic, as in OpenCV, so that ties round the same way.
+        scale = (255 / (total - cdf_min).clamp(min=1).double()).float()
+        lut = torch.round((cdf - cdf_min).float() * scale).clamp_(0, 255)
+        # Constant channels are left untouched.
+        identity = torch.arange(256, device=histogram.device, dtype=lut.dtype).expand_as(lut)
+        return torch.where(total == cdf_min, identity, lut)
+
+    def color_lut(self, images: List[torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Brightness/contrast, equalization and channel shift as one ``(N, C, 256)`` LUT, and the changed samples."""
+        n, c = len(images), images[0].shape[0]
+        device = images[0].device
+        lut = torch.arange(256, dtype=torch.float32, device=device).repeat(n, c, 1)
+
+        contrast = self._apply_mask(n)
+        alpha = self._uniform((n, 1, 1), 1 - self.contrast_limit, 1 + self.contrast_limit, device)
+        beta = self._uniform((n, 1, 1), -self.brightness_limit, self.brightness_limit, device)
+        adjusted = (lut * alpha + beta * 255).clamp_(0, 255).floor_()
+        lut = torch.where(contrast.to(device).view(n, 1, 1), adjusted, lut)
+
+        equalize = self._apply_mask(n)
+        if equalize.any():
+            selected = equalize.nonzero().view(-1)
+            histogram = self.histogram([images[i] for i in selected.tolist()]).to(device)
+            selected = selected.to(device)
+            selected_lut = lut[selected].long()
+            adjusted_histogram = torch.zeros_like(histogram).scatter_add_(2, selected_lut, histogram)
+            lut[selected] = self.equalize_lut(adjusted_histogram).gather(2, selected_lut)
+
+        # RGBShift is only part of the 3-channel pipeline.
+        shift = self._apply_mask(n) & (c == 3)
+        offsets = self._uniform((n, c, 1), -self.shift_limit, self.shift_limit, device)
+        shifted = (lut + offsets).clamp_(0, 255).floor_()
+        lut = torch.where(shift.to(device).view(n, 1, 1), shifted, lut)
+        return lut, contrast | equalize | shift
+
+    @staticmethod
+    def apply_lut(images: List[torch.Tensor], lut: torch.Tensor) -> List[torch.Tensor]:
+        lut = lut.to(device=images[0].device, dtype=torch.uint8)
+        if images[0].device.type == 'cpu':
+            results = []
+            for image, tables in zip(images, lut.numpy()):
+                result = torch.empty_like(image)
+                for plane, table, out in zip(image.numpy(), tables, result.numpy()):
+                    cv2.LUT(plane, table, dst=out)
+                results.append(result)
+            return results
+
+        results = [None] * len(images)
+        for indices in _group_by_shape(images):
+            batch = torch.stack([images[i] for i in indices])
+            mapped = lut[indices].gather(2, batch.flatten(2).long()).view_as(batch)
+            for i, image in zip(indices, mapped.unbind(0)):
+                results[i] = image
+        return results
+
+    def flip_codes(self, batch_size: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Horizontal and vertical flip flags, drawn as ``albumentations.Flip`` does."""
+        apply = self._apply_mask(batch_size)
+        d = torch.randint(0, 3, (batch_size,), generator=self.generator) - 1
+        horizontal = apply & (d != 0)
+        vertical = apply & (d != 1)
+        return horizontal, vertical
+
+    @staticmethod
+    def flip_image(image: torch.Tensor, horizontal: bool, vertical: bool) -> torch.Tensor:
+        dims = [d for d, flip in ((-1, horizontal), (-2, vertical)) if flip]
+        return image.flip(dims) if dims else image
+
+    @staticmethod
+    def flip_boxes(
+        targets: List[Dict[str, torch.Tensor]],
+        sizes: torch.Tensor,
+        horizontal: torch.Tensor,
+        vertical: torch.Tensor
+    ) -> List[Dict[str, torch.Tensor]]:
+        """Flip the boxes of all ``targets`` at once. ``sizes`` holds ``(height, width)`` per image."""
+        counts = [len(t['boxes']) for t in targets]
+        if sum(counts) == 0:
+            return targets
+        boxes = torch.cat([t['boxes'] for t in targets])
+        labels = torch.cat([t['labels'] for t in targets])
+        image_index = torch.repeat_interleave(
+            torch.arange(len(targets), device=boxes.device), torch.tensor(counts, device=boxes.device)
+        )
+        sizes = sizes.to(boxes.device, boxes.dtype)[image_index]
+        flip_x = horizontal.to(boxes.device)[image_index] & (labels != 0)
+        flip_y = vertical.to(boxes.device)[image_index] & (labels != 0)
+
+        flipped = boxes.clone()
+        flipped[:, 0] = torch.where(flip_x, sizes[:, 1] - boxes[:, 2], boxes[:, 0])
+        flipped[:, 2] = torch.where(flip_x, sizes[:, 1] - boxes[:, 0], boxes[:, 2])
+        flipped[:, 1] = torch.where(flip_y, sizes[:, 0] - boxes[:, 3], boxes[:, 1])
+        flipped[:, 3] = torch.where(flip_y, sizes[:, 0] - boxes[:, 1], boxes[:, 3])
+
+        return [
+            dict(target, boxes=target_boxes)
+            for target, target_boxes in zip(targets, flipped.split(counts))
+        ]
+
+    def __call__(
+        self,
+        images: List[torch.Tensor],
+        targets: List[Dict[str, torch.Tensor]]
+    ) -> Tuple[List[torch.Tensor], List[Dict[str, torch.Tensor]]]:
+        images = list(images)
+        horizontal, vertical = self.flip_codes(len(images))
+
+        lut, changed = self.color_lut(images)
+        if changed.any():
+            selected = changed.nonzero().view(-1).tolist()
+            adjusted = self.apply_lut([images[i] for i in selected], lut[selected])
+            for i, image in zip(selected, adjusted):
+                images[i] = image
+
+        images = [
+            self.flip_image(image, h, v)
+            for image, h, v in zip(images, horizontal.tolist(), vertical.tolist())
+        ]
+        sizes = torch.tensor([image.shape[-2:] for image in images])
+        targets = self.flip_boxes(list(targets), sizes, horizontal, vertical)
+        return images, targets
+
+
+def _group_by_shape(images: List[torch.Tensor]) -> List[List[int]]:
+    groups = defaultdict(list)
+    for i, image in enumerate(images):
+        groups[tuple(image.shape)].append(i)
+    return list(groups.values())
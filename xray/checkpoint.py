@@ -0,0 +1,230 @@
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import torch
+
+CHECKPOINT_DIR = 'checkpoints'
+BEST_CHECKPOINT = 'best.pth'
+BEST_MODEL = 'best_model_rcnn.cfg'
+# Written to the checkpoint directory once training wrote its last checkpoint.
+FINISHED = 'finished'
+# Written once the evaluation worker has evaluated every checkpoint.
+EVALUATED = 'evaluated'
+# One line per checkpoint evaluated by the evaluation worker.
+RESULTS_FILE = 'eval_results.jsonl'
+
+
+def to_cpu(value: Any) -> Any:
+    """Copy every tensor in a (nested) state dict to the CPU, so training can go on."""
+    if isinstance(value, torch.Tensor):
+        return value.detach().to('cpu', copy=True)
+    if isinstance(value, dict):
+        return {k: to_cpu(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(to_cpu(v) for v in value)
+    return value
+
+
+def rng_state() -> dict:
+    # The numpy key array is stored as a tensor, so checkpoints only hold plain types.
+    name, keys, position, has_gauss, cached_gaussian = np.random.get_state()
+    state = dict(
+        python=random.getstate(),
+        numpy=(name, torch.from_numpy(keys.astype(np.int64)), position, has_gauss, cached_gaussian),
+        torch=torch.get_rng_state()
+    )
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state: dict):
+    random.setstate(state['python'])
+    name, keys, position, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, keys.numpy().astype(np.uint32), position, has_gauss, cached_gaussian))
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class CheckpointManager:
+    """Writes the checkpoints of a run to ``<run folder>/checkpoints`` from a background thread."""
+
+    def __init__(
+        self,
+        folder: str,
+        keep_last: int = 3,
+        logger: Optional[logging.Logger] = None,
+        keep_unevaluated: bool = False
+    ):
+        self.folder = folder
+        self.directory = os.path.join(folder, CHECKPOINT_DIR)
+        os.makedirs(self.directory, exist_ok=True)
+        for marker in [FINISHED, EVALUATED]:
+            if os.path.exists(os.path.join(self.directory, marker)):
+                # Left over from the run that is resumed.
+                os.remove(os.path.join(self.directory, marker))
+        self.keep_last = keep_last
+        self.keep_unevaluated = keep_unevaluated
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def snapshot(
+        model: torch.nn.Module,
+        optimizer: torch.optim.Optimizer,
+        lr_scheduler,
+        scaler=None,
+        losses=None,
+        **extra
+    ) -> Dict[str, Any]:
+        return dict(
+            model=to_cpu(model.state_dict()),
+            optimizer=to_cpu(optimizer.state_dict()),
+            lr_scheduler=lr_scheduler.state_dict(),
+            scaler=scaler.state_dict() if scaler is not None else None,
+            losses=to_cpu(losses.state_dict()) if losses is not None else None,
+            rng=rng_state(),
+            **extra
+        )
+
+    def save(self, state: Dict[str, Any], epoch: int, is_best: bool = False):
+        self._queue.put((state, epoch, is_best))
+
+    def wait(self):
+        """Block until every handed over checkpoint is on disk."""
+        self._queue.join()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def checkpoints(self) -> List[str]:
+        """Epoch checkpoints on disk, oldest first."""
+        return list_checkpoints(self.directory)
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as e:
+                self.logger.exception(f'Writing checkpoint failed with exception {e}')
+            finally:
+                self._queue.task_done()
+
+    def _write(self, state: Dict[str, Any], epoch: int, is_best: bool):
+        path = os.path.join(self.directory, f'epoch_{epoch:04d}.pth')
+        _atomic_save(state, path)
+        if is_best:
+            save_best(self.folder, state)
+        old_paths = self.checkpoints()[:-self.keep_last or None]
+        if self.keep_unevaluated:
+            evaluated = set(result['checkpoint'] for result in read_results(self.folder))
+            old_paths = [path for path in old_paths if os.path.basename(path) in evaluated]
+        for old_path in old_paths:
+            os.remove(old_path)
+        self.logger.info(f'Saved checkpoint {path}')
+
+
+def _atomic_save(obj: Any, path: str):
+    torch.save(obj, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def save_best(folder: str, state: Dict[str, Any]):
+    """Keep ``state`` as ``best.pth`` and its model weights as ``best_model_rcnn.cfg`` of the run."""
+    _atomic_save(state, os.path.join(folder, CHECKPOINT_DIR, BEST_CHECKPOINT))
+    _atomic_save(state['model'], os.path.join(folder, BEST_MODEL))
+
+
+def list_checkpoints(directory: str) -> List[str]:
+    """Epoch checkpoints in ``directory``, oldest first."""
+    return [
+        os.path.join(directory, name) for name in sorted(os.listdir(directory))
+        if re.fullmatch(r'epoch_\d+\.pth', name)
+    ]
+
+
+def read_results(folder: str) -> List[dict]:
+    """The evaluations of the evaluation worker so far, one per checkpoint, in evaluation order."""
+    path = os.path.join(folder, CHECKPOINT_DIR, RESULTS_FILE)
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def mark_finished(folder: str):
+    open(os.path.join(folder, CHECKPOINT_DIR, FINISHED), 'w').close()
+
+
+def is_finished(folder: str) -> bool:
+    return os.path.exists(os.path.join(folder, CHECKPOINT_DIR, FINISHED))
+
+
+def mark_evaluated(folder: str):
+    open(os.path.join(folder, CHECKPOINT_DIR, EVALUATED), 'w').close()
+
+
+def is_evaluated(folder: str) -> bool:
+    return os.path.exists(os.path.join(folder, CHECKPOINT_DIR, EVALUATED))
+
+
+def resolve_checkpoint(path: str) -> str:
+    """``path`` itself if it is a file, else the latest epoch checkpoint of the run folder."""
+    if os.path.isfile(path):
+        return path
+    directory = os.path.join(path, CHECKPOINT_DIR) if os.path.isdir(os.path.join(path, CHECKPOINT_DIR)) else path
+    checkpoints = list_checkpoints(directory)
+    if not checkpoints:
+        raise FileNotFoundError(f'No checkpoint found in {path}')
+    return checkpoints[-1]
+
+
+def run_folder(path: str) -> str:
+    """The run folder that the checkpoint resolved from ``path`` belongs to."""
+    return os.path.dirname(os.path.dirname(os.path.abspath(resolve_checkpoint(path))))
+
+
+def load_checkpoint(
+    path: str,
+    model: torch.nn.Module,
+    optimizer: Optional[torch.optim.Optimizer] = None,
+    lr_scheduler=None,
+    scaler=None,
+    losses=None,
+    restore_rng: bool = True
+) -> Dict[str, Any]:
+    """Restore all states saved by :meth:`CheckpointManager.snapshot` and return the checkpoint."""
+    state = torch.load(path, map_location='cpu')
+    model.load_state_dict(state['model'])
+    if optimizer is not None:
+        optimizer.load_state_dict(state['optimizer'])
+    if lr_scheduler is not None:
+        lr_scheduler.load_state_dict(state['lr_scheduler'])
+    if scaler is not None and state.get('scaler') is not None:
+        scaler.load_state_dict(state['scaler'])
+    if losses is not None and state.get('losses') is not None:
+        losses.load_state_dict(state['losses'])
+    if restore_rng:
+        set_rng_state(state['rng'])
+    return state
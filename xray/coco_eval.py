@@ -128,7 +128,7 @@ class VinBigDataEval:
             for j, pred in enumerate(preds):
                 results.append({
                     "id": k,
-                    "image_id": int(np.where(image_ids == image_id)[0]),
+                    "image_id": int(np.where(image_ids == image_id)[0][0]),
                     "category_id": int(pred[0]),
                     "bbox": np.array([
                         pred[2], pred[3], pred[4], pred[5]
@@ -1,93 +1,406 @@
 # main bulk of the processing code taken from https://www.kaggle.com/bjoernholzhauer/eda-dicom-reading-vinbigdata-chest-x-ray
 
 import argparse
-import functools
+import concurrent.futures
+import contextlib
+import hashlib
+import itertools
+import json
+import logging
 import os
+import time
+import tracemalloc
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
 from pydicom.pixel_data_handlers.util import apply_voi_lut
-import albumentations
+import cv2
 import pydicom
 import warnings
 
-from fastcore.parallel import parallel
-import shelve
-import re
 import pandas as pd
 import numpy as np
+from tqdm import tqdm
+
+from xray.annotations import AnnotationIndex
+from xray.image_store import ImageStoreWriter, image_store_dir
+
+PYRAMID_SIZES = (1024, 768, 512, 384)
 
 # Using function from another great notebook: https://www.kaggle.com/raddar/convert-dicom-to-np-array-the-correct-way
-def read_xray(path, voi_lut=True, fix_monochrome=True):
-    dicom = pydicom.read_file(path)
+def decode_xray(
+    path: str,
+    max_size: Optional[int] = None,
+    shape: Optional[Tuple[int, int]] = None,
+    voi_lut: bool = True,
+    fix_monochrome: bool = True,
+    timings: Optional[dict] = None
+) -> Tuple[np.ndarray, Tuple[int, int]]:
+    """Decode a DICOM into a resized 2D uint8 image, returned with its original shape."""
+    timings = timings if timings is not None else {}
+    start = time.perf_counter()
+    dicom = pydicom.dcmread(path)
+    data = dicom.pixel_array
+    timings['read'] = time.perf_counter() - start
 
+    start = time.perf_counter()
+    # depending on this value, X-ray may look inverted - fix that. A negative rescale slope
+    # inverts it as well, intercept and a positive slope are removed by the min-max scaling.
+    invert = fix_monochrome and dicom.get('PhotometricInterpretation') == 'MONOCHROME1'
+    invert ^= float(dicom.get('RescaleSlope', 1.0)) < 0
     # VOI LUT (if available by DICOM device) is used to transform raw DICOM data to "human-friendly" view
-    with warnings.catch_warnings():
-        warnings.simplefilter('ignore')
-        if voi_lut:
+    voi_lut = voi_lut and ('WindowCenter' in dicom or 'VOILUTSequence' in dicom)
+    if data.dtype.kind in 'ui' and data.dtype.itemsize <= 2:
+        image = _normalize_with_table(data, dicom if voi_lut else None, invert)
+    else:
+        image = _normalize_float(data, dicom if voi_lut else None, invert)
+    timings['normalize'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    original_shape = image.shape
+    image = resize_image(image, max_size, shape)
+    timings['resize'] = time.perf_counter() - start
+    return image, original_shape
+
+
+def resize_image(
+    image: np.ndarray, max_size: Optional[int] = None, shape: Optional[Tuple[int, int]] = None
+) -> np.ndarray:
+    """Resize so that the smallest side is ``max_size`` (as ``SmallestMaxSize``) or to ``shape``."""
+    if max_size is not None:
+        scale = max_size / min(image.shape[:2])
+        shape = tuple(int(round(dim * scale)) for dim in image.shape[:2])
+    if shape is None or tuple(shape) == image.shape[:2]:
+        return image
+    downscale = shape[0] < image.shape[0] and shape[1] < image.shape[1]
+    return cv2.resize(
+        image, (shape[1], shape[0]), interpolation=cv2.INTER_AREA if downscale else cv2.INTER_LINEAR
+    )
+
+
+def _row_blocks(data: np.ndarray, pixels: int = 1 << 20):
+    rows = max(1, pixels // max(1, data.shape[1]))
+    for start in range(0, data.shape[0], rows):
+        yield slice(start, start + rows)
 
-            data = apply_voi_lut(dicom.pixel_array, dicom)
-        else:
-            data = dicom.pixel_array
 
-    # depending on this value, X-ray may look inverted - fix that:
-    if "PhotometricInterpretation" in dicom and dicom.PhotometricInterpretation == "MONOCHROME1":
-        data = np.amax(data) - data
+def _normalize_with_table(data: np.ndarray, dicom=None, invert: bool = False) -> np.ndarray:
+    # Pixel values are addressed by their unsigned bit pattern, so signed data works the same.
+    index_type = np.uint8 if data.dtype.itemsize == 1 else np.uint16
+    bits = data.view(index_type)
+    counts = np.zeros(np.iinfo(index_type).max + 1, dtype=np.int64)
+    for rows in _row_blocks(bits):
+        counts += np.bincount(bits[rows].ravel(), minlength=len(counts))
 
-    intercept = dicom.RescaleIntercept if "RescaleIntercept" in dicom else 0.0
-    slope = dicom.RescaleSlope if "RescaleSlope" in dicom else 1.0
+    values = np.arange(len(counts), dtype=index_type).view(data.dtype)
+    if dicom is not None:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            values = apply_voi_lut(values, dicom)
+    values = values.astype(np.float64)
 
-    if slope != 1:
-        data = slope * data.astype(np.float64)
-        data = data.astype(np.int16)
+    present = values[counts > 0]
+    low, high = present.min(), present.max()
+    table = (high - values if invert else values - low) / max(high - low, 1e-12) * 255
+    table = np.clip(table, 0, 255).astype(np.uint8)
 
-    data += np.int16(intercept)
+    image = np.empty(data.shape, dtype=np.uint8)
+    for rows in _row_blocks(bits):
+        np.take(table, bits[rows], out=image[rows])
+    return image
+
+
+def _normalize_float(data: np.ndarray, dicom=None, invert: bool = False) -> np.ndarray:
+    if dicom is not None:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            data = apply_voi_lut(data, dicom)
+    data = data.astype(np.float32)
+    low, high = data.min(), data.max()
+    if invert:
+        np.subtract(high, data, out=data)
+    else:
+        data -= low
+    data /= max(high - low, 1e-12)
+    data *= 255
+    return data.astype(np.uint8)
 
-    data = data - np.min(data)
-    data = data / np.max(data)
-    data = (data * 255).astype(np.uint8)
-    data = np.stack([data] * 3).transpose(1, 2, 0)
 
-    return data
+def load_annotations(directory: str, image_ids: List[str]) -> AnnotationIndex:
+    """Read ``train.csv`` once and group its rows per image."""
+    train = pd.read_csv(os.path.join(directory, 'train.csv'))
+    train = train.fillna({'x_min': 0, 'y_min': 0, 'x_max': 1, 'y_max': 1})
+    train[['x_min', 'y_min', 'x_max', 'y_max']] = train[['x_min', 'y_min', 'x_max', 'y_max']].astype(np.int16)
+    return AnnotationIndex.from_frame(train, image_ids)
 
 
-# This function will read a .dicom file, turn the smallest side to 600 pixels, and then save the additional annotations together with the image into a dictionary
-def get_and_save(x, directory: str, mode: str = 'train', max_size: int=1024):
-    idx = x[0]
+# This function will read a .dicom file, turn the smallest side to max_size pixels, and then save the additional annotations together with the image into a dictionary
+def get_and_save(
+    x,
+    directory: str,
+    mode: str = 'train',
+    max_size: int = 1024,
+    annotations: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None,
+    voi_lut: bool = True,
+    fix_monochrome: bool = True,
+    timings: Optional[dict] = None
+):
+    """Decode and resize a single image, scaling its ``annotations`` (read from ``train.csv`` if missing)."""
+    return get_pyramid(
+        x, directory, mode, (max_size,), annotations, voi_lut, fix_monochrome, timings
+    )[max_size]
+
+
+def get_pyramid(
+    x,
+    directory: str,
+    mode: str = 'train',
+    sizes: Sequence[int] = PYRAMID_SIZES,
+    annotations: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None,
+    voi_lut: bool = True,
+    fix_monochrome: bool = True,
+    timings: Optional[dict] = None
+) -> Dict[int, dict]:
+    """Decode an image once and return a ``get_and_save`` entry for each of ``sizes``."""
+    if mode not in ['train', 'test']:
+        raise KeyError(f'Mode needs to be one of [train, test], {mode} was given ')
     image_id = x[1]
+    timings = timings if timings is not None else {}
 
-    transform = albumentations.Compose(
-        [albumentations.SmallestMaxSize(max_size=max_size, always_apply=True)],
-        bbox_params=albumentations.BboxParams(format='pascal_voc')
+    img, original_shape = decode_xray(
+        path=source_path(directory, mode, image_id),
+        voi_lut=voi_lut,
+        fix_monochrome=fix_monochrome,
+        timings=timings
     )
-    img = read_xray(path=os.path.join(directory, mode, image_id + '.dicom'))
     if mode == 'train':
-        train = pd.read_csv(os.path.join(directory, 'train.csv'))
-        rad_id = np.array([int(re.findall(r'\d+', rad_id)[0]) for rad_id in
-                           train.loc[train['image_id'] == image_id, 'rad_id'].values], dtype=np.int8)
-        class_labels = train.loc[train['image_id'] == image_id, 'class_id'].values
-        bboxes = [list(row) for rowid, row in train.loc[
-            train['image_id'] == image_id, ['x_min', 'y_min', 'x_max', 'y_max', 'class_id']].fillna(
-            {'x_min': 0, 'y_min': 0, 'x_max': 1, 'y_max': 1}).astype(np.int16).iterrows()]
-        transformed = transform(image=img,
-                                bboxes=bboxes,
-                                class_labels=class_labels)
-        return dict(image_id=image_id,
-                    image=transformed['image'][:, :, 0],
-                    rad_id=rad_id,
-                    bboxes=np.array(transformed['bboxes'], dtype=np.float32),
-                    class_labels=transformed['class_labels'].astype(np.int8))
-    elif mode == 'test':
-        transformed = transform(
-            image=img,
-            bboxes=[],
-            class_labels=np.array([])
+        if annotations is None:
+            annotations = load_annotations(directory, [image_id]).slice(0)
+        boxes, class_labels, rad_id = annotations
+    else:
+        boxes = np.zeros((0, 4), dtype=np.float32)
+        class_labels = np.zeros(0, dtype=np.int8)
+        rad_id = np.array([])
+
+    start = time.perf_counter()
+    levels = {}
+    for size in sizes:
+        level = resize_image(img, size)
+        height, width = level.shape
+        scale = np.array([width, height, width, height]) / np.array(original_shape[::-1] * 2)
+        level_boxes = np.clip(boxes * scale, 0, [width, height, width, height]).astype(np.float32)
+        levels[size] = dict(image_id=image_id,
+                            image=level,
+                            original_shape=original_shape,
+                            rad_id=rad_id,
+                            bboxes=np.concatenate(
+                                [level_boxes, class_labels[:, None].astype(np.float32)], axis=1
+                            ),
+                            class_labels=class_labels.astype(np.int8))
+    timings['resize'] = time.perf_counter() - start
+    return levels
+
+
+def source_path(directory: str, mode: str, image_id: str) -> str:
+    return os.path.join(directory, mode, image_id + '.dicom')
+
+
+def source_signature(path: str, with_hash: bool = True) -> dict:
+    stat = os.stat(path)
+    signature = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+    if with_hash:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(chunk)
+        signature['sha1'] = sha1.hexdigest()
+    return signature
+
+
+class PreprocessingManifest:
+    """Append-only JSON-lines record of the source DICOMs in the image store; the last line of an image wins."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A torn last line from an interrupted run.
+                        continue
+                    self.entries[self.key(entry)] = entry
+
+    @staticmethod
+    def key(entry: dict):
+        # Every store level of an image has its own entry.
+        return entry['image_id'], entry['params']['max_size']
+
+    def is_current(self, image_id: str, path: str, params: dict) -> bool:
+        entry = self.entries.get((image_id, params['max_size']))
+        if entry is None or entry['status'] != 'done' or entry['params'] != params:
+            return False
+        signature = source_signature(path, with_hash=False)
+        if signature['size'] != entry['size']:
+            return False
+        if signature['mtime'] == entry['mtime']:
+            return True
+        # Touched but possibly unchanged (e.g. copied), compare the content.
+        signature = source_signature(path)
+        if signature['sha1'] != entry['sha1']:
+            return False
+        self.record([dict(entry, mtime=signature['mtime'])])
+        return True
+
+    def record(self, entries: List[dict]):
+        if not entries:
+            return
+        with open(self.path, 'a') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        for entry in entries:
+            self.entries[self.key(entry)] = entry
+
+
+def process_image(x, directory: str, mode: str, profile: bool = False, **kwargs):
+    """Worker task: ``get_pyramid`` plus the source signature, failures are returned."""
+    image_id = x[1]
+    timings = {}
+    if profile:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        signature = source_signature(source_path(directory, mode, image_id))
+        status = dict(signature, image_id=image_id, status='done')
+        entry = get_pyramid(x, directory=directory, mode=mode, timings=timings, **kwargs)
+    except Exception as e:
+        status, entry = dict(image_id=image_id, status='failed', error=repr(e)), None
+    if profile:
+        status['profile'] = dict(
+            timings,
+            total=time.perf_counter() - start,
+            peak_memory_mb=tracemalloc.get_traced_memory()[1] / 2 ** 20
+        )
+        tracemalloc.stop()
+    return status, entry
+
+
+def write_entry(writer: ImageStoreWriter, entry: dict):
+    writer.add(
+        entry['image_id'],
+        entry['image'],
+        boxes=entry['bboxes'].reshape(-1, 5)[:, :4],
+        labels=entry['class_labels'],
+        rad_ids=entry['rad_id'],
+        original_shape=entry['original_shape']
+    )
+
+
+def preprocess_images(
+    image_ids: List[str],
+    writer: Union[ImageStoreWriter, Dict[int, ImageStoreWriter]],
+    directory: str,
+    mode: str = 'train',
+    max_size: int = 1024,
+    n_workers: int = 8,
+    max_in_flight: Optional[int] = None,
+    manifest: Optional[PreprocessingManifest] = None,
+    voi_lut: bool = True,
+    fix_monochrome: bool = True,
+    checkpoint_every: int = 100,
+    report_path: Optional[str] = None,
+    logger: Optional[logging.Logger] = None
+):
+    """Decode ``image_ids`` in a process pool and stream the results into ``writer``."""
+    logger = logger if logger is not None else logging.getLogger(__name__)
+    writers = writer if isinstance(writer, dict) else {max_size: writer}
+    sizes = sorted(writers, reverse=True)
+
+    def params(size):
+        return dict(max_size=size, voi_lut=voi_lut, fix_monochrome=fix_monochrome)
+
+    # The levels each image still needs; all of them without a manifest.
+    levels = {}
+    for image_id in image_ids:
+        levels[image_id] = sizes if manifest is None else [
+            size for size in sizes
+            if image_id not in writers[size]
+            or not manifest.is_current(image_id, source_path(directory, mode, image_id), params(size))
+        ]
+    image_ids = [image_id for image_id in image_ids if levels[image_id]]
+    logger.info(f'Preprocessing {len(image_ids)} images')
+
+    annotations = load_annotations(directory, image_ids) if mode == 'train' else None
+    pending = []
+    report = []
+
+    def task_kwargs(position):
+        return dict(
+            x=(position, image_ids[position]),
+            directory=directory,
+            mode=mode,
+            annotations=annotations.slice(position) if annotations is not None else None,
+            sizes=levels[image_ids[position]],
+            voi_lut=voi_lut,
+            fix_monochrome=fix_monochrome,
+            profile=report_path is not None
         )
-        return dict(image_id=image_id,
-                    image=transformed['image'][:, :, 0],
-                    rad_id=np.array([]),
-                    bboxes=np.array(transformed['bboxes'], dtype=np.float32),
-                    class_labels=transformed['class_labels'].astype(np.int8))
+
+    def checkpoint():
+        for level_writer in writers.values():
+            level_writer.flush()
+        if manifest is not None:
+            manifest.record(list(itertools.chain.from_iterable(pending)))
+        pending.clear()
+
+    def handle(result):
+        status, entry = result
+        profile = status.pop('profile', None)
+        if profile is not None:
+            report.append(dict(image_id=status['image_id'], **profile))
+        if entry is not None:
+            for size, level_entry in entry.items():
+                write_entry(writers[size], level_entry)
+        else:
+            logger.warning(f'Preprocessing of {status["image_id"]} failed: {status["error"]}')
+        pending.append([dict(status, params=params(size)) for size in levels[status['image_id']]])
+        if len(pending) >= checkpoint_every:
+            checkpoint()
+        progress.update()
+
+    progress = tqdm(total=len(image_ids))
+    if n_workers <= 0:
+        for position in range(len(image_ids)):
+            handle(process_image(**task_kwargs(position)))
     else:
-        KeyError(f'Mode needs to be one of [train, test], {mode} was given ')
+        max_in_flight = max_in_flight or 2 * n_workers
+        positions = iter(range(len(image_ids)))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+            in_flight = set()
+            for position in itertools.islice(positions, max_in_flight):
+                in_flight.add(executor.submit(process_image, **task_kwargs(position)))
+
+            while in_flight:
+                done, in_flight = concurrent.futures.wait(
+                    in_flight, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    handle(future.result())
+                for position in itertools.islice(positions, len(done)):
+                    in_flight.add(executor.submit(process_image, **task_kwargs(position)))
+    checkpoint()
+    progress.close()
 
+    if report_path is not None and report:
+        report = pd.DataFrame(report)
+        report.to_csv(report_path, index=False)
+        logger.info(
+            f'Decode report written to {report_path}: median {report["total"].median():.3f}s per '
+            f'image, max peak memory {report["peak_memory_mb"].max():.1f} MB'
+        )
 
 
 if __name__ == '__main__':
@@ -96,24 +409,39 @@ if __name__ == '__main__':
     parser.add_argument('--n-workers', default=8, type=int)
     parser.add_argument('--data-path', default='../data/chest_xray/')
     parser.add_argument('--data-path-output', default='../data/chest_xray/')
+    parser.add_argument(
+        '--max-size', default=list(PYRAMID_SIZES), type=int, nargs='+',
+        help='Smallest side of each store level, all written from one decode'
+    )
+    parser.add_argument('--no-voi-lut', action='store_true')
+    parser.add_argument('--no-fix-monochrome', action='store_true')
+    parser.add_argument('--checkpoint-every', default=100, type=int)
+    parser.add_argument('--report', default=None, help='CSV with per-image decode timings and peak memory')
 
     parser.add_argument('--mode', default='train')
     cfg = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
 
     data_dir = os.path.join(cfg.data_path, cfg.mode)
     list_of_images = [f.split('.')[0] for f in os.listdir(data_dir) if f.endswith('dicom')]
 
-    out1 = parallel(
-        functools.partial(get_and_save, directory=cfg.data_path, mode=cfg.mode ),
-        [(idx, image_id) for idx, image_id in enumerate(list_of_images)],
-        n_workers=cfg.n_workers,
-        progress=True
-    )
-
-    with shelve.open(os.path.join(cfg.data_path_output, f'{cfg.mode}_data.db')) as myshelf:
-        myshelf.update( { dictentry['image_id']: {'image': dictentry['image'],
-                                                  'rad_id': dictentry['rad_id'],
-                                                  'bboxes': dictentry['bboxes'],
-                                                  'class_labels': dictentry['class_labels'] }  for dictentry in out1 } )
-
-
+    # One manifest for all levels, so runs with other --max-size only decode the missing ones.
+    manifest_path = os.path.join(cfg.data_path_output, f'{cfg.mode}_store', 'manifest.jsonl')
+    with contextlib.ExitStack() as stack:
+        writers = {
+            size: stack.enter_context(
+                ImageStoreWriter(image_store_dir(cfg.data_path_output, cfg.mode, size), append=True)
+            ) for size in cfg.max_size
+        }
+        preprocess_images(
+            list_of_images,
+            writers,
+            directory=cfg.data_path,
+            mode=cfg.mode,
+            n_workers=cfg.n_workers,
+            manifest=PreprocessingManifest(manifest_path),
+            voi_lut=not cfg.no_voi_lut,
+            fix_monochrome=not cfg.no_fix_monochrome,
+            checkpoint_every=cfg.checkpoint_every,
+            report_path=cfg.report
+        )
@@ -7,62 +7,80 @@ from typing import Optional
 
 from PIL import Image
 
+import xray.profiler
 import xray.utils
+from xray.annotations import AnnotationIndex
+from xray.data_preprocessing import decode_xray, resize_image
+from xray.dataset_manifest import DatasetManifest
+from xray.image_store import ImageStore, image_store_dir, select_size
 
 import numpy as np
 import pandas as pd
-import pydicom
 import torch
 import torchvision
 
 
 class XRayDataset:
     def __init__(
-        self, mode: str = 'train', data_dir: str = '../data/chest_xray/', split=0.8):
+        self,
+        mode: str = 'train',
+        data_dir: str = '../data/chest_xray/',
+        split=0.8,
+        manifest: Optional[DatasetManifest] = None,
+        image_size: int = 400
+    ):
         self.mode = mode
+        self.image_size = image_size
 
         self.mode_dir = os.path.join(data_dir, self.mode if mode != 'eval' else 'train')
 
-        self.available_files = [
-            f.split('.')[0] for f in os.listdir(self.mode_dir) if f.endswith('dicom')
-        ]
+        if manifest is not None:
+            self.available_files = manifest.ids(mode)
+        else:
+            self.available_files = [
+                f.split('.')[0] for f in os.listdir(self.mode_dir) if f.endswith('dicom')
+            ]
 
-        if self.mode == 'train':
-            self.available_files = self.available_files[:int(split * len(self.available_files))]
-        elif self.mode == 'eval':
-            self.available_files = self.available_files[int((1 -split) * len(self.available_files)):]
+            if self.mode == 'train':
+                self.available_files = self.available_files[:int(split * len(self.available_files))]
+            elif self.mode == 'eval':
+                self.available_files = self.available_files[int((1 -split) * len(self.available_files)):]
 
         self.logger = logging.getLogger(__name__)
         if self.mode != 'test':
             self.data_desc = pd.read_csv(os.path.join(data_dir, 'train.csv'))
+            self.annotations = AnnotationIndex.from_frame(self.data_desc, self.available_files)
+            self.class_names = dict(
+                self.data_desc[['class_id', 'class_name']].drop_duplicates().values.tolist()
+            )
+        # Images are decoded straight to image_size x image_size uint8 by decode_xray.
         self.transform = torchvision.transforms.Compose([
-            torchvision.transforms.ToPILImage(),
-            torchvision.transforms.Resize((400,400)),
             torchvision.transforms.ToTensor(),
             ZeroToOneTransform()
         ])
 
 
     def __getitem__(self, item, max_bboxes: int = 16):
-        image = pydicom.read_file(os.path.join(self.mode_dir, self.available_files[item] + '.dicom'))
+        image, original_shape = decode_xray(
+            os.path.join(self.mode_dir, self.available_files[item] + '.dicom'),
+            shape=(self.image_size, self.image_size),
+            voi_lut=False,
+            fix_monochrome=False
+        )
         if self.mode == 'test':
-            return self.transform(image.pixel_array.copy().astype('float32'))
-        file_description = self.data_desc.loc[self.data_desc.image_id == self.available_files[item]]
+            return self.transform(image)
+        boxes, class_ids, _ = self.annotations.slice(item)
 
         # TODO: Do IoU for the bboxes and make some mean for shared boxes > than lets say 0.4
-        class_names, bboxes, labels = [], [], []
-        for _, row in file_description.iterrows():
-            if not np.isnan(row.x_max):
-
-                bboxes.append((row.x_min, row.y_min, row.x_max, row.y_max))
-                labels.append(row.class_id + 1)
-                class_names.append(row.class_name)
-        bboxes, labels = tuple(map(torch.Tensor, [bboxes, labels]))
+        has_box = ~np.isnan(boxes[:, 2])
+        class_names = [self.class_names[class_id] for class_id in class_ids[has_box].tolist()]
+        bboxes = torch.from_numpy(boxes[has_box])
+        labels = torch.from_numpy(class_ids[has_box].astype(np.float32) + 1)
 
         assert len(bboxes) == len(labels) == len(class_names)
 
         bboxes_resized = torch.Tensor(
-            list(map(lambda x: xray.utils.resize_bbox(x, image.pixel_array.shape, (400, 400)), bboxes))
+            list(map(lambda x: xray.utils.resize_bbox(x, original_shape, (self.image_size, self.image_size)), bboxes))
         )
         bboxes_resized, labels = xray.utils.filter_radiologist_findings(bboxes_resized, labels)
 
@@ -72,7 +90,7 @@ class XRayDataset:
             'file_name': self.available_files[item],
             'class_names': class_names
         }
-        image_transformed = self.transform(image.pixel_array.copy().astype('float32'))
+        image_transformed = self.transform(image)
         return image_transformed, target
 
 
@@ -92,24 +110,28 @@ class XRAYShelveLoad:
         mode = 'train',
         data_dir = '../data/chest_xray/',
         database_dir = '../data/chest_xray/',
-        split = 0.8
+        split = 0.8,
+        manifest: Optional[DatasetManifest] = None
     ):
         if mode not in ['train', 'test', 'eval']:
             raise KeyError('Mode needs to be in [train, test, eval]')
         self.transform = xray.utils.get_augmentation(prob= 0.8 if mode == 'train' else 0)
 
-        self.available_files = [
-            f.split('.')[0] for f in os.listdir(
-                os.path.join(data_dir, 'test' if mode == 'test' else 'train')
-            ) if f.endswith('dicom')
-        ]
+        if manifest is not None:
+            self.available_files = manifest.ids(mode)
+        else:
+            self.available_files = [
+                f.split('.')[0] for f in os.listdir(
+                    os.path.join(data_dir, 'test' if mode == 'test' else 'train')
+                ) if f.endswith('dicom')
+            ]
         if mode in ['train', 'eval']:
             self.database = shelve.open(
                 os.path.join(database_dir, 'train_data.db'), flag='r', writeback=False
             )
-            if mode == 'train':
+            if manifest is None and mode == 'train':
                 self.available_files = self.available_files[: int(len(self.available_files) * split)]
-            else:
+            elif manifest is None:
                 self.available_files = self.available_files[int(len(self.available_files) * split):]
 
         else:
@@ -131,8 +153,9 @@ class XRAYShelveLoad:
             rad_id=item_data['rad_id'],
             image_name=self.available_files[item]
         )
-        image_transformed['image'] = np.transpose(image_transformed['image'], axes=(2,0,1))/255
-        image_transformed['image'] = torch.from_numpy(image_transformed['image']).float()
+        image_transformed['image'] = torch.from_numpy(
+            np.ascontiguousarray(np.transpose(image_transformed['image'], axes=(2,0,1)))
+        )
 
         labels = torch.Tensor([box[4] for box in image_transformed['bboxes']]).long()
         if labels.size()[0] == 0:
@@ -166,24 +189,46 @@ class VinBigDataset:
         data_dir = '../data/',
         split = 0.8,
         new_images_shape = (1024,1024),
-        logger: Optional[logging.Logger] = None
+        logger: Optional[logging.Logger] = None,
+        augmentation: str = 'sample',
+        channels: int = 3,
+        manifest: Optional[DatasetManifest] = None,
+        profile: bool = False
     ):
         if mode not in ['train', 'test', 'eval']:
             raise KeyError('Mode needs to be in [train, test, eval]')
-        self.transform = xray.utils.get_augmentation(prob= 0.6 if mode == 'train' else 0)
+        if augmentation not in ['sample', 'batch']:
+            raise KeyError('Augmentation needs to be in [sample, batch]')
+        # Stage times of every sample are added to its target, see xray.profiler.SampleTimer.
+        self.profile = profile
+        # Images are returned as uint8 tensors and scaled on the device by
+        # xray.utils.images_to_device. With 'batch' they are returned unaugmented and
+        # xray.batch_augmentation.BatchAugmentation is applied after collation.
+        self.augmentation = augmentation
+        if channels not in [1, 3]:
+            raise KeyError('Channels need to be in [1, 3]')
+        # With a single channel the grayscale image is never replicated.
+        self.channels = channels
+        self.transform = xray.utils.get_augmentation(
+            prob= 0.6 if mode == 'train' and augmentation == 'sample' else 0, channels=channels
+        )
         self.data_directory = os.path.join(data_dir, 'test' if mode == 'test' else 'train')
-        self.available_files = [
-            f.split('.')[0] for f in os.listdir(self.data_directory) if f.endswith('png')
-        ]
         self.mode = mode
+        if manifest is not None:
+            self.available_files = manifest.ids(mode)
+        else:
+            self.available_files = [
+                f.split('.')[0] for f in os.listdir(self.data_directory) if f.endswith('png')
+            ]
 
-        if mode == 'train':
-            self.available_files = self.available_files[: int(len(self.available_files) * split)]
-        elif mode == 'eval':
-            self.available_files = self.available_files[int(len(self.available_files) * split):]
+            if mode == 'train':
+                self.available_files = self.available_files[: int(len(self.available_files) * split)]
+            elif mode == 'eval':
+                self.available_files = self.available_files[int(len(self.available_files) * split):]
 
         self.length = len(self.available_files)
         self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.new_images_shape = new_images_shape
 
 
         if self.mode != 'test':
@@ -201,6 +246,9 @@ class VinBigDataset:
                                                  new_images_shape[1]/self.data_desc['height'].values.reshape(-1,1)
 
             self.data_desc.loc[self.data_desc["class_id"] == 0, ['x_max', 'y_max']] = 1.0
+            self.annotations = AnnotationIndex.from_frame(self.data_desc, self.available_files)
+        elif manifest is not None and (manifest.sizes(mode)[['height', 'width']].values >= 0).all():
+            self.data_desc = manifest.sizes(mode)
         else:
             self.data_desc = pd.read_csv(os.path.join(data_dir, 'test.csv'))
 
@@ -208,74 +256,221 @@ class VinBigDataset:
     def __len__(self):
         return self.length
 
+    def aspect_ratios(self) -> np.ndarray:
+        """``width / height`` of every image; the pngs are all resized to ``new_images_shape``."""
+        return np.full(self.length, self.new_images_shape[0] / self.new_images_shape[1])
+
     def __getitem__(self, item):
-        image = Image.open(os.path.join(self.data_directory, self.available_files[item]) + '.png')
-        image_array = np.array(image)
-        if self.mode != 'test':
-            image_data_desc = self.data_desc.loc[
-                self.data_desc['image_id'] == self.available_files[item]
-            ]
-            class_labels = image_data_desc.class_id.values
-            bboxes = image_data_desc[['x_min', 'y_min', 'x_max', 'y_max', 'class_id']].values
+        timer = xray.profiler.SampleTimer(self.profile)
+        with timer('decode'):
+            image = Image.open(os.path.join(self.data_directory, self.available_files[item]) + '.png')
+            # The boxes are scaled to new_images_shape (width, height), whatever size the pngs have.
+            image_array = resize_image(np.array(image), shape=self.new_images_shape[::-1])
+        with timer('annotations'):
+            if self.mode != 'test':
+                boxes, class_labels, rad_id = self.annotations.slice(item)
+                bboxes = np.concatenate([boxes, class_labels[:, None].astype(np.float32)], axis=1)
+            else:
+                bboxes = []
+                class_labels = []
+                rad_id = []
 
-            rad_id = image_data_desc.rad_id
-        else:
-            bboxes = []
-            class_labels = []
-            rad_id = []
+        if self.augmentation == 'batch':
+            return torch.from_numpy(np.stack([image_array] * self.channels, axis=0)), prepare_target(
+                bboxes, class_labels, self.available_files[item], self.logger, timer
+            )
 
-        image_transformed = self.transform(
-            image=np.stack([image_array, image_array, image_array], axis=2),
-            bboxes=bboxes,
-            class_labels=class_labels,
-            rad_id=rad_id,
-            image_name=self.available_files[item]
+        with timer('augmentation'):
+            image_transformed = self.transform(
+                image=np.stack([image_array] * 3, axis=2) if self.channels == 3 else image_array,
+                bboxes=bboxes,
+                class_labels=class_labels,
+                rad_id=rad_id,
+                image_name=self.available_files[item]
+            )
+            image_transformed['image'] = torch.from_numpy(
+                np.ascontiguousarray(np.atleast_3d(image_transformed['image']).transpose(2,0,1))
+            )
+
+        return image_transformed['image'], prepare_target(
+            image_transformed['bboxes'],
+            image_transformed['class_labels'],
+            image_transformed['image_name'],
+            self.logger,
+            timer
         )
-        image_transformed['image'] = torch.tensor(image_transformed['image'], dtype=torch.float).permute(2,0,1)/255
 
-        labels = torch.Tensor(image_transformed['class_labels']).long()
-        if labels.size()[0] == 0:
-            labels = torch.tensor([0], dtype=torch.long)
 
-        boxes = torch.Tensor([box[:4] for box in image_transformed['bboxes']])
-        if boxes.size()[0] == 0:
-            boxes = torch.Tensor([[0, 0, 1, 1]])
+class XRAYMemmapLoad:
+    """Dataset reading the image store written by ``data_preprocessing.py``."""
+    def __init__(
+        self,
+        mode = 'train',
+        database_dir = '../data/chest_xray/',
+        split = 0.8,
+        image_size: int = 1024,
+        logger: Optional[logging.Logger] = None,
+        augmentation: str = 'sample',
+        channels: int = 3,
+        manifest: Optional[DatasetManifest] = None,
+        profile: bool = False
+    ):
+        if mode not in ['train', 'test', 'eval']:
+            raise KeyError('Mode needs to be in [train, test, eval]')
+        if augmentation not in ['sample', 'batch']:
+            raise KeyError('Augmentation needs to be in [sample, batch]')
+        self.profile = profile
+        self.augmentation = augmentation
+        self.mode = mode
+        if channels not in [1, 3]:
+            raise KeyError('Channels need to be in [1, 3]')
+        self.channels = channels
+        self.transform = xray.utils.get_augmentation(
+            prob= 0.6 if mode == 'train' and augmentation == 'sample' else 0, channels=channels
+        )
+        folder = 'test' if mode == 'test' else 'train'
+        self.image_size = image_size
+        self.store_size = select_size(database_dir, folder, image_size)
+        self.store = ImageStore(image_store_dir(database_dir, folder, self.store_size))
+
+        if manifest is not None:
+            selected = manifest.select(mode)
+            self.positions = manifest.store_positions[selected]
+            found = self.positions >= 0
+            if not found.all() or not np.array_equal(
+                self.store.image_ids[self.positions[found]], manifest.image_ids[selected][found]
+            ):
+                # The manifest was built from another level or an older store.
+                self.positions = np.array([
+                    self.store.positions.get(image_id, -1) for image_id in manifest.ids(mode)
+                ], dtype=np.int64)
+            # Images of the split that are missing from the store are skipped.
+            self.positions = self.positions[self.positions >= 0]
+        else:
+            self.positions = np.arange(len(self.store))
+            if mode == 'train':
+                self.positions = self.positions[: int(len(self.positions) * split)]
+            elif mode == 'eval':
+                self.positions = self.positions[int(len(self.positions) * split):]
+        self.available_files = self.store.image_ids[self.positions].tolist()
+        if self.mode == 'test':
+            self.data_desc = pd.DataFrame({
+                'image_id': self.available_files,
+                'height': self.store.original_shapes[self.positions, 0],
+                'width': self.store.original_shapes[self.positions, 1]
+            })
 
+        self.length = len(self.available_files)
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+
+    def __len__(self):
+        return self.length
+
+    def aspect_ratios(self) -> np.ndarray:
+        """``width / height`` of every image, read from the store index."""
+        shapes = self.store.shapes[self.positions]
+        return shapes[:, 1] / shapes[:, 0]
+
+    def __getitem__(self, item):
+        position = self.positions[item]
+        timer = xray.profiler.SampleTimer(self.profile)
+        with timer('decode'):
+            image_array = self.store.get(position)
+            height, width = image_array.shape
+            if self.store_size != self.image_size:
+                image_array = resize_image(image_array, self.image_size)
+        with timer('annotations'):
+            boxes, class_ids, rad_id = self.store.annotations.slice(position)
+            if self.store_size != self.image_size:
+                boxes = boxes * np.array([image_array.shape[1] / width, image_array.shape[0] / height] * 2)
+
+            # FasterRCNN handles class_id==0 as the background, "No finding" (14) becomes 0.
+            class_labels = (class_ids.astype(np.int64) + 1) % 15
+            bboxes = np.concatenate([boxes, class_labels[:, None].astype(np.float32)], axis=1)
+
+        if self.augmentation == 'batch':
+            return torch.from_numpy(np.stack([image_array] * self.channels, axis=0)), prepare_target(
+                bboxes, class_labels, self.available_files[item], self.logger, timer
+            )
+
+        with timer('augmentation'):
+            image_transformed = self.transform(
+                image=np.stack([image_array] * 3, axis=2) if self.channels == 3 else image_array,
+                bboxes=bboxes,
+                class_labels=class_labels,
+                rad_id=rad_id,
+                image_name=self.available_files[item]
+            )
+            image_transformed['image'] = torch.from_numpy(
+                np.ascontiguousarray(np.atleast_3d(image_transformed['image']).transpose(2,0,1))
+            )
+
+        return image_transformed['image'], prepare_target(
+            image_transformed['bboxes'],
+            image_transformed['class_labels'],
+            image_transformed['image_name'],
+            self.logger,
+            timer
+        )
+
+
+def prepare_target(
+    bboxes,
+    class_labels,
+    file_name: str,
+    logger: logging.Logger,
+    timer: Optional[xray.profiler.SampleTimer] = None
+):
+    if timer is None:
+        timer = xray.profiler.SampleTimer()
+    labels = torch.Tensor(class_labels).long()
+    if labels.size()[0] == 0:
+        labels = torch.tensor([0], dtype=torch.long)
+
+    boxes = torch.Tensor([box[:4] for box in bboxes])
+    if boxes.size()[0] == 0:
+        boxes = torch.Tensor([[0, 0, 1, 1]])
+
+    with timer('filter'):
         boxes, labels = xray.utils.filter_radiologist_findings(
             boxes, labels, iou_threshold=0.5
         )
-        if len(labels) == 0:
-            # TODO: do something more clever. This happens when radiologist cant decide on either
-            #  class in the image
-            boxes = torch.tensor([[0, 0, 1, 1]], dtype=torch.float32)
-            labels = torch.tensor([0], dtype=torch.long)
+    if len(labels) == 0:
+        # TODO: do something more clever. This happens when radiologist cant decide on either
+        #  class in the image
+        boxes = torch.tensor([[0, 0, 1, 1]], dtype=torch.float32)
+        labels = torch.tensor([0], dtype=torch.long)
+
+
+    else:
+        for i, label in enumerate(labels):
+            if label.item() == 0:
+                boxes[i] = torch.tensor([ 0, 0, 1, 1], dtype=torch.float32)
+
+
+    boxes = boxes.long()
+    iscrowd = torch.zeros((boxes.shape[0],), dtype=torch.int64)
+    area = (boxes[:, 3] - boxes[:, 1]) * (boxes[:, 2] - boxes[:, 0])
+    area = torch.as_tensor(area, dtype=torch.float32)
+    if not all(area >= 1):
+        logger.warning('There are areas that are less or equal to 1. Filtering out those bboxes')
+        boxes = boxes[area >=1]
+        labels = labels[area >=1]
+        iscrowd = iscrowd[area >=1]
+        area = area[area >=1]
+
+    target = {
+        'boxes': boxes,
+        'labels': labels.long(),
+        'file_name': file_name,
+        'iscrowd': iscrowd,
+        'area': area
+    }
+    if timer.enabled:
+        target['timings'] = timer.timings
+    return target
 
 
-        else:
-            for i, label in enumerate(labels):
-                if label.item() == 0:
-                    boxes[i] = torch.tensor([ 0, 0, 1, 1], dtype=torch.float32)
-
-
-        boxes = boxes.long()
-        iscrowd = torch.zeros((boxes.shape[0],), dtype=torch.int64)
-        area = (boxes[:, 3] - boxes[:, 1]) * (boxes[:, 2] - boxes[:, 0])
-        area = torch.as_tensor(area, dtype=torch.float32)
-        if not all(area >= 1):
-            self.logger.warning('There are areas that are less or equal to 1. Filtering out those bboxes')
-            boxes = boxes[area >=1]
-            labels = labels[area >=1]
-            iscrowd = iscrowd[area >=1]
-            area = area[area >=1]
-
-        return image_transformed['image'].float(), {
-            'boxes': boxes,
-            'labels': labels.long(),
-            'file_name': image_transformed['image_name'],
-            'iscrowd': iscrowd,
-            'area': area
-        }
-
 class ZeroToOneTransform():
     def __call__(self, image):
         return (image - image.min())/(image - image.min()).max()
@@ -0,0 +1,190 @@
+import json
+import logging
+import os
+from functools import lru_cache
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+from xray.image_store import INDEX_FILE, ImageStore, image_store_dir, select_size, store_sizes
+
+SPLITS = {'train': 0, 'eval': 1, 'test': 2}
+
+
+class DatasetManifest:
+    """Persisted list of every image with its split, original size and image store position."""
+
+    def __init__(
+        self,
+        image_ids: np.ndarray,
+        splits: np.ndarray,
+        widths: np.ndarray,
+        heights: np.ndarray,
+        store_positions: np.ndarray,
+        fingerprint: str = ''
+    ):
+        self.image_ids = np.asarray(image_ids).astype(str)
+        self.splits = np.asarray(splits, dtype=np.int8)
+        self.widths = np.asarray(widths, dtype=np.int32)
+        self.heights = np.asarray(heights, dtype=np.int32)
+        self.store_positions = np.asarray(store_positions, dtype=np.int64)
+        self.fingerprint = fingerprint
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def select(self, mode: str) -> np.ndarray:
+        if mode not in SPLITS:
+            raise KeyError('Mode needs to be in [train, test, eval]')
+        return np.nonzero(self.splits == SPLITS[mode])[0]
+
+    def ids(self, mode: str) -> List[str]:
+        return self.image_ids[self.select(mode)].tolist()
+
+    def sizes(self, mode: str) -> pd.DataFrame:
+        """``image_id``, ``height`` and ``width`` of the images of ``mode``, as in ``test.csv``."""
+        selected = self.select(mode)
+        return pd.DataFrame({
+            'image_id': self.image_ids[selected], 'height': self.heights[selected], 'width': self.widths[selected]
+        })
+
+    def save(self, path: str):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(
+                f,
+                image_ids=self.image_ids,
+                splits=self.splits,
+                widths=self.widths,
+                heights=self.heights,
+                store_positions=self.store_positions,
+                fingerprint=self.fingerprint
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'DatasetManifest':
+        with np.load(path) as data:
+            return cls(
+                data['image_ids'], data['splits'], data['widths'], data['heights'], data['store_positions'],
+                str(data['fingerprint']) if 'fingerprint' in data else ''
+            )
+
+    @classmethod
+    def create(
+        cls,
+        data_dir: str,
+        database_dir: Optional[str] = None,
+        split: float = 0.8,
+        seed: int = 0,
+        image_size: int = 1024
+    ) -> 'DatasetManifest':
+        # Taken first, so that changes made while the manifest is built cause another rebuild.
+        fingerprint = input_fingerprint(data_dir, database_dir, split, seed, image_size)
+        columns = {key: [] for key in ['image_ids', 'splits', 'widths', 'heights', 'store_positions']}
+        for folder in ['train', 'test']:
+            store = None
+            if database_dir is not None and store_sizes(database_dir, folder):
+                store = ImageStore(image_store_dir(
+                    database_dir, folder, select_size(database_dir, folder, image_size)
+                ))
+
+            image_ids = _list_image_ids(os.path.join(data_dir, folder))
+            if not image_ids and store is not None:
+                image_ids = store.image_ids.tolist()
+            image_ids = np.array(sorted(image_ids), dtype=str)
+
+            if folder == 'train':
+                splits = np.full(len(image_ids), SPLITS['eval'], dtype=np.int8)
+                permutation = np.random.RandomState(seed).permutation(len(image_ids))
+                splits[permutation[: int(len(image_ids) * split)]] = SPLITS['train']
+            else:
+                splits = np.full(len(image_ids), SPLITS['test'], dtype=np.int8)
+
+            widths = np.full(len(image_ids), -1, dtype=np.int32)
+            heights = np.full(len(image_ids), -1, dtype=np.int32)
+            store_positions = np.full(len(image_ids), -1, dtype=np.int64)
+            if store is not None:
+                rows = np.array([store.positions.get(i, -1) for i in image_ids.tolist()], dtype=np.int64)
+                found = rows >= 0
+                store_positions[found] = rows[found]
+                heights[found] = store.original_shapes[rows[found], 0]
+                widths[found] = store.original_shapes[rows[found], 1]
+
+            sizes = _read_sizes(os.path.join(data_dir, 'train.csv' if folder == 'train' else 'test.csv'))
+            if sizes is not None:
+                sizes = sizes.reindex(image_ids)
+                known = sizes['width'].notna().values
+                widths[known] = sizes['width'].values[known]
+                heights[known] = sizes['height'].values[known]
+
+            for key, value in zip(columns, [image_ids, splits, widths, heights, store_positions]):
+                columns[key].append(value)
+
+        return cls(**{key: np.concatenate(value) for key, value in columns.items()}, fingerprint=fingerprint)
+
+
+def input_fingerprint(
+    data_dir: str,
+    database_dir: Optional[str] = None,
+    split: float = 0.8,
+    seed: int = 0,
+    image_size: int = 1024
+) -> str:
+    """Modification times and sizes of the folders, csvs and store indexes a manifest is built from."""
+    paths = {name: os.path.join(data_dir, name) for name in ['train', 'test', 'train.csv', 'test.csv']}
+    for folder in ['train', 'test']:
+        if database_dir is not None and store_sizes(database_dir, folder):
+            paths[f'{folder} store'] = os.path.join(
+                image_store_dir(database_dir, folder, select_size(database_dir, folder, image_size)), INDEX_FILE
+            )
+    stats = {}
+    for name, path in paths.items():
+        if os.path.exists(path):
+            stat = os.stat(path)
+            stats[name] = [path, stat.st_mtime_ns, stat.st_size]
+    return json.dumps({'split': split, 'seed': seed, 'image_size': image_size, 'inputs': stats}, sort_keys=True)
+
+
+def _list_image_ids(directory: str) -> List[str]:
+    if not os.path.isdir(directory):
+        return []
+    return [
+        f.split('.')[0] for f in os.listdir(directory) if f.endswith('png') or f.endswith('dicom')
+    ]
+
+
+def _read_sizes(path: str) -> Optional[pd.DataFrame]:
+    if not os.path.exists(path):
+        return None
+    sizes = pd.read_csv(path)
+    if not {'width', 'height'}.issubset(sizes.columns):
+        return None
+    return sizes.groupby('image_id')[['width', 'height']].first()
+
+
+@lru_cache()
+def load_manifest(path: str, mtime: int) -> DatasetManifest:
+    return DatasetManifest.load(path)
+
+
+def get_manifest(
+    path: str,
+    data_dir: str,
+    database_dir: Optional[str] = None,
+    split: float = 0.8,
+    image_size: int = 1024,
+    rebuild: bool = False
+) -> DatasetManifest:
+    """Load the manifest at ``path``, (re)building it if missing, stale or with ``rebuild``."""
+    manifest = None
+    if not rebuild and os.path.exists(path):
+        manifest = load_manifest(path, os.stat(path).st_mtime_ns)
+        if manifest.fingerprint != input_fingerprint(data_dir, database_dir, split, image_size=image_size):
+            logging.getLogger(__name__).warning(f'The inputs of {path} changed, rebuilding it')
+            manifest = None
+    if manifest is None:
+        DatasetManifest.create(data_dir, database_dir, split=split, image_size=image_size).save(path)
+        manifest = load_manifest(path, os.stat(path).st_mtime_ns)
+    return manifest
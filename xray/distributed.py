@@ -0,0 +1,97 @@
+import os
+from typing import Any, List
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+import xray.utils
+from xray.predictions import DetectionBuffer
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process() -> bool:
+    return get_rank() == 0
+
+
+def init_process_group(
+    rank: int,
+    world_size: int,
+    backend: str = 'gloo',
+    master_addr: str = '127.0.0.1',
+    master_port: int = 29500
+):
+    """Join the process group; ``MASTER_ADDR`` / ``MASTER_PORT`` from the environment win."""
+    os.environ.setdefault('MASTER_ADDR', master_addr)
+    os.environ.setdefault('MASTER_PORT', str(master_port))
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def all_reduce(values: List[float], op=None) -> List[float]:
+    """Reduce a list of numbers over all processes (sum by default)."""
+    if not is_distributed():
+        return list(values)
+    tensor = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(tensor, op=op if op is not None else dist.ReduceOp.SUM)
+    return tensor.tolist()
+
+
+def min_over_processes(value: int) -> int:
+    return int(all_reduce([value], op=dist.ReduceOp.MIN if is_distributed() else None)[0])
+
+
+def gather_lists(values: List[Any]) -> List[Any]:
+    """Concatenate the per-process lists in rank order, on every process."""
+    if not is_distributed():
+        return values
+    gathered = [None] * get_world_size()
+    dist.all_gather_object(gathered, values)
+    return [value for process_values in gathered for value in process_values]
+
+
+def gather_detections(buffer: DetectionBuffer) -> DetectionBuffer:
+    """Concatenate the per-process buffers in rank order, on every process."""
+    if not is_distributed():
+        return buffer
+    return DetectionBuffer.concatenate(gather_lists([buffer]))
+
+
+def reduce_losses(losses: xray.utils.LossAccumulator) -> dict:
+    """``losses.summary()`` over the steps of all processes."""
+    return losses.summary(all_reduce(losses.totals()))
+
+
+class ShardSampler(Sampler):
+    """Every ``world_size``-th index starting at ``rank``, without padding."""
+
+    def __init__(self, length: int, rank: int = None, world_size: int = None):
+        self.length = length
+        self.rank = get_rank() if rank is None else rank
+        self.world_size = get_world_size() if world_size is None else world_size
+
+    def __iter__(self):
+        return iter(range(self.rank, self.length, self.world_size))
+
+    def __len__(self):
+        return len(range(self.rank, self.length, self.world_size))
@@ -0,0 +1,276 @@
+import argparse
+import json
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import DataLoader
+from torchvision.models.detection import FasterRCNN
+
+import xray.evalutation
+import xray.inference
+import xray.map_eval
+import xray.train
+import xray.utils
+from xray.predictions import DetectionBuffer, add_outputs
+
+# Dimensions of a (channels, height, width) image that every view flips.
+VIEWS = {'none': (), 'hflip': (2,), 'vflip': (1,)}
+FUSION_IOU = 0.55
+
+
+def unflip(predictions: DetectionBuffer, view: str) -> DetectionBuffer:
+    """Map the boxes predicted on ``view`` of the images back onto the images themselves."""
+    if view not in VIEWS:
+        raise KeyError(f'Views need to be in {list(VIEWS)}')
+    boxes = predictions.boxes.copy()
+    shapes = predictions.shapes[predictions.image_index()]
+    for dim in VIEWS[view]:
+        # x for the width (dim 2), y for the height (dim 1).
+        size = shapes[:, 1 if dim == 2 else 0, None]
+        columns = [0, 2] if dim == 2 else [1, 3]
+        boxes[:, columns] = size - boxes[:, columns[::-1]]
+    return predictions.replace(boxes=boxes)
+
+
+def _paired_iou(boxes: np.ndarray, clusters: np.ndarray) -> np.ndarray:
+    """IoU of every box ``(n, 4)`` with each of its clusters ``(n, k, 4)``, xyxy."""
+    boxes = boxes[:, None]
+    widths = np.minimum(boxes[..., 2], clusters[..., 2]) - np.maximum(boxes[..., 0], clusters[..., 0])
+    heights = np.minimum(boxes[..., 3], clusters[..., 3]) - np.maximum(boxes[..., 1], clusters[..., 1])
+    intersection = np.maximum(widths, 0) * np.maximum(heights, 0)
+    areas = (boxes[..., 2] - boxes[..., 0]) * (boxes[..., 3] - boxes[..., 1])
+    cluster_areas = (clusters[..., 2] - clusters[..., 0]) * (clusters[..., 3] - clusters[..., 1])
+    return intersection / np.maximum(areas + cluster_areas - intersection, np.finfo(np.float64).tiny)
+
+
+def weighted_box_fusion(
+    predictions: Sequence[DetectionBuffer],
+    weights: Optional[Sequence[float]] = None,
+    iou_threshold: float = FUSION_IOU
+) -> DetectionBuffer:
+    """Weighted box fusion of several predictions of the same images."""
+    first = predictions[0]
+    weights = np.ones(len(predictions)) if weights is None else np.asarray(weights, dtype=np.float64)
+    images = np.concatenate([buffer.image_index() for buffer in predictions])
+    labels = np.concatenate([buffer.labels for buffer in predictions])
+    boxes = np.concatenate([buffer.boxes for buffer in predictions]).astype(np.float64)
+    scores = np.concatenate([buffer.scores for buffer in predictions]).astype(np.float64)
+    scores *= np.repeat(weights, [buffer.n_rows for buffer in predictions])
+
+    order = np.lexsort((-scores, labels, images))
+    images, labels, boxes, scores = images[order], labels[order], boxes[order], scores[order]
+    new_group = np.ones(len(order), dtype=bool)
+    new_group[1:] = (images[1:] != images[:-1]) | (labels[1:] != labels[:-1])
+    starts = np.flatnonzero(new_group)
+    sizes = np.diff(np.append(starts, len(order)))
+
+    # A group has at most as many clusters as boxes, so cluster j of the group starting at row
+    # s is kept in row s + j.
+    box_sums = np.zeros((len(order), 4))
+    score_sums = np.zeros(len(order))
+    counts = np.zeros(len(order), dtype=np.int64)
+    n_clusters = np.zeros(len(starts), dtype=np.int64)
+    for rank in range(int(sizes.max(initial=0))):
+        active = np.flatnonzero(sizes > rank)
+        rows = starts[active] + rank
+        target = n_clusters[active].copy()
+        if rank > 0:
+            slots = starts[active, None] + np.arange(rank)
+            ious = _paired_iou(boxes[rows], box_sums[slots] / np.maximum(score_sums[slots], 1e-12)[..., None])
+            ious[np.arange(rank) >= n_clusters[active, None]] = -1.0
+            best = ious.argmax(axis=1)
+            matched = ious[np.arange(len(active)), best] > iou_threshold
+            target[matched] = best[matched]
+        n_clusters[active] += target == n_clusters[active]
+        slots = starts[active] + target
+        box_sums[slots] += scores[rows, None] * boxes[rows]
+        score_sums[slots] += scores[rows]
+        counts[slots] += 1
+
+    used = np.flatnonzero(counts)
+    fused_scores = score_sums[used] / counts[used] * np.minimum(counts[used], len(predictions)) / weights.sum()
+    fused_order = np.lexsort((-fused_scores, images[used]))
+    used, fused_scores = used[fused_order], fused_scores[fused_order]
+    result = DetectionBuffer(len(first), per_image=0)
+    result.extend(
+        first.image_ids,
+        np.bincount(images[used], minlength=len(first)),
+        box_sums[used] / score_sums[used, None],
+        labels[used],
+        fused_scores,
+        first.shapes
+    )
+    return result
+
+
+class Ensemble(torch.nn.Module):
+    """Several Faster R-CNNs on several views of the images, fused into one prediction."""
+
+    def __init__(
+        self,
+        models: Sequence[FasterRCNN],
+        views: Sequence[str] = ('none',),
+        weights: Optional[Sequence[float]] = None,
+        fusion_iou: float = FUSION_IOU
+    ):
+        super().__init__()
+        for view in views:
+            if view not in VIEWS:
+                raise KeyError(f'Views need to be in {list(VIEWS)}')
+        self.models = torch.nn.ModuleList(models)
+        self.views = list(views)
+        self.members = [(model, view) for model in range(len(models)) for view in self.views]
+        self.weights = np.ones(len(self.members)) if weights is None else np.asarray(weights, dtype=np.float64)
+        if len(self.weights) != len(self.members):
+            raise ValueError(f'{len(self.weights)} weights for {len(self.members)} models and views')
+        self.fusion_iou = fusion_iou
+        self.forward_seconds = np.zeros(len(models))
+
+    def predict_views(self, images: List[torch.Tensor], image_ids: Sequence[str]) -> List[DetectionBuffer]:
+        """The predictions of every member, on the images."""
+        shapes = [image.shape[-2:] for image in images]
+        views = [image.flip(VIEWS[view]) if VIEWS[view] else image for view in self.views for image in images]
+        predictions = []
+        for k, model in enumerate(self.models):
+            start = time.perf_counter()
+            outputs = model(views)
+            if views[0].is_cuda:
+                torch.cuda.synchronize(views[0].device)
+            self.forward_seconds[k] += time.perf_counter() - start
+            buffer = DetectionBuffer(len(views))
+            add_outputs(buffer, list(image_ids) * len(self.views), outputs, shapes * len(self.views))
+            predictions.extend(
+                unflip(buffer.slice_images(v * len(images), (v + 1) * len(images)), view)
+                for v, view in enumerate(self.views)
+            )
+        return predictions
+
+    def forward(self, images: List[torch.Tensor]) -> List[Dict[str, torch.Tensor]]:
+        predictions = self.predict_views(images, [str(i) for i in range(len(images))])
+        if len(predictions) > 1:
+            predictions = [weighted_box_fusion(predictions, self.weights, self.fusion_iou)]
+        device = images[0].device
+        return [
+            {
+                'boxes': torch.from_numpy(detections['boxes'].copy()).to(device),
+                'labels': torch.from_numpy(detections['labels'].copy()).to(device),
+                'scores': torch.from_numpy(detections['scores'].copy()).to(device)
+            }
+            for detections in predictions[0]
+        ]
+
+
+def cost_benefit(
+    ensemble: Ensemble,
+    loader: DataLoader,
+    device: str = 'cpu',
+    precision: str = 'fp32',
+    score_threshold: float = 0.5,
+    logger: Optional[logging.Logger] = None
+) -> pd.DataFrame:
+    """Forward and fusion time and mAP gain of every member of ``ensemble`` on ``loader``."""
+    logger = logger if logger is not None else logging.getLogger(__name__)
+    ensemble = ensemble.to(device)
+    ensemble.eval()
+    ensemble.forward_seconds[:] = 0.0
+    members = [DetectionBuffer(len(loader.sampler)) for _ in ensemble.members]
+    targets = DetectionBuffer(len(loader.sampler), with_scores=False)
+    with torch.no_grad():
+        for images, batch_targets in loader:
+            image_ids = [target['file_name'] for target in batch_targets]
+            with xray.utils.autocast(device, precision):
+                predictions = ensemble.predict_views(xray.utils.images_to_device(images, device), image_ids)
+            for buffer, batch_predictions in zip(members, predictions):
+                buffer.append(batch_predictions)
+            targets.extend(
+                image_ids,
+                [len(target['labels']) for target in batch_targets],
+                torch.cat([target['boxes'].reshape(-1, 4) for target in batch_targets]).float().numpy(),
+                torch.cat([target['labels'] for target in batch_targets]).numpy()
+            )
+
+    rows = []
+    for k, (model, view) in enumerate(ensemble.members):
+        start = time.perf_counter()
+        fused = members[0] if k == 0 else weighted_box_fusion(
+            members[:k + 1], ensemble.weights[:k + 1], ensemble.fusion_iou
+        )
+        fusion_seconds = time.perf_counter() - start
+        fused = fused.take(np.flatnonzero(fused.scores > score_threshold))
+        rows.append({
+            'model': model,
+            'view': view,
+            'forward_seconds': ensemble.forward_seconds[model] / len(ensemble.views),
+            'fusion_seconds': fusion_seconds,
+            'map': xray.map_eval.evaluate(xray.evalutation.prepare_predictions(fused), targets).map
+        })
+    report = pd.DataFrame(rows)
+    report['gain'] = report['map'].diff().fillna(0.0)
+    for row in report.itertuples():
+        logger.info(
+            f'Model {row.model} view {row.view}: mAP {row.map:.4f} ({row.gain:+.4f}), '
+            f'forward {row.forward_seconds:.1f}s, fusion {row.fusion_seconds:.2f}s'
+        )
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint-path', type=str, nargs='+', required=True,
+                        help='best_model_rcnn.cfg, checkpoints of --keep-checkpoints or run folders')
+    parser.add_argument('--views', type=str, nargs='+', default=['none', 'hflip'], choices=list(VIEWS))
+    parser.add_argument('--weights', type=float, nargs='+', default=None,
+                        help='One per checkpoint and view, ordered by checkpoint then view')
+    parser.add_argument('--fusion-iou', default=FUSION_IOU, type=float)
+    parser.add_argument('--report', type=str, default=None,
+                        help='Run folder of train.py: report cost and mAP of every view on its eval split')
+    parser.add_argument('--output', type=str, default=None, help='Submission csv, continued if it exists')
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--image-dir', type=str, help='Folder of .dicom / .dcm or .png test images')
+    source.add_argument('--store', type=str, help='Folder with the test image store of data_preprocessing.py')
+    parser.add_argument('--sizes-csv', type=str, default=None,
+                        help='test.csv with the original sizes of png images')
+    parser.add_argument('--image-size', default=1024, type=int)
+    parser.add_argument('--channels', default=3, type=int, choices=[1, 3])
+    parser.add_argument('--batch-size', default=4, type=int, help='Images per batch, each in every view')
+    parser.add_argument('--n-workers', default=2, type=int)
+    parser.add_argument('--device', default='cpu', type=str)
+    parser.add_argument('--precision', default='fp32', type=str, choices=list(xray.utils.PRECISIONS))
+    parser.add_argument('--score-threshold', default=0.5, type=float, help='Applied to the fused scores')
+    parser.add_argument('--prefetch-depth', default=2, type=int)
+    args = parser.parse_args()
+    if args.report is None and (args.output is None or (args.image_dir is None and args.store is None)):
+        parser.error('--output and --image-dir or --store are required without --report')
+
+    logger = xray.utils.define_logger('Ensemble', filehandler=False)
+    logger.setLevel(logging.INFO)
+    if args.report is not None:
+        with open(os.path.join(args.report, 'model_hyperparameters.json')) as j:
+            cfg = argparse.Namespace(**json.load(j))
+        cfg.device, cfg.batch_size, cfg.n_workers = args.device, args.batch_size, args.n_workers
+        args.channels, args.image_size = cfg.channels, cfg.image_size
+
+    models = [xray.inference.load_model(path, args.channels, args.image_size) for path in args.checkpoint_path]
+    ensemble = Ensemble(models, args.views, args.weights, args.fusion_iou)
+    if args.report is not None:
+        loader = xray.train.get_eval_loader(xray.train.get_dataset('eval', cfg), cfg)
+        print(cost_benefit(ensemble, loader, args.device, args.precision, args.score_threshold, logger).to_string(index=False))
+    else:
+        done = xray.inference.finished_images(args.output)
+        if done:
+            logger.info(f'Continuing {args.output}, {len(done)} images are already predicted')
+        if args.store is not None:
+            dataset = xray.inference.StoreImages(args.store, args.image_size, args.channels, skip=done)
+        else:
+            sizes = pd.read_csv(args.sizes_csv) if args.sizes_csv is not None else None
+            dataset = xray.inference.ImageFolder(args.image_dir, args.image_size, args.channels, sizes, skip=done)
+        xray.inference.run_inference(
+            ensemble, dataset, args.output, args.batch_size, args.n_workers, args.device, args.precision,
+            args.score_threshold, args.prefetch_depth, logger=logger
+        )
+        logger.info(f'Forward seconds per checkpoint: {ensemble.forward_seconds.round(1).tolist()}')
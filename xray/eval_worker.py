@@ -0,0 +1,125 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import time
+from typing import List, Optional
+
+import torch
+
+import xray.checkpoint
+import xray.evalutation
+import xray.map_eval
+import xray.train
+import xray.utils
+
+
+class EvaluationWorker:
+    """Evaluates the epoch checkpoints of a training run while the training goes on."""
+
+    def __init__(self, model_path_folder: str, cfg, logger: Optional[logging.Logger] = None):
+        self.folder = model_path_folder
+        self.directory = os.path.join(model_path_folder, xray.checkpoint.CHECKPOINT_DIR)
+        self.cfg = cfg
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.model = xray.evalutation.build_rcnn(cfg.channels, cfg.image_size).to(cfg.device)
+        self.eval_loader = xray.train.get_eval_loader(xray.train.get_dataset('eval', cfg), cfg)
+
+        results = xray.checkpoint.read_results(model_path_folder)
+        self.evaluated = set(result['checkpoint'] for result in results)
+        self.best_eval_ma = max([result['ma'] for result in results], default=0)
+        self.test_number = 1 + sum(result['is_best'] for result in results)
+
+    def pending(self) -> List[str]:
+        if not os.path.isdir(self.directory):
+            return []
+        return [
+            path for path in xray.checkpoint.list_checkpoints(self.directory)
+            if os.path.basename(path) not in self.evaluated
+        ]
+
+    def evaluate(self, path: str) -> Optional[dict]:
+        name = os.path.basename(path)
+        try:
+            state = torch.load(path, map_location='cpu')
+        except FileNotFoundError:
+            self.logger.warning(f'Checkpoint {path} was removed (--keep-checkpoints) before its evaluation')
+            self.evaluated.add(name)
+            return None
+        self.model.load_state_dict(state['model'])
+
+        evaluator = xray.map_eval.OnlineMAPEvaluator()
+        xray.evalutation.model_eval_forward(
+            self.model, self.eval_loader, self.cfg.device, logger=self.logger, precision=self.cfg.precision,
+            evaluator=evaluator
+        )
+        eval_ma = evaluator.result().map
+        self.logger.info(f'Ma metric on evaluation dataset after epoch {state["epoch"]} is with IoU 0.4 is {eval_ma}')
+
+        is_best = eval_ma > self.best_eval_ma
+        if is_best:
+            self.best_eval_ma = eval_ma
+            self.logger.info(f'New best model after epoch {state["epoch"]} with ma {eval_ma}')
+            xray.checkpoint.save_best(self.folder, state)
+            xray.train.create_test_submission(
+                model=self.model,
+                model_path_folder=self.folder,
+                cfg=self.cfg,
+                logger=self.logger,
+                test_number=self.test_number
+            )
+            self.test_number += 1
+
+        # Written last, so a checkpoint whose submission did not finish is evaluated again.
+        result = dict(checkpoint=name, epoch=state['epoch'], ma=eval_ma, is_best=is_best, time=xray.utils.time_str())
+        with open(os.path.join(self.directory, xray.checkpoint.RESULTS_FILE), 'a') as f:
+            f.write(json.dumps(result) + '\n')
+        self.evaluated.add(name)
+        return result
+
+    def run(self, poll_interval: float = 30.0):
+        """Evaluate checkpoints as they appear, until training has finished and all are evaluated."""
+        while True:
+            # Checked before listing, so every checkpoint of a finished run is listed.
+            finished = xray.checkpoint.is_finished(self.folder)
+            pending = self.pending()
+            for path in pending:
+                self.evaluate(path)
+            if finished and not pending:
+                return
+            if not pending:
+                time.sleep(poll_interval)
+
+
+def run_worker(model_path_folder: str, cfg, poll_interval: float = 30.0):
+    logger = xray.utils.define_logger('Evaluation worker', folder=model_path_folder)
+    try:
+        EvaluationWorker(model_path_folder, cfg, logger).run(poll_interval)
+    except Exception as e:
+        logger.exception(f'Evaluation worker failed with exception {e}')
+        raise
+
+
+def start(model_path_folder: str, cfg) -> multiprocessing.Process:
+    """Run the worker for ``model_path_folder`` in a new process, on ``cfg.eval_device``."""
+    worker_cfg = argparse.Namespace(**{**vars(cfg), 'device': cfg.eval_device or cfg.device})
+    process = torch.multiprocessing.get_context('spawn').Process(
+        target=run_worker, args=(model_path_folder, worker_cfg, cfg.eval_poll_interval)
+    )
+    process.start()
+    return process
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('run_folder', type=str, help='Run folder of train.py, its hyperparameters are reused')
+    parser.add_argument('--device', default=None, type=str)
+    parser.add_argument('--poll-interval', default=30.0, type=float)
+    args = parser.parse_args()
+
+    with open(os.path.join(args.run_folder, 'model_hyperparameters.json')) as j:
+        cfg = argparse.Namespace(**json.load(j))
+    if args.device is not None:
+        cfg.device = args.device
+    run_worker(args.run_folder, cfg, args.poll_interval)
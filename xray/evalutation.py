@@ -1,7 +1,10 @@
 import argparse
+import functools
 import logging
 from collections import Counter
+from typing import Optional, Tuple
 
+import numpy as np
 import torch
 from torch.utils.data import DataLoader
 from torchvision.models.detection import FasterRCNN, fasterrcnn_resnet50_fpn
@@ -10,76 +13,139 @@ from torchvision.models.detection.faster_rcnn import FastRCNNPredictor
 from tqdm import tqdm
 
 import xray
-from xray.coco_eval import VinBigDataEval
 from xray.dataset import XRAYShelveLoad
-from xray.utils import create_true_df, create_eval_df, my_custom_collate
+from xray.map_eval import MAPResult, OnlineMAPEvaluator, evaluate
+from xray.predictions import NO_FINDING_BOX, DetectionBuffer, add_outputs, fill_no_findings
+from xray.prefetch import BatchPrefetcher
+from xray.profiler import PipelineProfiler
+from xray.utils import create_eval_df, my_custom_collate
 
 best_model_path = '../data/chest_xray/2021-02-09_17:46:42/rcnn_checkpoint.pth'
 
 
-def get_rcnn(model_path, device: str = 'cpu'):
-    model = fasterrcnn_resnet50_fpn(pretrained_backbone=False)
+def build_rcnn(channels: int = 3, image_size: Optional[int] = None) -> FasterRCNN:
+    """The untrained 15 class Faster R-CNN that the weights saved by ``train.py`` belong to."""
+    size_kwargs = dict(min_size=image_size, max_size=image_size) if image_size is not None else {}
+    model = fasterrcnn_resnet50_fpn(pretrained_backbone=False, **size_kwargs)
     in_features = model.roi_heads.box_predictor.cls_score.in_features
     model.roi_heads.box_predictor = FastRCNNPredictor(in_features, 15)
+    if channels == 1:
+        to_single_channel(model)
+    return xray.utils.float32_boxes(model)
 
+
+def get_rcnn(model_path, device: str = 'cpu', channels: int = 3, image_size: Optional[int] = None):
+    model = build_rcnn(channels, image_size)
     model.load_state_dict(torch.load(model_path, map_location=torch.device(device)))
 
     return model
 
 
+def to_single_channel(model: FasterRCNN) -> FasterRCNN:
+    """Adapt an RGB Faster R-CNN to 1xHxW grayscale input by folding its first convolution."""
+    conv = model.backbone.body.conv1
+    mean = torch.as_tensor(model.transform.image_mean, dtype=conv.weight.dtype).view(1, -1, 1, 1)
+    std = torch.as_tensor(model.transform.image_std, dtype=conv.weight.dtype).view(1, -1, 1, 1)
+    single_mean, single_std = mean.mean().item(), std.mean().item()
+
+    with torch.no_grad():
+        scaled_weight = conv.weight / std
+        weight = single_std * scaled_weight.sum(dim=1, keepdim=True)
+        bias = (single_mean * scaled_weight.sum(dim=1) - (scaled_weight * mean).sum(dim=1)).sum(dim=(1, 2))
+
+        single_conv = torch.nn.Conv2d(
+            1, conv.out_channels, conv.kernel_size, conv.stride, conv.padding, bias=True
+        ).to(conv.weight.device)
+        single_conv.weight.copy_(weight)
+        single_conv.bias.copy_(bias)
+    single_conv.requires_grad_(conv.weight.requires_grad)
+
+    model.backbone.body.conv1 = single_conv
+    model.transform.image_mean = [single_mean]
+    model.transform.image_std = [single_std]
+    return model
+
+
 def model_eval_forward(
     model: FasterRCNN,
     loader: DataLoader,
     device: str = 'cpu',
     score_threshold: float = 0.5,
-    logger: logging.Logger = None
-):
+    logger: logging.Logger = None,
+    precision: str = 'fp32',
+    profiler: Optional[PipelineProfiler] = None,
+    prefetch_depth: int = 2,
+    evaluator: Optional[OnlineMAPEvaluator] = None
+) -> Tuple[DetectionBuffer, DetectionBuffer]:
+    """Predictions above ``score_threshold`` and the targets of every image of ``loader``."""
     if logger is None:
         logger = logging.getLogger('Model Evaluation')
+    if profiler is None:
+        profiler = PipelineProfiler()
     model = model.to(device)
     model.eval()
+    # Sized for the images of this process; the buffers grow if the loader has no sampler.
+    n_images = len(loader.sampler) if hasattr(loader, 'sampler') else 0
+    predictions = DetectionBuffer(n_images)
+    targets = DetectionBuffer(n_images, with_scores=False)
+    n_classes = model.roi_heads.box_predictor.cls_score.out_features
+    predictions_count = torch.zeros(n_classes, dtype=torch.int64, device=device)
     with torch.no_grad():
-        all_results = []
-        all_targets = []
-
-        for i, (x_eval, x_target) in tqdm(enumerate(loader), total=len(loader)):
-            x_eval = [x.to(device) for x in x_eval]
-            results = model(x_eval)
-
-            for target in x_target:
-                all_targets.append({
-                    'boxes': target['boxes'].tolist(),
-                    'labels': target['labels'].tolist(),
-                    'file_name': target['file_name']
-                })
-
-
-
-            all_results.extend(results)
-
-        labels_count = Counter([l for t in all_targets for l in t['labels']])
-        predictions_count = Counter([l.item() for p in all_results for l in p['labels']])
+        batches = BatchPrefetcher(
+            loader, device, prefetch_depth, functools.partial(_images_to_device, device=device),
+            synchronize=profiler.enabled
+        )
+        for i, (x_eval, x_target) in tqdm(enumerate(profiler.iterate(batches, 'eval')), total=len(loader)):
+            with profiler.stage('forward'):
+                with xray.utils.autocast(device, precision):
+                    results = model(x_eval)
+
+            image_ids = [target['file_name'] for target in x_target]
+            labels = torch.cat([result['labels'] for result in results])
+            predictions_count.index_add_(0, labels, torch.ones_like(labels))
+            batch_predictions = DetectionBuffer(len(results))
+            add_outputs(
+                batch_predictions, image_ids, results, [image.shape[-2:] for image in x_eval], score_threshold
+            )
+            batch_targets = DetectionBuffer(len(x_target), with_scores=False)
+            batch_targets.extend(
+                image_ids,
+                [len(target['labels']) for target in x_target],
+                torch.cat([target['boxes'].reshape(-1, 4) for target in x_target]).float().numpy(),
+                torch.cat([target['labels'] for target in x_target]).numpy()
+            )
+            predictions.append(batch_predictions)
+            targets.append(batch_targets)
+
+            if evaluator is not None:
+                evaluator.update(prepare_predictions(batch_predictions), batch_targets)
+                if (i + 1) % max(1, len(loader) // 10) == 0:
+                    logger.info(f'Running mAP after {evaluator.n_images} images: {evaluator.result().map:.4f}')
+
+    labels_count = Counter(targets.labels.tolist())
+    predictions_count = {label: count for label, count in enumerate(predictions_count.tolist()) if count}
+    logger.info(f'Total class counts of the predictions are: {Counter(predictions_count)}')
+    logger.info(f'Total class counts of the targets are: {labels_count}')
 
+    return predictions, targets
 
-    logger.info(f'Total class counts of the predictions are: {predictions_count}')
-    logger.info(f'Total class counts of the targets are: {labels_count}')
 
-    index_selected = [results['scores'].data.cpu().numpy() > score_threshold for results in all_results]
-    results_selected = [{r: val[index].data.cpu().numpy() for r, val in result.items()} for result, index in zip(all_results, index_selected)]
+def _images_to_device(images, targets, device: str):
+    # Targets stay on the host, they are only converted to lists.
+    return xray.utils.images_to_device(images, device), targets
 
-    return results_selected, all_targets
 
+def prepare_predictions(results: DetectionBuffer) -> DetectionBuffer:
+    """The results of ``model_eval_forward`` as the former ``VinBigDataEval`` path saw them."""
+    predictions = fill_no_findings(results)
+    boxes = np.trunc(predictions.boxes)
+    boxes[predictions.labels == 14] = NO_FINDING_BOX
+    return predictions.replace(boxes=boxes)
 
-def calculate_metrics(results, targets):
-    true_df = create_true_df(descriptions=targets)
-    results = xray.utils.transform_no_findings(results)
-    results = xray.utils.no_findings_to_ones(results)
 
-    eval_df = create_eval_df(results=results, description=targets)
-    eval_df['PredictionString'] = eval_df.PredictionString.apply(xray.utils.do_nms)
-    vinbigeval = VinBigDataEval(true_df)
-    final_evaluation = vinbigeval.evaluate(eval_df)
-    return final_evaluation
+def calculate_metrics(results: DetectionBuffer, targets: DetectionBuffer) -> MAPResult:
+    """mAP@0.4 of the results of ``model_eval_forward``, with ``xray.map_eval``."""
+    return evaluate(prepare_predictions(results), targets)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,237 @@
+import logging
+import math
+import os
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+from torchvision.models.detection import FasterRCNN
+from torchvision.models.detection.image_list import ImageList
+
+import xray.utils
+
+CACHE_DTYPES = {'fp16': np.float16, 'fp32': np.float32}
+INDEX_FILE = 'index.npz'
+
+
+def padded_size(model: FasterRCNN, image_size: int) -> int:
+    """Side of the square every image is padded to, so all cached feature maps share a shape."""
+    divisible = model.transform.size_divisible
+    return int(math.ceil(image_size / divisible) * divisible)
+
+
+def backbone_checksum(model: FasterRCNN) -> float:
+    """Sum of the backbone weights, to notice a cache built from another backbone."""
+    return float(sum(
+        value.detach().double().sum().item() for value in model.backbone.state_dict().values()
+        if value.is_floating_point()
+    ))
+
+
+def hflip(images: List[torch.Tensor], targets: List[Dict[str, torch.Tensor]]):
+    flipped_targets = []
+    for image, target in zip(images, targets):
+        boxes = target['boxes'].clone()
+        boxes[:, 0] = image.shape[-1] - target['boxes'][:, 2]
+        boxes[:, 2] = image.shape[-1] - target['boxes'][:, 0]
+        flipped_targets.append({**target, 'boxes': boxes})
+    return [image.flip(-1) for image in images], flipped_targets
+
+
+def is_current(
+    directory: str,
+    image_ids: Sequence[str],
+    image_size: int,
+    model: FasterRCNN,
+    dtype: str = 'fp16',
+    flip: bool = False
+) -> bool:
+    """Whether ``directory`` holds a complete cache of these images, size, backbone, dtype and views."""
+    path = os.path.join(directory, INDEX_FILE)
+    if not os.path.exists(path):
+        return False
+    index = np.load(path)
+    return (
+        'dtype' in index and str(index['dtype']) == dtype
+        and int(index['views']) == (2 if flip else 1)
+        and int(index['image_size']) == image_size
+        and index['image_ids'].tolist() == list(image_ids)
+        and float(index['checksum']) == backbone_checksum(model)
+    )
+
+
+def build_feature_cache(
+    model: FasterRCNN,
+    dataset,
+    directory: str,
+    image_size: int,
+    dtype: str = 'fp16',
+    flip: bool = False,
+    batch_size: int = 8,
+    num_workers: int = 0,
+    device: str = 'cpu',
+    logger: Optional[logging.Logger] = None
+):
+    """Run the backbone of ``model`` once over ``dataset`` and store its FPN feature maps."""
+    if dtype not in CACHE_DTYPES:
+        raise KeyError(f'Dtype needs to be in {list(CACHE_DTYPES)}')
+    logger = logger if logger is not None else logging.getLogger(__name__)
+    os.makedirs(directory, exist_ok=True)
+    if os.path.exists(os.path.join(directory, INDEX_FILE)):
+        os.remove(os.path.join(directory, INDEX_FILE))
+
+    model.eval()
+    size = padded_size(model, image_size)
+    channels = model.backbone.body.conv1.in_channels
+    views = 2 if flip else 1
+    n_images = len(dataset)
+    with torch.no_grad():
+        probe = model.backbone(torch.zeros(1, channels, size, size, device=device))
+    levels = list(probe)
+    feature_maps = {
+        level: np.lib.format.open_memmap(
+            os.path.join(directory, f'features_{level}.npy'), mode='w+', dtype=CACHE_DTYPES[dtype],
+            shape=(views * n_images,) + tuple(probe[level].shape[1:])
+        ) for level in levels
+    }
+    logger.info(
+        f'Caching {len(levels)} FPN levels of {n_images} images x {views} views, '
+        f'{sum(m.nbytes for m in feature_maps.values()) / 2 ** 30:.1f} GiB'
+    )
+
+    image_sizes = np.zeros((views * n_images, 2), dtype=np.int32)
+    boxes: List[np.ndarray] = [np.zeros((0, 4), np.float32)] * (views * n_images)
+    labels: List[np.ndarray] = [np.zeros(0, np.int64)] * (views * n_images)
+    loader = DataLoader(
+        dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers,
+        collate_fn=xray.utils.my_custom_collate
+    )
+    start = 0
+    with torch.no_grad():
+        for images, targets in loader:
+            images = xray.utils.images_to_device(images, device)
+            targets = [{'boxes': t['boxes'].float().to(device), 'labels': t['labels'].to(device)} for t in targets]
+            for view in range(views):
+                if view == 1:
+                    images, targets = hflip(images, targets)
+                image_list, transformed = model.transform(images, targets)
+                tensors = image_list.tensors
+                tensors = F.pad(tensors, (0, size - tensors.shape[-1], 0, size - tensors.shape[-2]))
+                features = model.backbone(tensors)
+
+                rows = range(view * n_images + start, view * n_images + start + len(images))
+                for level in levels:
+                    feature_maps[level][rows.start:rows.stop] = features[level].cpu().numpy()
+                image_sizes[rows.start:rows.stop] = image_list.image_sizes
+                for row, target in zip(rows, transformed):
+                    boxes[row] = target['boxes'].cpu().numpy()
+                    labels[row] = target['labels'].cpu().numpy()
+            start += len(images)
+            logger.info(f'Cached {start}/{n_images} images')
+
+    for feature_map in feature_maps.values():
+        feature_map.flush()
+    offsets = np.concatenate([[0], np.cumsum([len(b) for b in boxes])]).astype(np.int64)
+    index_path = os.path.join(directory, INDEX_FILE)
+    with open(index_path + '.tmp', 'wb') as f:
+        np.savez(
+            f,
+            image_ids=np.array(dataset.available_files),
+            image_size=image_size,
+            size=size,
+            views=views,
+            dtype=dtype,
+            levels=np.array(levels),
+            image_sizes=image_sizes,
+            offsets=offsets,
+            boxes=np.concatenate(boxes).astype(np.float32).reshape(-1, 4),
+            labels=np.concatenate(labels).astype(np.int64),
+            checksum=backbone_checksum(model)
+        )
+    os.replace(index_path + '.tmp', index_path)
+
+
+class FeatureCacheDataset:
+    """Cached FPN features of ``build_feature_cache`` with their transformed targets."""
+
+    def __init__(self, directory: str, flip_prob: float = 0.5):
+        index = np.load(os.path.join(directory, INDEX_FILE))
+        self.available_files = index['image_ids'].tolist()
+        self.size = int(index['size'])
+        self.views = int(index['views'])
+        self.levels = index['levels'].tolist()
+        self.image_sizes = index['image_sizes']
+        self.offsets = index['offsets']
+        self.boxes = index['boxes']
+        self.labels = index['labels']
+        self.feature_maps = {
+            level: np.load(os.path.join(directory, f'features_{level}.npy'), mmap_mode='r')
+            for level in self.levels
+        }
+        self.flip_prob = flip_prob if self.views == 2 else 0.0
+
+    def __len__(self):
+        return len(self.available_files)
+
+    def __getitem__(self, item):
+        # torch's RNG is seeded per DataLoader worker, numpy's is not.
+        view = int(torch.rand(()).item() < self.flip_prob)
+        row = view * len(self) + item
+        features = {
+            level: torch.from_numpy(np.array(self.feature_maps[level][row]))
+            for level in self.levels
+        }
+        start, end = self.offsets[row], self.offsets[row + 1]
+        return features, {
+            'boxes': torch.from_numpy(self.boxes[start:end]),
+            'labels': torch.from_numpy(self.labels[start:end]),
+            'image_size': tuple(self.image_sizes[row].tolist()),
+            'file_name': self.available_files[item]
+        }
+
+
+def collate(batch):
+    """Stack the feature maps of a batch per level (in the loader workers)."""
+    features, targets = zip(*batch)
+    stacked = OrderedDict((level, torch.stack([f[level] for f in features])) for level in features[0])
+    return (stacked, [target['image_size'] for target in targets]), list(targets)
+
+
+def batch_to_device(
+    batch: Tuple[Dict[str, torch.Tensor], List[Tuple[int, int]]],
+    targets: List[dict],
+    device: str
+):
+    features, image_sizes = batch
+    features = OrderedDict(
+        (level, feature.to(device, non_blocking=True).float()) for level, feature in features.items()
+    )
+    targets = [{
+        'boxes': target['boxes'].to(device),
+        'labels': target['labels'].to(device),
+        'file_name': target['file_name']
+    } for target in targets]
+    return (features, image_sizes), targets
+
+
+class DetectionHeads(torch.nn.Module):
+    """The RPN and ROI heads of ``model``, trained on cached backbone features."""
+
+    def __init__(self, model: FasterRCNN, size: int):
+        super().__init__()
+        self.rpn = model.rpn
+        self.roi_heads = model.roi_heads
+        self.size = size
+
+    def forward(self, batch, targets):
+        features, image_sizes = batch
+        first = next(iter(features.values()))
+        # The anchor generator only reads the shape of the padded image batch.
+        tensors = first.new_zeros(()).expand(len(image_sizes), 1, self.size, self.size)
+        images = ImageList(tensors, list(image_sizes))
+        proposals, proposal_losses = self.rpn(images, features, targets)
+        _, detector_losses = self.roi_heads(features, proposals, images.image_sizes, targets)
+        return {**detector_losses, **proposal_losses}
@@ -0,0 +1,205 @@
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from xray.annotations import AnnotationIndex
+
+IMAGES_FILE = 'images.u8'
+INDEX_FILE = 'index.npz'
+ANNOTATIONS_FILE = 'annotations.npz'
+
+
+def image_store_dir(root: str, mode: str = 'train', size: int = 1024) -> str:
+    return os.path.join(root, f'{mode}_store', str(size))
+
+
+def store_sizes(root: str, mode: str = 'train') -> List[int]:
+    """Sizes of the pyramid levels written for ``mode`` under ``root``, ascending."""
+    directory = os.path.join(root, f'{mode}_store')
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        int(name) for name in os.listdir(directory)
+        if name.isdigit() and os.path.exists(os.path.join(directory, name, INDEX_FILE))
+    )
+
+
+def select_size(root: str, mode: str = 'train', size: int = 1024) -> int:
+    """The smallest level of at least ``size``, or the largest level if all are smaller."""
+    sizes = store_sizes(root, mode)
+    if not sizes:
+        raise FileNotFoundError(f'No image store for {mode} in {root}')
+    larger = [level for level in sizes if level >= size]
+    return larger[0] if larger else sizes[-1]
+
+
+class ImageStoreWriter:
+    """Appends preprocessed uint8 images to a single contiguous file."""
+
+    def __init__(self, directory: str, append: bool = False):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+        self.image_ids: List[str] = []
+        self.offsets: List[int] = []
+        self.shapes: List[tuple] = []
+        self.original_shapes: List[tuple] = []
+        self.boxes: List[np.ndarray] = []
+        self.labels: List[np.ndarray] = []
+        self.rad_ids: List[np.ndarray] = []
+        self.positions: Dict[str, int] = {}
+
+        images_path = os.path.join(directory, IMAGES_FILE)
+        if append and os.path.exists(os.path.join(directory, INDEX_FILE)):
+            store = ImageStore(directory)
+            for position, image_id in enumerate(store.image_ids.tolist()):
+                boxes, labels, rad_ids = store.annotations.slice(position)
+                self._set(
+                    image_id, int(store.offsets[position]), tuple(store.shapes[position]),
+                    tuple(store.original_shapes[position]), boxes, labels, rad_ids
+                )
+            self.images_file = open(images_path, 'ab')
+            # Drop bytes of images that were written after the last flush.
+            self.images_file.truncate(store.end)
+        else:
+            self.images_file = open(images_path, 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def __contains__(self, image_id: str):
+        return image_id in self.positions
+
+    @property
+    def _columns(self):
+        return (
+            self.offsets, self.shapes, self.original_shapes, self.boxes, self.labels, self.rad_ids
+        )
+
+    def _set(self, image_id, offset, shape, original_shape, boxes, labels, rad_ids):
+        entry = (offset, shape, original_shape, boxes, labels, rad_ids)
+        if image_id in self.positions:
+            position = self.positions[image_id]
+        else:
+            position = len(self.image_ids)
+            self.positions[image_id] = position
+            self.image_ids.append(image_id)
+            for column in self._columns:
+                column.append(None)
+        for column, value in zip(self._columns, entry):
+            column[position] = value
+
+    def add(
+        self,
+        image_id: str,
+        image: np.ndarray,
+        boxes: Optional[np.ndarray] = None,
+        labels: Optional[np.ndarray] = None,
+        rad_ids: Optional[np.ndarray] = None,
+        original_shape: Optional[tuple] = None
+    ):
+        """Append ``image`` (2D uint8) with its boxes and the ``(height, width)`` of the source DICOM."""
+        if image.dtype != np.uint8 or image.ndim != 2:
+            raise ValueError(f'Expected a 2D uint8 image, got {image.dtype} with shape {image.shape}')
+        boxes = np.zeros((0, 4), dtype=np.float32) if boxes is None else boxes
+        labels = np.zeros(len(boxes), dtype=np.int8) if labels is None else labels
+        rad_ids = np.full(len(boxes), -1, dtype=np.int8) if rad_ids is None else rad_ids
+
+        self.images_file.seek(0, os.SEEK_END)
+        offset = self.images_file.tell()
+        self.images_file.write(np.ascontiguousarray(image).tobytes())
+        self._set(
+            image_id,
+            offset,
+            image.shape,
+            tuple(original_shape) if original_shape is not None else image.shape,
+            np.asarray(boxes, dtype=np.float32).reshape(-1, 4),
+            np.asarray(labels, dtype=np.int8),
+            np.asarray(rad_ids, dtype=np.int8)
+        )
+
+    def flush(self):
+        self.images_file.flush()
+        os.fsync(self.images_file.fileno())
+
+        tmp_path = os.path.join(self.directory, INDEX_FILE + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.savez(
+                f,
+                image_ids=np.array(self.image_ids, dtype=str),
+                offsets=np.array(self.offsets, dtype=np.int64),
+                shapes=np.array(self.shapes, dtype=np.int32).reshape(-1, 2),
+                original_shapes=np.array(self.original_shapes, dtype=np.int32).reshape(-1, 2),
+                end=np.int64(self.images_file.tell())
+            )
+        os.replace(tmp_path, os.path.join(self.directory, INDEX_FILE))
+
+        counts = np.array([len(b) for b in self.boxes], dtype=np.int64)
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        AnnotationIndex(
+            np.array(self.image_ids, dtype=str),
+            offsets,
+            np.concatenate(self.boxes) if self.boxes else np.zeros((0, 4), dtype=np.float32),
+            np.concatenate(self.labels) if self.labels else np.zeros(0, dtype=np.int8),
+            np.concatenate(self.rad_ids) if self.rad_ids else np.zeros(0, dtype=np.int8)
+        ).save(os.path.join(self.directory, ANNOTATIONS_FILE))
+
+    def close(self):
+        if not self.images_file.closed:
+            self.flush()
+            self.images_file.close()
+
+
+class ImageStore:
+    """Read side of :class:`ImageStoreWriter`, returning read-only memmap views."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        with np.load(os.path.join(directory, INDEX_FILE)) as index:
+            self.image_ids = index['image_ids']
+            self.offsets = index['offsets']
+            self.shapes = index['shapes']
+            self.original_shapes = index['original_shapes']
+            self.end = int(index['end'])
+        self.positions = {image_id: i for i, image_id in enumerate(self.image_ids.tolist())}
+        self.annotations = AnnotationIndex.load(os.path.join(directory, ANNOTATIONS_FILE))
+        self._images = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_images'] = None
+        state['_pid'] = None
+        return state
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def __contains__(self, image_id: str):
+        return image_id in self.positions
+
+    @property
+    def images(self) -> np.memmap:
+        if self._images is None or self._pid != os.getpid():
+            self._images = np.memmap(
+                os.path.join(self.directory, IMAGES_FILE), dtype=np.uint8, mode='r',
+                shape=(self.end,)
+            )
+            self._pid = os.getpid()
+        return self._images
+
+    def get(self, position: int) -> np.ndarray:
+        height, width = self.shapes[position]
+        offset = self.offsets[position]
+        return self.images[offset: offset + height * width].reshape(height, width)
+
+    def image(self, image_id: str) -> np.ndarray:
+        return self.get(self.positions[image_id])
@@ -0,0 +1,225 @@
+import argparse
+import csv
+import functools
+import logging
+import os
+from typing import Iterable, Optional, Set
+
+import numpy as np
+import pandas as pd
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader
+from torchvision.models.detection import FasterRCNN
+
+import xray.checkpoint
+import xray.evalutation
+import xray.utils
+from xray.data_preprocessing import decode_xray, resize_image
+from xray.image_store import ImageStore, image_store_dir, select_size
+from xray.predictions import DetectionBuffer, add_outputs, postprocess, to_submission
+from xray.prefetch import BatchPrefetcher
+
+COLUMNS = ('image_id', 'PredictionString')
+
+
+class ImageFolder:
+    """The ``.dicom`` / ``.dcm`` and ``.png`` images of a folder, for inference."""
+
+    def __init__(
+        self,
+        directory: str,
+        image_size: int = 1024,
+        channels: int = 3,
+        original_sizes: Optional[pd.DataFrame] = None,
+        skip: Iterable[str] = ()
+    ):
+        if channels not in [1, 3]:
+            raise KeyError('Channels need to be in [1, 3]')
+        skip = set(skip)
+        self.directory = directory
+        self.image_size = image_size
+        self.channels = channels
+        self.files = sorted(
+            f for f in os.listdir(directory)
+            if f.endswith(('.dicom', '.dcm', '.png')) and os.path.splitext(f)[0] not in skip
+        )
+        self.available_files = [os.path.splitext(f)[0] for f in self.files]
+        self.original_sizes = {} if original_sizes is None else {
+            image_id: (int(height), int(width)) for image_id, height, width
+            in zip(original_sizes.image_id, original_sizes.height, original_sizes.width)
+        }
+        # Boxes are scaled back to the DICOM, whose size a png does not tell.
+        missing = [
+            image_id for f, image_id in zip(self.files, self.available_files)
+            if f.endswith('.png') and image_id not in self.original_sizes
+        ]
+        if missing:
+            raise KeyError(f'No original size of {len(missing)} png images, e.g. {missing[0]}')
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, item):
+        path = os.path.join(self.directory, self.files[item])
+        if path.endswith('.png'):
+            image = resize_image(np.array(Image.open(path)), self.image_size)
+            original_shape = self.original_sizes[self.available_files[item]]
+        else:
+            image, original_shape = decode_xray(path, max_size=self.image_size)
+        return torch.from_numpy(np.stack([image] * self.channels, axis=0)), {
+            'file_name': self.available_files[item], 'original_shape': tuple(original_shape)
+        }
+
+
+class StoreImages:
+    """The test images of the image store under ``database_dir``, for inference."""
+
+    def __init__(self, database_dir: str, image_size: int = 1024, channels: int = 3, skip: Iterable[str] = ()):
+        if channels not in [1, 3]:
+            raise KeyError('Channels need to be in [1, 3]')
+        skip = set(skip)
+        self.image_size = image_size
+        self.channels = channels
+        self.store_size = select_size(database_dir, 'test', image_size)
+        self.store = ImageStore(image_store_dir(database_dir, 'test', self.store_size))
+        self.positions = np.array(
+            [i for i, image_id in enumerate(self.store.image_ids.tolist()) if image_id not in skip], dtype=np.int64
+        )
+        self.available_files = self.store.image_ids[self.positions].tolist()
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, item):
+        position = self.positions[item]
+        image = self.store.get(position)
+        if self.store_size != self.image_size:
+            image = resize_image(image, self.image_size)
+        return torch.from_numpy(np.stack([image] * self.channels, axis=0)), {
+            'file_name': self.available_files[item],
+            'original_shape': tuple(self.store.original_shapes[position].tolist())
+        }
+
+
+def load_model(path: str, channels: int = 3, image_size: Optional[int] = None) -> FasterRCNN:
+    """Weights of ``best_model_rcnn.cfg``, a checkpoint of ``CheckpointManager`` or a run folder."""
+    if os.path.isdir(path):
+        path = os.path.join(path, xray.checkpoint.BEST_MODEL)
+    state = torch.load(path, map_location='cpu')
+    if 'model' in state and 'optimizer' in state:
+        state = state['model']
+    model = xray.evalutation.build_rcnn(channels, image_size)
+    model.load_state_dict(state)
+    return model
+
+
+def finished_images(path: str) -> Set[str]:
+    """Images already written to ``path`` by an earlier, interrupted run."""
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'rb+') as f:
+        content = f.read()
+        end = content.rfind(b'\n') + 1
+        if end < len(content):
+            f.truncate(end)
+    with open(path, newline='') as f:
+        rows = list(csv.reader(f))
+    return set(row[0] for row in rows[1:] if row)
+
+
+def _images_to_device(images, targets, device: str):
+    return xray.utils.images_to_device(images, device), targets
+
+
+def run_inference(
+    model: torch.nn.Module,
+    dataset,
+    output: str,
+    batch_size: int = 8,
+    num_workers: int = 2,
+    device: str = 'cpu',
+    precision: str = 'fp32',
+    score_threshold: float = 0.5,
+    prefetch_depth: int = 2,
+    per_class_nms: bool = True,
+    logger: Optional[logging.Logger] = None
+) -> int:
+    """Predict every image of ``dataset`` and append its row to the csv ``output``."""
+    logger = logger if logger is not None else logging.getLogger(__name__)
+    model = model.to(device)
+    model.eval()
+    loader = DataLoader(
+        dataset,
+        shuffle=False,
+        num_workers=num_workers,
+        batch_size=batch_size,
+        collate_fn=xray.utils.my_custom_collate,
+        pin_memory=torch.device(device).type == 'cuda'
+    )
+    batches = BatchPrefetcher(
+        loader, device, prefetch_depth, functools.partial(_images_to_device, device=device)
+    )
+    write_header = not os.path.exists(output) or os.path.getsize(output) == 0
+    written = 0
+    with open(output, 'a', newline='') as f, torch.no_grad():
+        writer = csv.writer(f)
+        if write_header:
+            writer.writerow(COLUMNS)
+        for i, (images, targets) in enumerate(batches):
+            with xray.utils.autocast(device, precision):
+                results = model(images)
+            predictions = DetectionBuffer(len(results))
+            add_outputs(
+                predictions, [target['file_name'] for target in targets], results,
+                [image.shape[-2:] for image in images], score_threshold
+            )
+            predictions = postprocess(
+                predictions, np.array([target['original_shape'] for target in targets]), per_class=per_class_nms
+            )
+            writer.writerows(to_submission(predictions).itertuples(index=False))
+            f.flush()
+            written += len(predictions)
+            if (i + 1) % 10 == 0 or written == len(dataset):
+                logger.info(f'Predicted {written}/{len(dataset)} images')
+    return written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint-path', type=str, required=True,
+                        help='best_model_rcnn.cfg, a checkpoint of --keep-checkpoints or a run folder')
+    parser.add_argument('--output', type=str, required=True, help='Submission csv, continued if it exists')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--image-dir', type=str, help='Folder of .dicom / .dcm or .png test images')
+    source.add_argument('--store', type=str, help='Folder with the test image store of data_preprocessing.py')
+    parser.add_argument('--sizes-csv', type=str, default=None,
+                        help='test.csv with the original sizes of png images, required for them')
+    parser.add_argument('--image-size', default=1024, type=int)
+    parser.add_argument('--channels', default=3, type=int, choices=[1, 3])
+    parser.add_argument('--batch-size', default=8, type=int)
+    parser.add_argument('--n-workers', default=2, type=int)
+    parser.add_argument('--device', default='cpu', type=str)
+    parser.add_argument('--precision', default='fp32', type=str, choices=list(xray.utils.PRECISIONS))
+    parser.add_argument('--score-threshold', default=0.5, type=float)
+    parser.add_argument('--prefetch-depth', default=2, type=int)
+    parser.add_argument('--class-agnostic-nms', action='store_true',
+                        help='Let boxes of different classes suppress each other')
+    args = parser.parse_args()
+
+    logger = xray.utils.define_logger('Inference', filehandler=False)
+    logger.setLevel(logging.INFO)
+    done = finished_images(args.output)
+    if done:
+        logger.info(f'Continuing {args.output}, {len(done)} images are already predicted')
+    if args.store is not None:
+        dataset = StoreImages(args.store, args.image_size, args.channels, skip=done)
+    else:
+        sizes = pd.read_csv(args.sizes_csv) if args.sizes_csv is not None else None
+        dataset = ImageFolder(args.image_dir, args.image_size, args.channels, sizes, skip=done)
+
+    model = load_model(args.checkpoint_path, args.channels, args.image_size)
+    run_inference(
+        model, dataset, args.output, args.batch_size, args.n_workers, args.device, args.precision,
+        args.score_threshold, args.prefetch_depth, not args.class_agnostic_nms, logger
+    )
@@ -0,0 +1,201 @@
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from xray.predictions import DetectionBuffer
+
+IOU_THRESHOLD = 0.4
+MAX_DETECTIONS = 100
+RECALL_THRESHOLDS = np.linspace(0.0, 1.0, 101)
+AREA_RANGE = (0.0, 1e5 ** 2)
+
+
+class MAPResult(NamedTuple):
+    map: float
+    class_ap: Dict[int, float]
+
+
+def box_iou(boxes: np.ndarray, other: np.ndarray, coco_boxes: bool = True) -> np.ndarray:
+    """IoU matrix of two sets of boxes, computed as ``pycocotools`` does."""
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    other = np.asarray(other, dtype=np.float64).reshape(-1, 4)
+    if coco_boxes:
+        # VinBigDataEval hands xyxy boxes to COCO, which reads them as xywh.
+        x0, y0, w, h = boxes.T
+        ox0, oy0, ow, oh = other.T
+        x1, y1, ox1, oy1 = x0 + w, y0 + h, ox0 + ow, oy0 + oh
+    else:
+        x0, y0, x1, y1 = boxes.T
+        ox0, oy0, ox1, oy1 = other.T
+        w, h, ow, oh = x1 - x0, y1 - y0, ox1 - ox0, oy1 - oy0
+    widths = np.minimum(x1[:, None], ox1[None]) - np.maximum(x0[:, None], ox0[None])
+    heights = np.minimum(y1[:, None], oy1[None]) - np.maximum(y0[:, None], oy0[None])
+    intersection = np.maximum(widths, 0) * np.maximum(heights, 0)
+    return intersection / ((w * h)[:, None] + (ow * oh)[None] - intersection)
+
+
+def match(
+    ious: np.ndarray,
+    iou_threshold: float = IOU_THRESHOLD,
+    det_ids: Optional[np.ndarray] = None,
+    gt_ids: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """Which detections (rows, by decreasing score) are true positives, as in ``COCOeval.evaluateImg``."""
+    threshold = min(iou_threshold, 1 - 1e-10)
+    matched = np.zeros(ious.shape[1], dtype=bool)
+    true_positives = np.zeros(ious.shape[0], dtype=bool)
+    for i, row in enumerate(ious):
+        row = np.where(matched, -1.0, row)
+        # Of equal overlaps the last box; COCO records matches by id, so id 0 reads as unmatched.
+        best = len(row) - 1 - np.argmax(row[::-1])
+        if row[best] >= threshold:
+            matched[best] = det_ids is None or det_ids[i] != 0
+            true_positives[i] = gt_ids is None or gt_ids[best] != 0
+    return true_positives
+
+
+def precision_at_recalls(true_positives: np.ndarray, n_ground_truth: int) -> np.ndarray:
+    """Interpolated precision at ``RECALL_THRESHOLDS``, of detections sorted by decreasing score."""
+    tp = np.cumsum(true_positives).astype(float)
+    fp = np.cumsum(~true_positives).astype(float)
+    recall = tp / n_ground_truth
+    precision = tp / (fp + tp + np.spacing(1))
+    # The precision envelope: the best precision at any higher recall.
+    precision = np.maximum.accumulate(precision[::-1])[::-1]
+    positions = np.searchsorted(recall, RECALL_THRESHOLDS, side='left')
+    found = positions < len(precision)
+    result = np.zeros(len(RECALL_THRESHOLDS))
+    result[found] = precision[positions[found]]
+    return result
+
+
+def _match_class(
+    det_image: np.ndarray,
+    det_boxes: np.ndarray,
+    det_scores: np.ndarray,
+    det_ids: np.ndarray,
+    gt_image: np.ndarray,
+    gt_boxes: np.ndarray,
+    gt_ids: np.ndarray,
+    iou_threshold: float,
+    max_detections: int,
+    coco_compatible: bool
+):
+    """Scores, true positive flags, images and ids of the detections of one class that count."""
+    # Detections by image, then decreasing score; ties keep their order, as COCO's mergesort.
+    order = np.lexsort((det_ids, -det_scores, det_image))
+    det_image, det_boxes, det_scores, det_ids = (a[order] for a in (det_image, det_boxes, det_scores, det_ids))
+    rank = np.arange(len(det_image)) - np.searchsorted(det_image, det_image, side='left')
+    keep = rank < max_detections
+    det_image, det_boxes, det_scores, det_ids = (a[keep] for a in (det_image, det_boxes, det_scores, det_ids))
+
+    gt_order = np.argsort(gt_image, kind='stable')
+    gt_image, gt_boxes, gt_ids = gt_image[gt_order], gt_boxes[gt_order], gt_ids[gt_order]
+    true_positives = np.zeros(len(det_image), dtype=bool)
+    for image in np.intersect1d(det_image, gt_image):
+        dets = slice(*np.searchsorted(det_image, [image, image + 1]))
+        gts = slice(*np.searchsorted(gt_image, [image, image + 1]))
+        true_positives[dets] = match(
+            box_iou(det_boxes[dets], gt_boxes[gts], coco_compatible), iou_threshold,
+            *((det_ids[dets], gt_ids[gts]) if coco_compatible else ())
+        )
+
+    # Unmatched detections outside COCO's area range 'all' (with a negative area) are ignored.
+    areas = (det_boxes[:, 2] - det_boxes[:, 0]) * (det_boxes[:, 3] - det_boxes[:, 1])
+    counted = true_positives | ((areas >= AREA_RANGE[0]) & (areas <= AREA_RANGE[1]))
+    return det_scores[counted], true_positives[counted], det_image[counted], det_ids[counted]
+
+
+class OnlineMAPEvaluator:
+    """``evaluate`` fed batch by batch."""
+
+    def __init__(
+        self,
+        iou_threshold: float = IOU_THRESHOLD,
+        max_detections: int = MAX_DETECTIONS,
+        coco_compatible: bool = True,
+        shard: int = 0
+    ):
+        self.iou_threshold = iou_threshold
+        self.max_detections = max_detections
+        self.coco_compatible = coco_compatible
+        self.n_images = 0
+        # Annotation ids are rows counted from 0 in the first shard, from 1 in the others.
+        self.n_predictions = 0 if shard == 0 else 1
+        self.n_targets = 0 if shard == 0 else 1
+        self.ground_truth: Dict[int, int] = {}
+        self.detections: Dict[int, List[Tuple[np.ndarray, ...]]] = {}
+
+    def update(self, predictions: DetectionBuffer, targets: DetectionBuffer):
+        """Add the images of ``targets``, with the ``predictions`` that belong to them."""
+        gt_image = targets.image_index()
+        positions = pd.Index(targets.image_ids).get_indexer(predictions.image_ids)
+        det_image = positions[predictions.image_index()]
+        has_ground_truth = np.bincount(gt_image, minlength=len(targets)) > 0
+        evaluated = (det_image >= 0) & has_ground_truth[np.maximum(det_image, 0)]
+
+        for label in np.union1d(targets.labels, predictions.labels[evaluated]).tolist():
+            gts = targets.labels == label
+            dets = evaluated & (predictions.labels == label)
+            self.ground_truth[label] = self.ground_truth.get(label, 0) + int(gts.sum())
+            if not dets.any():
+                continue
+            scores, true_positives, images, ids = _match_class(
+                det_image[dets], predictions.boxes[dets], predictions.scores[dets],
+                np.flatnonzero(dets) + self.n_predictions, gt_image[gts], targets.boxes[gts],
+                np.flatnonzero(gts) + self.n_targets, self.iou_threshold, self.max_detections,
+                self.coco_compatible
+            )
+            self.detections.setdefault(label, []).append((scores, true_positives, images + self.n_images, ids))
+
+        self.n_images += len(targets)
+        self.n_predictions += predictions.n_rows
+        self.n_targets += targets.n_rows
+
+    def result(self) -> MAPResult:
+        """The mean over classes with ground truth boxes of their AP."""
+        classes = sorted(label for label, count in self.ground_truth.items() if count > 0)
+        precision = np.zeros((len(RECALL_THRESHOLDS), len(classes)))
+        for k, label in enumerate(classes):
+            chunks = self.detections.get(label, [])
+            scores, true_positives, images, ids = (
+                np.concatenate(arrays) for arrays in zip(*chunks)
+            ) if chunks else (np.zeros(0),) * 4
+            # Decreasing score, then image order and detection order, as COCOeval.accumulate.
+            order = np.lexsort((ids, images, -scores))
+            precision[:, k] = precision_at_recalls(true_positives[order].astype(bool), self.ground_truth[label])
+        return MAPResult(
+            map=float(precision.mean()) if classes else -1.0,
+            class_ap=dict(zip(classes, precision.mean(axis=0).tolist()))
+        )
+
+    @classmethod
+    def concatenate(cls, evaluators: Sequence['OnlineMAPEvaluator']) -> 'OnlineMAPEvaluator':
+        first = evaluators[0]
+        result = cls(first.iou_threshold, first.max_detections, first.coco_compatible)
+        for evaluator in evaluators:
+            for label, count in evaluator.ground_truth.items():
+                result.ground_truth[label] = result.ground_truth.get(label, 0) + count
+            for label, chunks in evaluator.detections.items():
+                result.detections.setdefault(label, []).extend(
+                    (scores, true_positives, images + result.n_images, ids + result.n_predictions)
+                    for scores, true_positives, images, ids in chunks
+                )
+            result.n_images += evaluator.n_images
+            result.n_predictions += evaluator.n_predictions
+            result.n_targets += evaluator.n_targets
+        return result
+
+
+def evaluate(
+    predictions: DetectionBuffer,
+    targets: DetectionBuffer,
+    iou_threshold: float = IOU_THRESHOLD,
+    max_detections: int = MAX_DETECTIONS,
+    coco_compatible: bool = True
+) -> MAPResult:
+    """Mean over classes of the AP at ``iou_threshold``, the same number as ``VinBigDataEval``."""
+    evaluator = OnlineMAPEvaluator(iou_threshold, max_detections, coco_compatible)
+    evaluator.update(predictions, targets)
+    return evaluator.result()
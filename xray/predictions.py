@@ -0,0 +1,293 @@
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+import torch
+import torchvision
+
+NO_FINDING_BOX = np.array([0, 0, 1, 1], dtype=np.float32)
+
+
+def _grown(array: np.ndarray, size: int) -> np.ndarray:
+    grown = np.zeros((size,) + array.shape[1:], dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+class DetectionBuffer:
+    """Boxes, labels and optionally scores of a set of images, in preallocated numpy arrays."""
+
+    def __init__(self, n_images: int = 0, per_image: int = 8, with_scores: bool = True):
+        self.image_ids: List[str] = []
+        self.offsets = np.zeros(max(n_images, 1) + 1, dtype=np.int64)
+        self._shapes = np.zeros((max(n_images, 1), 2), dtype=np.int64)
+        rows = max(n_images * per_image, 1)
+        self._boxes = np.zeros((rows, 4), dtype=np.float32)
+        self._labels = np.zeros(rows, dtype=np.int64)
+        self._scores = np.zeros(rows, dtype=np.float32) if with_scores else None
+
+    @property
+    def with_scores(self) -> bool:
+        return self._scores is not None
+
+    @property
+    def n_rows(self) -> int:
+        return int(self.offsets[len(self)])
+
+    @property
+    def shapes(self) -> np.ndarray:
+        return self._shapes[:len(self)]
+
+    @property
+    def boxes(self) -> np.ndarray:
+        return self._boxes[:self.n_rows]
+
+    @property
+    def labels(self) -> np.ndarray:
+        return self._labels[:self.n_rows]
+
+    @property
+    def scores(self) -> Optional[np.ndarray]:
+        return self._scores[:self.n_rows] if self.with_scores else None
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def _reserve(self, images: int, rows: int):
+        if len(self) + images >= len(self.offsets):
+            self.offsets = _grown(self.offsets, max(len(self) + images + 1, 2 * len(self.offsets)))
+            self._shapes = _grown(self._shapes, len(self.offsets) - 1)
+        needed = self.n_rows + rows
+        if needed > len(self._labels):
+            capacity = max(needed, 2 * len(self._labels))
+            self._boxes = _grown(self._boxes, capacity)
+            self._labels = _grown(self._labels, capacity)
+            if self.with_scores:
+                self._scores = _grown(self._scores, capacity)
+
+    def extend(
+        self,
+        image_ids: Sequence[str],
+        counts: Sequence[int],
+        boxes: np.ndarray,
+        labels: np.ndarray,
+        scores: Optional[np.ndarray] = None,
+        shapes: Optional[np.ndarray] = None
+    ):
+        """Add images whose rows are consecutive in the arrays, ``counts[i]`` rows for image ``i``."""
+        counts = np.asarray(counts, dtype=np.int64)
+        self._reserve(len(image_ids), int(counts.sum()))
+        start, n = self.n_rows, len(self)
+        end = start + len(labels)
+        self._boxes[start:end] = np.asarray(boxes).reshape(-1, 4)
+        self._labels[start:end] = labels
+        if self.with_scores:
+            self._scores[start:end] = scores
+        if shapes is not None:
+            self._shapes[n:n + len(image_ids)] = shapes
+        self.offsets[n + 1:n + 1 + len(image_ids)] = start + np.cumsum(counts)
+        self.image_ids.extend(image_ids)
+
+    def add(
+        self,
+        image_id: str,
+        boxes: np.ndarray,
+        labels: np.ndarray,
+        scores: Optional[np.ndarray] = None,
+        shape: Optional[Sequence[int]] = None
+    ):
+        self.extend([image_id], [len(labels)], boxes, labels, scores, None if shape is None else [shape])
+
+    def append(self, other: 'DetectionBuffer'):
+        """Add the images of ``other``."""
+        self.extend(
+            other.image_ids, np.diff(other.offsets[:len(other) + 1]), other.boxes, other.labels,
+            other.scores if self.with_scores else None, other.shapes
+        )
+
+    def slice_images(self, start: int, stop: int) -> 'DetectionBuffer':
+        """A buffer of the images ``start:stop``."""
+        rows = slice(self.offsets[start], self.offsets[stop])
+        result = type(self)(stop - start, per_image=0, with_scores=self.with_scores)
+        result.extend(
+            self.image_ids[start:stop], np.diff(self.offsets[start:stop + 1]), self.boxes[rows],
+            self.labels[rows], self.scores[rows] if self.with_scores else None, self.shapes[start:stop]
+        )
+        return result
+
+    def image_index(self) -> np.ndarray:
+        """The image of every row."""
+        return np.repeat(np.arange(len(self)), np.diff(self.offsets[:len(self) + 1]))
+
+    def take(self, rows: np.ndarray) -> 'DetectionBuffer':
+        """A buffer of the same images with only ``rows``, which have to be ordered by image."""
+        rows = np.asarray(rows, dtype=np.int64)
+        result = type(self)(len(self), per_image=0, with_scores=self.with_scores)
+        result.extend(
+            self.image_ids, np.bincount(self.image_index()[rows], minlength=len(self)), self.boxes[rows],
+            self.labels[rows], self.scores[rows] if self.with_scores else None, self.shapes
+        )
+        return result
+
+    def replace(
+        self,
+        boxes: Optional[np.ndarray] = None,
+        labels: Optional[np.ndarray] = None,
+        scores: Optional[np.ndarray] = None,
+        shapes: Optional[np.ndarray] = None
+    ) -> 'DetectionBuffer':
+        """A buffer of the same images and rows with some of the columns replaced."""
+        result = type(self)(len(self), per_image=0, with_scores=self.with_scores)
+        result.extend(
+            self.image_ids,
+            np.diff(self.offsets[:len(self) + 1]),
+            self.boxes if boxes is None else boxes,
+            self.labels if labels is None else labels,
+            self.scores if scores is None else scores,
+            self.shapes if shapes is None else shapes
+        )
+        return result
+
+    def __getitem__(self, item: int) -> dict:
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError(f'Image {item} is not in the buffer of {len(self)} images')
+        start, end = self.offsets[item], self.offsets[item + 1]
+        detections = {'boxes': self._boxes[start:end], 'labels': self._labels[start:end]}
+        if self.with_scores:
+            detections['scores'] = self._scores[start:end]
+        detections['file_name'] = self.image_ids[item]
+        return detections
+
+    def __iter__(self) -> Iterator[dict]:
+        for item in range(len(self)):
+            yield self[item]
+
+    def __getstate__(self):
+        # Only the used rows are pickled (and sent between processes).
+        return dict(
+            image_ids=self.image_ids,
+            offsets=self.offsets[:len(self) + 1],
+            shapes=self.shapes,
+            boxes=self.boxes,
+            labels=self.labels,
+            scores=self.scores
+        )
+
+    def __setstate__(self, state):
+        self.image_ids = state['image_ids']
+        self.offsets = state['offsets']
+        self._shapes = state['shapes']
+        self._boxes = state['boxes']
+        self._labels = state['labels']
+        self._scores = state['scores']
+
+    @classmethod
+    def concatenate(cls, buffers: Sequence['DetectionBuffer']) -> 'DetectionBuffer':
+        with_scores = all(buffer.with_scores for buffer in buffers)
+        result = cls(sum(len(b) for b in buffers), per_image=0, with_scores=with_scores)
+        for buffer in buffers:
+            result.append(buffer)
+        return result
+
+
+def add_outputs(
+    buffer: DetectionBuffer,
+    image_ids: Sequence[str],
+    outputs: List[Dict[str, torch.Tensor]],
+    shapes: Sequence[Sequence[int]],
+    score_threshold: float = 0.0
+):
+    """Add the detections above ``score_threshold`` of a batch of Faster R-CNN ``outputs``."""
+    device = outputs[0]['scores'].device
+    image_index = torch.repeat_interleave(
+        torch.arange(len(outputs), device=device),
+        torch.tensor([len(output['scores']) for output in outputs], dtype=torch.int64, device=device)
+    )
+    scores = torch.cat([output['scores'] for output in outputs]).float()
+    keep = scores > score_threshold
+    buffer.extend(
+        image_ids,
+        np.bincount(image_index[keep].cpu().numpy(), minlength=len(outputs)),
+        torch.cat([output['boxes'] for output in outputs]).float()[keep].cpu().numpy(),
+        torch.cat([output['labels'] for output in outputs])[keep].cpu().numpy(),
+        scores[keep].cpu().numpy(),
+        np.asarray(shapes, dtype=np.int64).reshape(-1, 2)
+    )
+
+
+def fill_no_findings(predictions: DetectionBuffer) -> DetectionBuffer:
+    """Set "No finding" rows to box ``0 0 1 1`` and score 1, and add one to images without detections."""
+    starts = predictions.offsets[:len(predictions)]
+    empty = np.diff(predictions.offsets[:len(predictions) + 1]) == 0
+    boxes = np.insert(predictions.boxes, starts[empty], NO_FINDING_BOX, axis=0)
+    labels = np.insert(predictions.labels, starts[empty], 0)
+    scores = np.insert(predictions.scores, starts[empty], 1.0)
+    no_finding = labels == 0
+    boxes[no_finding] = NO_FINDING_BOX
+    scores[no_finding] = 1.0
+
+    result = DetectionBuffer(len(predictions), per_image=0)
+    counts = np.diff(predictions.offsets[:len(predictions) + 1]) + empty
+    result.extend(predictions.image_ids, counts, boxes, labels, scores, predictions.shapes)
+    return result
+
+
+def original_shapes(image_ids: Sequence[str], data_desc: pd.DataFrame) -> np.ndarray:
+    """``(height, width)`` of every image in ``image_ids``, joined from a frame like ``test.csv``."""
+    sizes = data_desc.drop_duplicates('image_id').set_index('image_id')
+    positions = sizes.index.get_indexer(list(image_ids))
+    if (positions < 0).any():
+        missing = [image_id for image_id, position in zip(image_ids, positions) if position < 0]
+        raise KeyError(f'No original size for {len(missing)} images, e.g. {missing[:3]}')
+    return sizes[['height', 'width']].values[positions].astype(np.int64)
+
+
+def rescale_to_original_size(predictions: DetectionBuffer, shapes: np.ndarray) -> DetectionBuffer:
+    """Scale the boxes from ``predictions.shapes`` to the ``(height, width)`` in ``shapes``."""
+    if (predictions.shapes == 0).any():
+        raise ValueError('The predictions do not know the shapes of their images')
+    scale = np.asarray(shapes, dtype=np.float64)[:, ::-1] / predictions.shapes[:, ::-1]
+    rows = predictions.image_index()
+    boxes = predictions.boxes * np.tile(scale, 2)[rows]
+    boxes = np.where(predictions.labels[:, None] == 0, predictions.boxes, boxes)
+    return predictions.replace(boxes=boxes, shapes=shapes)
+
+
+def nms(predictions: DetectionBuffer, iou_threshold: float = 0.4, per_class: bool = True) -> DetectionBuffer:
+    """Non-maximum suppression of all images in one ``batched_nms`` call."""
+    groups = predictions.image_index()
+    if per_class:
+        groups = groups * (int(predictions.labels.max(initial=0)) + 1) + predictions.labels
+    # float64: batched_nms may offset the boxes of every group by the largest coordinate.
+    keep = torchvision.ops.batched_nms(
+        torch.from_numpy(predictions.boxes.astype(np.float64)),
+        torch.from_numpy(predictions.scores.astype(np.float64)),
+        torch.from_numpy(groups),
+        iou_threshold
+    ).numpy()
+    # Sorted by decreasing score, which the stable sort keeps within every image.
+    return predictions.take(keep[np.argsort(predictions.image_index()[keep], kind='stable')])
+
+
+def postprocess(
+    predictions: DetectionBuffer, shapes: np.ndarray, iou_threshold: float = 0.4, per_class: bool = True
+) -> DetectionBuffer:
+    """The submission post-processing: "No finding" rows, original sizes, then NMS."""
+    return nms(rescale_to_original_size(fill_no_findings(predictions), shapes), iou_threshold, per_class)
+
+
+def to_submission(predictions: DetectionBuffer) -> pd.DataFrame:
+    """``image_id`` / ``PredictionString`` rows with the class ids of ``train.csv``."""
+    labels = np.where(predictions.labels == 0, 14, predictions.labels - 1)
+    rows = [
+        f'{label} {score:.4f} {x0:.1f} {y0:.1f} {x1:.1f} {y1:.1f}'
+        for label, score, (x0, y0, x1, y1)
+        in zip(labels.tolist(), predictions.scores.tolist(), predictions.boxes.tolist())
+    ]
+    offsets = predictions.offsets[:len(predictions) + 1].tolist()
+    return pd.DataFrame({
+        'image_id': predictions.image_ids,
+        'PredictionString': [' '.join(rows[start:end]) for start, end in zip(offsets[:-1], offsets[1:])]
+    })
@@ -0,0 +1,127 @@
+import queue
+import threading
+import time
+from typing import Any, Callable, Iterable, Optional
+
+import torch
+
+_END = object()
+
+
+def to_device(value: Any, device: str, non_blocking: bool = True) -> Any:
+    """Move every tensor in a (nested) batch to ``device``, other values are kept."""
+    if isinstance(value, torch.Tensor):
+        return value.to(device, non_blocking=non_blocking)
+    if isinstance(value, dict):
+        return type(value)((key, to_device(v, device, non_blocking)) for key, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return type(value)(to_device(v, device, non_blocking) for v in value)
+    return value
+
+
+def _record_stream(value: Any, stream: 'torch.cuda.Stream'):
+    if isinstance(value, torch.Tensor):
+        if value.is_cuda:
+            value.record_stream(stream)
+    elif isinstance(value, dict):
+        for v in value.values():
+            _record_stream(v, stream)
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            _record_stream(v, stream)
+
+
+class BatchPrefetcher:
+    """Iterates ``loader`` while a background thread prepares the next ``depth`` batches."""
+
+    def __init__(
+        self,
+        loader: Iterable,
+        device: str = 'cpu',
+        depth: int = 2,
+        prepare: Optional[Callable] = None,
+        synchronize: bool = False
+    ):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = depth
+        self.prepare = prepare if prepare is not None else self._to_device
+        self.synchronize = synchronize
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        self.last_prepare_time = None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _to_device(self, images, targets):
+        return to_device(images, self.device), to_device(targets, self.device)
+
+    def _prepare(self, batch):
+        start = time.perf_counter()
+        event = None
+        if self.stream is None:
+            prepared = self.prepare(*batch)
+        else:
+            with torch.cuda.stream(self.stream):
+                prepared = self.prepare(*batch)
+                event = torch.cuda.Event()
+                event.record(self.stream)
+            if self.synchronize:
+                event.synchronize()
+        return prepared, event, time.perf_counter() - start
+
+    def _ready(self, prepared, event):
+        if event is not None:
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_event(event)
+            # Keeps the caching allocator from reusing the side stream's memory too early.
+            _record_stream(prepared, stream)
+        return prepared
+
+    def __iter__(self):
+        if self.depth <= 0:
+            for batch in self.loader:
+                prepared, event, self.last_prepare_time = self._prepare(batch)
+                yield self._ready(prepared, event)
+            return
+
+        items = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._fill, args=(items, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = items.get()
+                if item is _END:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                prepared, event, self.last_prepare_time = item
+                yield self._ready(prepared, event)
+        finally:
+            # Also when the loop stops early: unblock the thread and let it finish.
+            stop.set()
+            while thread.is_alive():
+                try:
+                    items.get_nowait()
+                except queue.Empty:
+                    pass
+                thread.join(timeout=0.01)
+
+    def _fill(self, items: queue.Queue, stop: threading.Event):
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    items.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        try:
+            for batch in self.loader:
+                if not put(self._prepare(batch)):
+                    return
+            put(_END)
+        except Exception as e:
+            put(e)
@@ -0,0 +1,163 @@
+import contextlib
+import csv
+import json
+import logging
+import os
+import time
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+import torch
+
+STEP_STAGES = ('data_wait', 'h2d', 'augmentation', 'forward', 'backward', 'optimizer')
+SAMPLE_STAGES = ('decode', 'augmentation', 'annotations', 'filter')
+PERCENTILES = (50, 90, 99)
+
+
+class SampleTimer:
+    """Stage times of one dataset ``__getitem__`` call, passed on in the target."""
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.timings = {}
+
+    @contextlib.contextmanager
+    def __call__(self, stage: str):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage] = self.timings.get(stage, 0.0) + time.perf_counter() - start
+
+
+class PipelineProfiler:
+    """Per-step stage times of the training and evaluation loops."""
+
+    def __init__(self, enabled: bool = False, device: str = 'cpu'):
+        self.enabled = enabled
+        self.device = torch.device(device)
+        self.epoch = 0
+        self.steps: List[Dict[str, float]] = []
+        self.samples: List[Dict[str, float]] = []
+        self._current = None
+
+    def _synchronize(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    def iterate(self, loader: Iterable, phase: str = 'train') -> Iterator:
+        if not self.enabled:
+            yield from loader
+            return
+        iterator = iter(loader)
+        step = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            targets = batch[1]
+            self._current = dict(
+                phase=phase, epoch=self.epoch, step=step, images=len(targets),
+                data_wait=time.perf_counter() - start
+            )
+            if getattr(loader, 'last_prepare_time', None) is not None:
+                self._current['h2d'] = loader.last_prepare_time
+            self.samples.extend(
+                dict(phase=phase, epoch=self.epoch, **target['timings'])
+                for target in targets if isinstance(target, dict) and 'timings' in target
+            )
+            try:
+                yield batch
+            except GeneratorExit:
+                # The loop stopped before using the batch.
+                self._current = None
+                raise
+            self._synchronize()
+            self._current['step_time'] = time.perf_counter() - start
+            self.steps.append(self._current)
+            self._current = None
+            step += 1
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        if not self.enabled or self._current is None:
+            yield
+            return
+        self._synchronize()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._synchronize()
+            self._current[name] = self._current.get(name, 0.0) + time.perf_counter() - start
+
+    def summary(self, phase: Optional[str] = None, epoch: Optional[int] = None) -> dict:
+        """Images/sec, step and sample stage percentiles (in ms) and their share of the step time."""
+        def selected(record):
+            return (phase is None or record['phase'] == phase) and (epoch is None or record['epoch'] == epoch)
+
+        steps = [step for step in self.steps if selected(step)]
+        samples = [sample for sample in self.samples if selected(sample)]
+        if not steps:
+            return {}
+        step_time = np.array([step['step_time'] for step in steps])
+        data_wait = np.array([step['data_wait'] for step in steps])
+        return dict(
+            steps=len(steps),
+            images=int(sum(step['images'] for step in steps)),
+            images_per_sec=sum(step['images'] for step in steps) / step_time.sum(),
+            # Waiting for data longer than everything else means the loader is the bottleneck.
+            bound='loader' if data_wait.sum() > (step_time - data_wait).sum() else 'compute',
+            stages=_stage_stats(steps, ('step_time',) + STEP_STAGES, step_time.sum()),
+            samples=_stage_stats(samples, SAMPLE_STAGES)
+        )
+
+    def log(self, logger: logging.Logger, phase: str):
+        summary = self.summary(phase, self.epoch)
+        if not summary:
+            return
+        logger.info(
+            f'Profile of {phase} in Ep {self.epoch}: {summary["images_per_sec"]:.1f} images/sec, '
+            f'{summary["bound"]} bound'
+        )
+        for kind in ['stages', 'samples']:
+            for stage, stats in summary[kind].items():
+                logger.info(
+                    f'    {stage:>12}: ' + ', '.join(f'{key} {value:.2f}' for key, value in stats.items())
+                )
+
+    def write(self, folder: str):
+        """Write ``profile_steps.csv``, ``profile_samples.csv`` and ``profile_summary.json``."""
+        _write_csv(os.path.join(folder, 'profile_steps.csv'), self.steps)
+        _write_csv(os.path.join(folder, 'profile_samples.csv'), self.samples)
+        phases = sorted(set(step['phase'] for step in self.steps))
+        with open(os.path.join(folder, 'profile_summary.json'), 'w') as f:
+            json.dump({phase: self.summary(phase) for phase in phases}, f, indent=2)
+
+
+def _stage_stats(records: List[dict], stages: Iterable[str], total: Optional[float] = None) -> dict:
+    stats = {}
+    for stage in stages:
+        times = np.array([record[stage] for record in records if stage in record]) * 1000
+        if len(times) == 0:
+            continue
+        stats[stage] = dict(
+            mean_ms=float(times.mean()),
+            **{f'p{q}_ms': float(np.percentile(times, q)) for q in PERCENTILES}
+        )
+        if total is not None:
+            stats[stage]['share'] = float(times.sum() / 1000 / total)
+    return stats
+
+
+def _write_csv(path: str, records: List[dict]):
+    columns = list(dict.fromkeys(key for record in records for key in record))
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(records)
@@ -0,0 +1,58 @@
+from typing import Iterable, Iterator, List, Optional
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+def aspect_ratio_groups(aspect_ratios: np.ndarray, group_factor: int = 3) -> np.ndarray:
+    """Bucket ``width / height`` ratios into ``2 * group_factor + 2`` log-spaced groups."""
+    bins = 2 ** np.linspace(-1, 1, 2 * group_factor + 1)
+    return np.digitize(np.asarray(aspect_ratios, dtype=np.float64), bins)
+
+
+class GroupedBatchSampler(Sampler):
+    """Batch sampler whose batches only contain images of the same aspect ratio group."""
+
+    def __init__(
+        self,
+        groups: np.ndarray,
+        batch_size: int,
+        shuffle: bool = True,
+        drop_last: bool = False,
+        generator: Optional[torch.Generator] = None,
+        sampler: Optional[Iterable[int]] = None
+    ):
+        self.groups = np.asarray(groups)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = generator
+        self.sampler = sampler
+
+    def __iter__(self) -> Iterator[List[int]]:
+        if self.sampler is not None:
+            order = list(self.sampler)
+        elif self.shuffle:
+            order = torch.randperm(len(self.groups), generator=self.generator).tolist()
+        else:
+            order = range(len(self.groups))
+
+        buffers = {}
+        for index in order:
+            buffer = buffers.setdefault(self.groups[index], [])
+            buffer.append(index)
+            if len(buffer) == self.batch_size:
+                yield buffer
+                buffers[self.groups[index]] = []
+        if not self.drop_last:
+            for buffer in buffers.values():
+                if buffer:
+                    yield buffer
+
+    def __len__(self):
+        groups = self.groups if self.sampler is None else self.groups[list(self.sampler)]
+        _, counts = np.unique(groups, return_counts=True)
+        if self.drop_last:
+            return int((counts // self.batch_size).sum())
+        return int(np.ceil(counts / self.batch_size).sum())
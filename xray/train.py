@@ -1,5 +1,6 @@
 import argparse
-import copy
+import contextlib
+import functools
 import json
 import logging
 import os
@@ -7,13 +8,25 @@ import time
 import traceback
 
 import torch
-from torch.utils.data import DataLoader
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, DistributedSampler
 from torchvision.models.detection.faster_rcnn import FastRCNNPredictor
 import torchvision
 from torch.optim import SGD
 
+import xray.batch_augmentation
+import xray.checkpoint
 import xray.dataset
+import xray.dataset_manifest
+import xray.distributed
+import xray.eval_worker
 import xray.evalutation
+import xray.feature_cache
+import xray.map_eval
+import xray.predictions
+import xray.prefetch
+import xray.profiler
+import xray.sampler
 import xray.utils
 
 torch.backends.cudnn.benchmark = True
@@ -37,126 +50,363 @@ parser.add_argument('--last-epoch', default=-1, type=int)
 parser.add_argument('--gamma', default=0.02, type=float)
 parser.add_argument('--step-size', default=10, type=int)
 parser.add_argument('--weight-decay', default=0.005, type=float)
+parser.add_argument('--data-format', default='png', choices=['png', 'store'])
+parser.add_argument('--augmentation', default='sample', choices=['sample', 'batch'])
+parser.add_argument('--channels', default=3, type=int, choices=[1, 3])
+parser.add_argument(
+    '--image-size', default=1024, type=int,
+    help='Picks the image store level with --data-format store, the pngs are resized to it with --data-format png'
+)
+parser.add_argument('--precision', default='fp32', choices=list(xray.utils.PRECISIONS))
+parser.add_argument(
+    '--aspect-ratio-group-factor', default=3, type=int,
+    help='Batch images of similar aspect ratio together, -1 for plain shuffled batches'
+)
+parser.add_argument(
+    '--accumulate-steps', default=1, type=int,
+    help='Optimizer step every N batches, the effective batch size is N * --batch-size'
+)
+parser.add_argument(
+    '--manifest-path', default=None, type=str,
+    help='Dataset manifest, created on first use and rebuilt when its inputs change. '
+         'Defaults to dataset_manifest.npz in --database-path'
+)
+parser.add_argument('--rebuild-manifest', action='store_true', help='Rebuild the dataset manifest')
+parser.add_argument(
+    '--resume', default=None, type=str,
+    help='Run folder or checkpoint file to continue training from, with optimizer, scheduler and RNG states'
+)
+parser.add_argument(
+    '--keep-checkpoints', default=3, type=int,
+    help='Number of last epoch checkpoints kept; older ones are kept until evaluated with --eval-mode worker'
+)
+parser.add_argument(
+    '--feature-cache', default=None, type=str,
+    help='Train only the RPN and ROI heads, on backbone features cached once in this folder'
+)
+parser.add_argument('--feature-cache-dtype', default='fp16', choices=list(xray.feature_cache.CACHE_DTYPES))
+parser.add_argument(
+    '--feature-cache-flip', action='store_true',
+    help='Also cache the flipped images, used with probability 0.5 (the only augmentation from the cache)'
+)
+parser.add_argument(
+    '--eval-mode', default='inline', choices=['inline', 'worker'],
+    help='Evaluate after every epoch, or let a worker process evaluate the checkpoints while training goes on'
+)
+parser.add_argument('--eval-device', default=None, type=str, help='Device of the evaluation worker, defaults to --device')
+parser.add_argument(
+    '--eval-poll-interval', default=30.0, type=float,
+    help='Seconds between checks for new checkpoints, and for the work of rank 0 other ranks wait on'
+)
+parser.add_argument(
+    '--class-agnostic-nms', action='store_true',
+    help='Let submission boxes of different classes suppress each other, NMS is per class otherwise'
+)
+parser.add_argument(
+    '--prefetch-depth', default=2, type=int,
+    help='Batches moved to the device in the background ahead of the current one, 0 to disable'
+)
+parser.add_argument(
+    '--profile', action='store_true',
+    help='Time every pipeline stage (synchronizing the device) and write profile_*.csv/json to the run folder'
+)
+parser.add_argument('--world-size', default=1, type=int, help='Training processes per node')
+parser.add_argument('--nodes', default=1, type=int)
+parser.add_argument('--node-rank', default=0, type=int)
+parser.add_argument('--dist-backend', default='gloo', choices=['gloo', 'nccl'])
+parser.add_argument('--master-addr', default='127.0.0.1', type=str)
+parser.add_argument('--master-port', default=29500, type=int)
+
+
+
+def get_manifest(cfg, rebuild: bool = False):
+    manifest_path = cfg.manifest_path or os.path.join(cfg.database_path, 'dataset_manifest.npz')
+    return xray.dataset_manifest.get_manifest(
+        manifest_path, cfg.data_path, cfg.database_path, image_size=cfg.image_size, rebuild=rebuild
+    )
+
+
+def get_dataset(mode, cfg, augmentation=None):
+    if augmentation is None:
+        augmentation = cfg.augmentation if mode == 'train' else 'sample'
+    if cfg.data_format == 'store':
+        return xray.dataset.XRAYMemmapLoad(
+            mode, database_dir=cfg.database_path, image_size=cfg.image_size, augmentation=augmentation,
+            channels=cfg.channels, manifest=get_manifest(cfg), profile=cfg.profile
+        )
+    return xray.dataset.VinBigDataset(
+        mode, data_dir=cfg.data_path, new_images_shape=(cfg.image_size, cfg.image_size),
+        augmentation=augmentation, channels=cfg.channels,
+        manifest=get_manifest(cfg), profile=cfg.profile
+    )
 
 
+def get_feature_cache(model, cfg, logger):
+    """The cached backbone features of the train split, (re)built by the main process if needed."""
+    # 'batch' returns the images without any augmentation.
+    dataset = get_dataset('train', cfg, augmentation='batch')
+    cache_args = (
+        cfg.feature_cache, dataset.available_files, cfg.image_size, model, cfg.feature_cache_dtype,
+        cfg.feature_cache_flip
+    )
+    if xray.distributed.is_main_process():
+        if not xray.feature_cache.is_current(*cache_args):
+            logger.info(f'Building the feature cache in {cfg.feature_cache}')
+            xray.feature_cache.build_feature_cache(
+                model,
+                dataset,
+                cfg.feature_cache,
+                cfg.image_size,
+                dtype=cfg.feature_cache_dtype,
+                flip=cfg.feature_cache_flip,
+                batch_size=cfg.batch_size,
+                num_workers=cfg.n_workers,
+                device=cfg.device,
+                logger=logger
+            )
+    else:
+        # Building the cache can take much longer than the timeout of a barrier.
+        while not xray.feature_cache.is_current(*cache_args):
+            time.sleep(cfg.eval_poll_interval)
+    xray.distributed.barrier()
+    return xray.feature_cache.FeatureCacheDataset(cfg.feature_cache)
+
+
+def get_eval_loader(dataset, cfg):
+    # Every process evaluates its own shard, results are gathered afterwards.
+    return DataLoader(
+        dataset,
+        shuffle=False,
+        sampler=xray.distributed.ShardSampler(len(dataset)) if xray.distributed.is_distributed() else None,
+        num_workers=cfg.n_workers,
+        batch_size=cfg.batch_size,
+        collate_fn=xray.utils.my_custom_collate,
+        pin_memory=True
+    )
+
 
 def train(model_path_folder, cfg, logger):
+    distributed = xray.distributed.is_distributed()
     if cfg.checkpoint_path:
-        model = xray.evalutation.get_rcnn(cfg.checkpoint_path)
+        model = xray.evalutation.get_rcnn(
+            cfg.checkpoint_path, channels=cfg.channels, image_size=cfg.image_size
+        )
         model.to(cfg.device)
 
 
     else:
         model = torchvision.models.detection.fasterrcnn_resnet50_fpn(
             pretrained=True,
-            min_size=1024,
-            max_size=1024,
+            min_size=cfg.image_size,
+            max_size=cfg.image_size,
         )
 
         in_features = model.roi_heads.box_predictor.cls_score.in_features
 
         model.roi_heads.box_predictor = FastRCNNPredictor(in_features, 15)
+        xray.utils.float32_boxes(model)
+        if cfg.channels == 1:
+            xray.evalutation.to_single_channel(model)
         model.to(cfg.device)
 
+    if cfg.feature_cache:
+        # The backbone is frozen, its features are computed once and read from the cache.
+        model.backbone.requires_grad_(False)
     params = [p for p in model.parameters() if p.requires_grad]
 
     optimizer = SGD(params, weight_decay=cfg.weight_decay, lr=cfg.lr, momentum=cfg.momentum)
     lr_scheduler = torch.optim.lr_scheduler.StepLR(
         optimizer=optimizer, gamma=cfg.gamma, step_size=cfg.step_size, last_epoch=cfg.last_epoch
     )
+    scaler = xray.utils.grad_scaler(cfg.device, cfg.precision)
+    losses = xray.utils.LossAccumulator(cfg.device)
+    grad_mask = xray.utils.NonFiniteGradientMask(params)
+
+    start_epoch = 0
+    best_eval_ma = 0
+    test_number = 1
+    if cfg.resume:
+        checkpoint_path = xray.checkpoint.resolve_checkpoint(cfg.resume)
+        logger.info(f'Resuming training from {checkpoint_path}')
+        state = xray.checkpoint.load_checkpoint(
+            checkpoint_path, model, optimizer, lr_scheduler, scaler, losses
+        )
+        start_epoch = state['epoch'] + 1
+        best_eval_ma = state['best_eval_ma']
+        test_number = state['test_number']
+
+    checkpoints = None
+    if xray.distributed.is_main_process():
+        checkpoints = xray.checkpoint.CheckpointManager(
+            model_path_folder, cfg.keep_checkpoints, logger, keep_unevaluated=cfg.eval_mode == 'worker'
+        )
+
+    model_without_ddp = model
+    if cfg.feature_cache:
+        train_dataset = get_feature_cache(model, cfg, logger)
+        model = xray.feature_cache.DetectionHeads(model, train_dataset.size)
+    else:
+        train_dataset = get_dataset('train', cfg)
+    if distributed:
+        model = DistributedDataParallel(
+            model, device_ids=[torch.device(cfg.device).index] if cfg.device.startswith('cuda') else None
+        )
 
+    train_sampler = DistributedSampler(train_dataset, shuffle=True) if distributed else None
+    # Cached features are all padded to the same square.
+    if cfg.aspect_ratio_group_factor >= 0 and not cfg.feature_cache:
+        batching = dict(batch_sampler=xray.sampler.GroupedBatchSampler(
+            xray.sampler.aspect_ratio_groups(
+                train_dataset.aspect_ratios(), cfg.aspect_ratio_group_factor
+            ),
+            cfg.batch_size,
+            sampler=train_sampler
+        ))
+    else:
+        batching = dict(shuffle=train_sampler is None, sampler=train_sampler, batch_size=cfg.batch_size)
     train_loader = DataLoader(
-        xray.dataset.VinBigDataset('train', data_dir=cfg.data_path),
-        shuffle=True,
+        train_dataset,
         num_workers=cfg.n_workers,
-        batch_size=cfg.batch_size,
-        collate_fn=xray.utils.my_custom_collate,
-        pin_memory=True
+        collate_fn=xray.feature_cache.collate if cfg.feature_cache else xray.utils.my_custom_collate,
+        pin_memory=True,
+        **batching
     )
 
-    eval_loader = DataLoader(
-        xray.dataset.VinBigDataset('eval', data_dir=cfg.data_path),
-        shuffle=False,
-        num_workers=cfg.n_workers,
-        batch_size=cfg.batch_size,
-        collate_fn=xray.utils.my_custom_collate,
-        pin_memory=True
+    eval_loader = get_eval_loader(get_dataset('eval', cfg), cfg) if cfg.eval_mode == 'inline' else None
+    eval_worker = None
+    if cfg.eval_mode == 'worker' and xray.distributed.is_main_process():
+        logger.info('Starting the evaluation worker')
+        eval_worker = xray.eval_worker.start(model_path_folder, cfg)
+
+    batch_augmentation = (
+        xray.batch_augmentation.BatchAugmentation(prob=0.6)
+        if cfg.augmentation == 'batch' and not cfg.feature_cache else None
+    )
+
+    profiler = xray.profiler.PipelineProfiler(cfg.profile, cfg.device)
+    batches = xray.prefetch.BatchPrefetcher(
+        train_loader,
+        cfg.device,
+        cfg.prefetch_depth,
+        functools.partial(xray.feature_cache.batch_to_device, device=cfg.device) if cfg.feature_cache else None,
+        synchronize=cfg.profile
     )
 
     logger.info('Starting training')
-    best_eval_ma = 0
-    test_number = 1
-    average_loss = xray.utils.Averager()
 
     try:
-        for epoch in range(cfg.n_epochs):
-            average_loss.reset()
-            average_loss.reset_all_losses()
+        for epoch in range(start_epoch, cfg.n_epochs):
+            losses.reset()
             model.train()
+            profiler.epoch = epoch
             epoch_time = time.time()
-            for step, (x_batch, y_batch) in enumerate(train_loader):
-                x_batch = [x.to(cfg.device) for x in x_batch]
-                y_batch = [{
-                    'boxes': j['boxes'].to(cfg.device),
-                    'labels': j['labels'].to(cfg.device),
-                    'iscrowd': j['iscrowd'].to(cfg.device),
-                    'area': j['area'].to(cfg.device),
-                    'file_name': j['file_name']
-                } for j in y_batch]
-
-                batch_time = time.time()
-                loss_dict = model(x_batch, y_batch)
-                total_loss = sum(loss for loss in loss_dict.values())
-                if torch.isnan(total_loss).any():
-                    logger.warning(f'There is nan in final losses. Some Debugging needed. Error on '
-                                   f'images {[i["file_name"] for i in y_batch]} with labels {[i["labels"] for i in y_batch]}'
-                                   f'Loss values are {loss_dict}')
-
-                    logger.warning('Skipping the batch, moving to another ... ')
-                    continue
-
-                optimizer.zero_grad()
-
-                total_loss.backward()
-                optimizer.step()
-                average_loss.send(total_loss.item())
-                average_loss.send_all(
-                    (loss_dict['loss_classifier'].item(),
-                    loss_dict['loss_box_reg'].item(),
-                    loss_dict['loss_objectness'].item(),
-                    loss_dict['loss_rpn_box_reg'].item())
-                )
-                if (step + 1) % cfg.log_step == 0 or (step + 1) == len(train_loader):
+            log_time = epoch_time
+            epoch_images = log_images = 0
+            optimizer.zero_grad()
+            accumulated = 0
+            if train_sampler is not None:
+                train_sampler.set_epoch(epoch)
+            # Grouped batches can differ in number between processes, which all have to run
+            # the same number of steps.
+            n_steps = xray.distributed.min_over_processes(len(train_loader))
+            # Batches arrive on the device, moved there while the previous step computed.
+            for step, (x_batch, y_batch) in enumerate(profiler.iterate(batches, 'train')):
+                if step == n_steps:
+                    break
+                with profiler.stage('augmentation'):
+                    if batch_augmentation is not None:
+                        x_batch, y_batch = batch_augmentation(x_batch, y_batch)
+                    if not cfg.feature_cache:
+                        x_batch = xray.utils.to_float_images(x_batch)
+
+                sync = accumulated + 1 == cfg.accumulate_steps or (step + 1) == n_steps
+                # Gradients of accumulation steps are only all-reduced with the last one.
+                with model.no_sync() if distributed and not sync else contextlib.nullcontext():
+                    with profiler.stage('forward'):
+                        with xray.utils.autocast(cfg.device, cfg.precision):
+                            loss_dict = model(x_batch, y_batch)
+                        loss_dict = {k: loss.float() for k, loss in loss_dict.items()}
+                        total_loss = sum(loss for loss in loss_dict.values())
+                        # A batch with a NaN/inf loss (also fp16 overflows) makes the gradients of its
+                        # accumulation window NaN on the device, and the window's step is skipped.
+                        total_loss = grad_mask.mask(total_loss, losses.update(loss_dict, total_loss))
+                    with profiler.stage('backward'):
+                        # The last window of an epoch can be shorter than --accumulate-steps.
+                        window = min(cfg.accumulate_steps, n_steps - (step - accumulated))
+                        scaler.scale(total_loss / window).backward()
+                accumulated += 1
+                if sync:
+                    with profiler.stage('optimizer'):
+                        grad_mask.step(optimizer, scaler)
+                        optimizer.zero_grad()
+                    accumulated = 0
+                epoch_images += len(y_batch)
+                log_images += len(y_batch)
+                if (step + 1) % cfg.log_step == 0 or (step + 1) == n_steps:
+                    summary = xray.distributed.reduce_losses(losses)
                     logger.info(
-                        f'{xray.utils.time_str()}, Step {step}/{len(train_loader)} in Ep {epoch}, {time.time() - batch_time:.2f}s '
-                        f'train_loss:{average_loss.value:.4f}. Individual losses: {average_loss.value_all_losses}'
+                        f'{xray.utils.time_str()}, Step {step}/{n_steps} in Ep {epoch}, '
+                        f'{log_images / (time.time() - log_time):.1f} images/sec '
+                        f'train_loss:{summary["loss"]:.4f}. Individual losses: {summary["losses"]}'
                     )
+                    log_time = time.time()
+                    log_images = 0
+                    if summary['skipped']:
+                        logger.warning(
+                            f'{summary["skipped"]} batches with nan in the losses skipped their optimizer step in Ep {epoch}'
+                        )
             lr_scheduler.step()
 
 
-            logger.info(f'Epoch duration: {(time.time() - epoch_time)/60} Min')
-            logger.info('==========================================')
-            logger.info(f'Testing results after epoch {epoch + 1} on eval_loader {epoch + 1}')
-
-            all_results, all_targets = xray.evalutation.model_eval_forward(
-                model, eval_loader, cfg.device, logger=logger
+            epoch_duration = time.time() - epoch_time
+            logger.info(
+                f'Epoch duration: {epoch_duration:.1f}s, {epoch_images / epoch_duration:.1f} images/sec'
             )
-            final_evaluation = xray.evalutation.calculate_metrics(all_results, all_targets)
-            logger.info(f'Ma metric on evaluation dataset after epoch {epoch} is with '
-                        f'IoU 0.4 is {final_evaluation.stats[0]}')
-
-            if final_evaluation.stats[0] > best_eval_ma:
-                best_eval_ma = final_evaluation.stats[0]
-                logger.info('<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<'*2)
-                logger.info(f'New best model after epoch {epoch} with ma {final_evaluation.stats[0]}')
-                logger.info('<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<'*2)
-                best_model = copy.deepcopy(model)
-                best_model_path = os.path.join(model_path_folder, 'best_model_rcnn.cfg')
-                logger.info(f'Saving best model to {best_model_path}')
-                torch.save(best_model.state_dict(), best_model_path)
+            profiler.log(logger, 'train')
+
+            is_best = False
+            # With the worker, the checkpoint below is all there is to do for the evaluation.
+            if cfg.eval_mode == 'inline':
+                logger.info('==========================================')
+                logger.info(f'Testing results after epoch {epoch + 1} on eval_loader {epoch + 1}')
+
+                # Every rank matches its shard as it goes, only the matching statistics are gathered.
+                evaluator = xray.map_eval.OnlineMAPEvaluator(shard=xray.distributed.get_rank())
+                xray.evalutation.model_eval_forward(
+                    model_without_ddp, eval_loader, cfg.device, logger=logger, precision=cfg.precision,
+                    profiler=profiler, prefetch_depth=cfg.prefetch_depth, evaluator=evaluator
+                )
+                profiler.log(logger, 'eval')
+                evaluators = xray.distributed.gather_lists([evaluator])
+                eval_ma = xray.map_eval.OnlineMAPEvaluator.concatenate(evaluators).result().map
+                logger.info(f'Ma metric on evaluation dataset after epoch {epoch} is with '
+                            f'IoU 0.4 is {eval_ma}')
+
+                is_best = eval_ma > best_eval_ma
+                if is_best:
+                    best_eval_ma = eval_ma
+                    logger.info('<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<'*2)
+                    logger.info(f'New best model after epoch {epoch} with ma {eval_ma}')
+                    logger.info('<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<'*2)
+
+            if cfg.profile and xray.distributed.is_main_process():
+                profiler.write(model_path_folder)
+
+            if checkpoints is not None:
+                # Only the copy to the CPU happens here, the file is written in the background.
+                checkpoints.save(
+                    xray.checkpoint.CheckpointManager.snapshot(
+                        model_without_ddp, optimizer, lr_scheduler, scaler, losses,
+                        epoch=epoch, best_eval_ma=best_eval_ma, test_number=test_number + is_best
+                    ),
+                    epoch,
+                    is_best=is_best
+                )
 
+            if is_best:
+                # The model is still the best one here, it is restored from disk at the end.
                 create_test_submission(
-                    model=best_model,
+                    model=model_without_ddp,
                     model_path_folder=model_path_folder,
                     cfg=cfg,
                     logger=logger,
@@ -164,39 +414,49 @@ def train(model_path_folder, cfg, logger):
                 )
                 test_number += 1
 
-        return best_model
     except Exception as e:
         logger.exception(f'Training failed with exception {e}')
         traceback.print_exc()
-        return best_model
+
+    if checkpoints is not None:
+        checkpoints.close()
+        xray.checkpoint.mark_finished(model_path_folder)
+    if eval_worker is not None:
+        logger.info('Waiting for the evaluation worker to evaluate the last checkpoints')
+        eval_worker.join()
+        xray.checkpoint.mark_evaluated(model_path_folder)
+    elif cfg.eval_mode == 'worker':
+        # The worker can take much longer than the timeout of a barrier.
+        while not xray.checkpoint.is_evaluated(model_path_folder):
+            time.sleep(cfg.eval_poll_interval)
+    xray.distributed.barrier()
+    best_model_path = os.path.join(model_path_folder, xray.checkpoint.BEST_MODEL)
+    if os.path.exists(best_model_path):
+        logger.info(f'Loading best model from {best_model_path}')
+        model_without_ddp.load_state_dict(torch.load(best_model_path, map_location=cfg.device))
+    return model_without_ddp
 
 
 def create_test_submission(model, model_path_folder, cfg, logger, test_number: int = 1):
     model.eval()
-    test_dataset = xray.dataset.VinBigDataset('test', data_dir=cfg.data_path)
-    test_loader = DataLoader(
-        test_dataset,
-        shuffle=False,
-        num_workers=cfg.n_workers,
-        batch_size=cfg.batch_size,
-        collate_fn=xray.utils.my_custom_collate,
-        pin_memory=True
-    )
+    test_dataset = get_dataset('test', cfg)
+    test_loader = get_eval_loader(test_dataset, cfg)
 
     logger.info("===================================================================")
     logger.info("Testing best model on test set")
-    all_results, all_targets = xray.evalutation.model_eval_forward(
-        model, test_loader, cfg.device, score_threshold=0.5, logger=logger
+    all_results, _ = xray.evalutation.model_eval_forward(
+        model, test_loader, cfg.device, score_threshold=0.5, logger=logger, precision=cfg.precision
     )
+    all_results = xray.distributed.gather_detections(all_results)
+    if not xray.distributed.is_main_process():
+        return
     logger.info("Creating submission file for test data ...")
 
-    all_results = xray.utils.no_findings_to_ones(all_results)
-    submission_file = xray.utils.create_submission_df(
-        all_results, [i['file_name'] for i in all_targets]
+    predictions = xray.predictions.postprocess(
+        all_results, xray.predictions.original_shapes(all_results.image_ids, test_dataset.data_desc),
+        per_class=not cfg.class_agnostic_nms
     )
-
-    submission_file = xray.utils.rescale_to_original_size(submission_file, test_dataset.data_desc)
-    submission_file['PredictionString'] = submission_file.PredictionString.apply(xray.utils.do_nms)
+    submission_file = xray.predictions.to_submission(predictions)
 
     with open(os.path.join(model_path_folder, 'model_hyperparameters.json'), 'w') as j:
         json.dump(cfg.__dict__, j)
@@ -208,16 +468,47 @@ def create_test_submission(model, model_path_folder, cfg, logger, test_number: i
 
 
 
-if __name__ == '__main__':
-    cfg = parser.parse_args()
-    model_path_folder = os.path.join(cfg.save_path, xray.utils.time_str())
-    os.makedirs(model_path_folder, exist_ok=True)
+def run(local_rank, model_path_folder, cfg):
+    """Train and write the final submission, as process ``local_rank`` of this node."""
+    world_size = cfg.world_size * cfg.nodes
+    if world_size > 1:
+        xray.distributed.init_process_group(
+            cfg.node_rank * cfg.world_size + local_rank,
+            world_size,
+            backend=cfg.dist_backend,
+            master_addr=cfg.master_addr,
+            master_port=cfg.master_port
+        )
+        if cfg.device.startswith('cuda'):
+            cfg.device = f'cuda:{local_rank}'
+            torch.cuda.set_device(cfg.device)
 
-    logger = xray.utils.define_logger('Train pipeline', folder=model_path_folder)
+    main_process = xray.distributed.is_main_process()
+    logger = xray.utils.define_logger(
+        'Train pipeline', folder=model_path_folder, filehandler=main_process, streamhandler=main_process
+    )
+    if not main_process:
+        logger.setLevel(logging.WARNING)
 
     model = train(model_path_folder, cfg, logger)
     create_test_submission(model, model_path_folder, cfg, logger, test_number=0)
+    xray.distributed.cleanup()
 
 
+if __name__ == '__main__':
+    cfg = parser.parse_args()
+    if cfg.resume:
+        model_path_folder = xray.checkpoint.run_folder(cfg.resume)
+    else:
+        model_path_folder = os.path.join(cfg.save_path, xray.utils.time_str())
+    os.makedirs(model_path_folder, exist_ok=True)
+    # Also read by the evaluation worker.
+    with open(os.path.join(model_path_folder, 'model_hyperparameters.json'), 'w') as j:
+        json.dump(cfg.__dict__, j)
+    # Created once here instead of concurrently by every process.
+    get_manifest(cfg, rebuild=cfg.rebuild_manifest)
 
-
+    if cfg.world_size > 1:
+        torch.multiprocessing.spawn(run, args=(model_path_folder, cfg), nprocs=cfg.world_size)
+    else:
+        run(0, model_path_folder, cfg)
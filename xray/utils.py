@@ -1,4 +1,3 @@
-import copy
 import datetime
 import logging
 import os
@@ -11,63 +10,150 @@ import pandas as pd
 import pydicom
 import torch
 import torchvision
+from torchvision.models.detection._utils import BoxCoder
+from torchvision.models.detection.anchor_utils import AnchorGenerator
 
 
-class Averager:
-    def __init__(self):
-        self.loss_box_reg = 0.0
-        self.loss_objectness = 0.0
-        self.loss_rpn_box_reg = 0.0
-        self.current_total = 0.0
-        self.iterations = 0.0
-        self.loss_classifier = 0.0
+LOSS_NAMES = ('loss_classifier', 'loss_box_reg', 'loss_objectness', 'loss_rpn_box_reg')
 
-    def send(self, value):
-        self.current_total += value
-        self.iterations += 1
 
-    @property
-    def value(self):
-        if self.iterations == 0:
-            return 0
-        else:
-            return 1.0 * self.current_total / self.iterations
+class LossAccumulator:
+    """Running sums of the training losses, kept in one tensor on the training device."""
 
-    @property
-    def value_all_losses(self):
-        if self.iterations == 0:
-            return 0
-        else:
-            return {
-                'loss_classifier': self.loss_classifier/self.iterations,
-                'loss_box_reg': self.loss_box_reg/self.iterations,
-                'loss_objectness': self.loss_objectness/self.iterations,
-                'loss_rpn_box_reg': self.loss_rpn_box_reg/self.iterations
-            }
+    def __init__(self, device: str = 'cpu'):
+        # total loss, the individual losses, finite steps, skipped steps
+        self.sums = torch.zeros(len(LOSS_NAMES) + 3, dtype=torch.float64, device=device)
 
     def reset(self):
-        self.current_total = 0.0
-        self.iterations = 0.0
+        self.sums.zero_()
+
+    def update(self, loss_dict: Dict[str, torch.Tensor], total_loss: torch.Tensor) -> torch.Tensor:
+        """Add the losses of a step; returns the step's 0-dim "all finite" flag on the device."""
+        values = torch.stack([total_loss.detach()] + [loss_dict[name].detach() for name in LOSS_NAMES])
+        values = values.double()
+        finite = torch.isfinite(values).all()
+        self.sums[:-2] += torch.where(finite, values, torch.zeros_like(values))
+        self.sums[-2] += finite
+        self.sums[-1] += ~finite
+        return finite
+
+    def totals(self) -> List[float]:
+        return self.sums.tolist()
+
+    def summary(self, totals: List[float] = None) -> dict:
+        """Mean losses over the finite steps, from ``totals`` (e.g. reduced over processes)."""
+        *sums, steps, skipped = self.totals() if totals is None else totals
+        means = [value / steps if steps else 0.0 for value in sums]
+        return dict(loss=means[0], losses=dict(zip(LOSS_NAMES, means[1:])), steps=int(steps), skipped=int(skipped))
+
+    def state_dict(self) -> dict:
+        return {'sums': self.sums}
+
+    def load_state_dict(self, state: dict):
+        self.sums.copy_(state['sums'])
+
+
+class NonFiniteGradientMask:
+    """Skips the optimizer steps of windows with a non-finite loss or gradient, on the device."""
+
+    def __init__(self, parameters):
+        self.parameters = [p for p in parameters if p.requires_grad]
+
+    @staticmethod
+    def mask(loss: torch.Tensor, finite: torch.Tensor) -> torch.Tensor:
+        """``loss`` times 1, or NaN when ``finite`` is false, so all of its gradients become NaN."""
+        return loss * torch.where(finite, torch.ones_like(loss), torch.full_like(loss, float('nan')))
+
+    def found_inf(self, optimizer: torch.optim.Optimizer, scaler: torch.cuda.amp.GradScaler) -> torch.Tensor:
+        if scaler.is_enabled():
+            # unscale_ records the check per device for scaler.update, without a sync.
+            scaler.unscale_(optimizer)
+            found = scaler._per_optimizer_states[id(optimizer)]['found_inf_per_device'].values()
+            return sum(value.to(self.parameters[0].device) for value in found)
+        grads = [p.grad for p in self.parameters if p.grad is not None]
+        found = torch.zeros(1, device=self.parameters[0].device)
+        if grads and grads[0].is_cuda:
+            torch._amp_foreach_non_finite_check_and_unscale_(grads, found, torch.ones_like(found))
+        elif grads:
+            found += ~torch.stack([grad.isfinite().all() for grad in grads]).all()
+        return found
+
+    @torch.no_grad()
+    def step(self, optimizer: torch.optim.Optimizer, scaler: torch.cuda.amp.GradScaler):
+        finite = self.found_inf(optimizer, scaler) == 0
+        # The update is made and undone where it is not finite, so nothing waits for the device.
+        # Only tensor optimizer state is restored (SGD has no other).
+        before = []
+        for p in self.parameters:
+            state = optimizer.state[p]
+            before.append((p, p.clone(), {name: state[name].clone() for name in state if torch.is_tensor(state[name])}))
+        optimizer.step()
+        for p, param, state in before:
+            p.copy_(torch.where(finite, p, param))
+            for name, value in optimizer.state[p].items():
+                if torch.is_tensor(value):
+                    # State made by this step (the first momentum buffer) starts from zero.
+                    value.copy_(torch.where(finite, value, state.get(name, torch.zeros_like(value))))
+        scaler.update()
 
-    def reset_all_losses(self):
-        self.loss_classifier = 0.0
-        self.loss_box_reg = 0.0
-        self.loss_objectness = 0.0
-        self.loss_rpn_box_reg = 0.0
-        self.iterations = 0.0
 
+def my_custom_collate(x):
+    x = [(a,b) for a,b in x]
+    return list(zip(*x))
 
-    def send_all(self, losses: Tuple[float, float, float, float]):
-        self.loss_classifier += losses[0]
-        self.loss_box_reg += losses[1]
-        self.loss_objectness += losses[2]
-        self.loss_rpn_box_reg += losses[3]
 
+def to_float_images(images: List[torch.Tensor]) -> List[torch.Tensor]:
+    return [image.float().div_(255) if image.dtype == torch.uint8 else image for image in images]
 
 
-def my_custom_collate(x):
-    x = [(a,b) for a,b in x]
-    return list(zip(*x))
+def images_to_device(images: List[torch.Tensor], device: str) -> List[torch.Tensor]:
+    """Move uint8 images to ``device`` and only there convert them to floats in [0, 1]."""
+    return to_float_images([image.to(device, non_blocking=True) for image in images])
+
+
+PRECISIONS = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def autocast(device: str, precision: str = 'fp32'):
+    """Autocast context running the forward pass in ``precision`` on ``device``, off for fp32."""
+    if precision not in PRECISIONS:
+        raise KeyError(f'Precision needs to be in {list(PRECISIONS)}')
+    return torch.autocast(
+        torch.device(device).type, dtype=PRECISIONS[precision], enabled=precision != 'fp32'
+    )
+
+
+class Float32BoxCoder(BoxCoder):
+    """``BoxCoder`` decoding in float32 whatever the dtype of the regression outputs."""
+
+    def decode(self, rel_codes: torch.Tensor, boxes: List[torch.Tensor]) -> torch.Tensor:
+        return super().decode(rel_codes.float(), [box.float() for box in boxes])
+
+
+class Float32AnchorGenerator(AnchorGenerator):
+    """``AnchorGenerator`` making float32 anchors also for bf16/fp16 feature maps."""
+
+    def forward(self, image_list, feature_maps: List[torch.Tensor]) -> List[torch.Tensor]:
+        # Only the shape, dtype and device of the feature maps are used.
+        feature_maps = [torch.empty((), device=f.device).expand(f.shape) for f in feature_maps]
+        return super().forward(image_list, feature_maps)
+
+
+def float32_boxes(model: torchvision.models.detection.FasterRCNN) -> torchvision.models.detection.FasterRCNN:
+    """Make ``model`` generate anchors and decode boxes in float32 under ``autocast``."""
+    # In bf16 coordinates above 512 are multiples of 4.
+    anchors = model.rpn.anchor_generator
+    model.rpn.anchor_generator = Float32AnchorGenerator(anchors.sizes, anchors.aspect_ratios)
+    for heads in (model.rpn, model.roi_heads):
+        heads.box_coder = Float32BoxCoder(heads.box_coder.weights, heads.box_coder.bbox_xform_clip)
+    return model
+
+
+def grad_scaler(device: str, precision: str = 'fp32') -> torch.cuda.amp.GradScaler:
+    """Loss scaler for fp16 on CUDA; disabled (a pass-through) for every other combination."""
+    return torch.cuda.amp.GradScaler(
+        enabled=precision == 'fp16' and torch.device(device).type == 'cuda'
+    )
 
 
 def create_eval_df(results: List[Dict[str, np.array]], description: List[Dict[str, np.array]]):
@@ -90,40 +176,6 @@ def create_eval_df(results: List[Dict[str, np.array]], description: List[Dict[st
     return eval_df
 
 
-def create_true_df(descriptions: List[Dict[str, np.array]]):
-    true_df = pd.DataFrame(
-        columns=['image_id', 'class_name', 'class_id', 'x_min', 'y_min', 'x_max', 'y_max']
-    )
-
-    for desc in descriptions:
-        bbox_df_true = pd.DataFrame(
-            desc['boxes'], columns=['x_min', 'y_min', 'x_max', 'y_max']
-        )
-
-        bbox_df_true['class_id'] = desc['labels']
-        bbox_df_true['image_id'] = desc['file_name']
-
-        true_df = true_df.append(bbox_df_true)
-
-    return true_df
-
-
-def create_submission_df(
-    results: List[Dict[str, torch.Tensor ]], image_ids: List[str]
-):
-    all_rows = []
-    for image_id, result in zip(image_ids, results):
-        labels = [l-1 if int(l) != 0 else 14 for l in result['labels']]
-        if len(result['boxes']) > 0:
-            all_rows.append({
-                'PredictionString': format_prediction_string(labels, result['boxes'], result['scores']),
-                'image_id': image_id
-            })
-        else:
-            all_rows.append({'PredictionString': '14 1.0 0 0 1 1', 'image_id': image_id})
-    return pd.DataFrame(all_rows)
-
-
 def time_str(fmt=None):
     if fmt is None:
         fmt = '%Y-%m-%d_%H:%M:%S'
@@ -131,12 +183,13 @@ def time_str(fmt=None):
     #     time.strftime(format[, t])
     return datetime.datetime.today().strftime(fmt)
 
-def get_augmentation(prob = 0.8):
+def get_augmentation(prob = 0.8, channels: int = 3):
+    # RGBShift only makes sense for the 3-channel copy of the radiograph.
     return A.Compose(
         [A.augmentations.RandomBrightnessContrast(p=prob),
-         A.augmentations.Equalize(p=prob),
-         A.augmentations.RGBShift(p=prob),
-         A.augmentations.Flip(p=prob)
+         A.augmentations.Equalize(p=prob)] +
+        ([A.augmentations.RGBShift(p=prob)] if channels == 3 else []) +
+        [A.augmentations.Flip(p=prob)
          ]
         ,
         bbox_params=A.BboxParams(format='pascal_voc'),
@@ -205,53 +258,6 @@ def filter_radiologist_findings(
     return boxes_tensor, labels_tensor
 
 
-def transform_no_findings(results):
-    new_dict = copy.deepcopy(results)
-    for index in range(len(results)):
-        for box_n, (box, label) in enumerate(
-            zip(results[index]['boxes'], results[index]['labels'])):
-            if label == 14:
-                new_dict[index]['boxes'][box_n] = torch.tensor([0, 0, 1, 1])
-    return new_dict
-
-
-def no_findings_to_ones(results: List[Dict[str, np.array]]):
-    new_dict = copy.deepcopy(results)
-    for index in range(len(results)):
-        if results[index]['boxes'].size == 0:
-            new_dict[index]['boxes'] = np.array([[0, 0, 1, 1]])
-            new_dict[index]['labels'] = np.array([0])
-            new_dict[index]['scores'] = np.array([1.0])
-
-    return new_dict
-
-
-def do_nms(string_row):
-    example = string_row.split(' ')
-    example_edited = []
-    scores = []
-    classes = []
-    for index in range(int(len(example) / 6)):
-        scores.append(float(example[index * 6 + 1]))
-        classes.append(int(float(example[index * 6])))
-
-        bbox = list(map(float, example[(index * 6 + 2):(index * 6 + 6)]))
-        example_edited.append(bbox)
-    final_example = torch.tensor(example_edited, dtype=torch.float32, device='cpu')
-    index_after_nms = torchvision.ops.nms(final_example, torch.tensor(scores).float(), 0.4)
-
-    scores_updated = torch.tensor(scores)[index_after_nms]
-    classes_updated = torch.tensor(classes)[index_after_nms]
-    final_example_updated = final_example[index_after_nms]
-    list_of_lists = torch.cat(
-        [classes_updated.unsqueeze(dim=1), scores_updated.unsqueeze(dim=1), final_example_updated],
-        axis=1).tolist()
-    for l in list_of_lists:
-        l[0] = int(l[0])
-
-    final_output = ' '.join([str(element) for puf in list_of_lists for element in puf])
-    return final_output
-
 def resize_bbox(
     bbox_coord:Tuple[float, float, float, float],
     curr_size: Tuple[int, int],
@@ -263,47 +269,6 @@ def resize_bbox(
     y1_new = float(bbox_coord[3]) * new_size[1] / curr_size[1]
     return [x0_new, y0_new, x1_new, y1_new]
 
-def rescale_to_original_size(
-    output_file,
-    test_data_desc: pd.DataFrame,
-    current_size: Tuple[int, int] = (1024, 1024)
-):
-
-    new_predicted_strings = []
-    for i, (string, image_id) in enumerate(zip(output_file.PredictionString, output_file.image_id)):
-        string_list = string.split(' ')
-        orig_shape = (test_data_desc.loc[test_data_desc.image_id == image_id].iloc[0].height,
-                      test_data_desc.loc[test_data_desc.image_id == image_id].iloc[0].width)
-
-        new_string = []
-        for index in range(int(len(string_list) / 6)):
-            current_string = string_list[index * 6: index * 6 + 6]
-            if int(current_string[0]) != 14:
-                new_bbox_coord = resize_bbox(
-                    bbox_coord=current_string[2:],
-                    curr_size=current_size,
-                    new_size=orig_shape
-                )
-
-                new_bbox_coord = [str(current_string[0]), str(current_string[1])] + list(map(str, new_bbox_coord))
-                new_string.extend(new_bbox_coord)
-            else:
-                new_string.extend(['14','1', '0','0','1','1'])
-        new_predicted_strings.append(' '.join(new_string))
-        if (i+1) % 10 == 0:
-            print(f'Episode {i}', flush = True)
-
-    return pd.DataFrame({'PredictionString': new_predicted_strings, 'image_id': output_file.image_id})
-
-def format_prediction_string(labels, boxes, scores):
-    pred_strings = []
-    for j in zip(labels, scores, boxes):
-        pred_strings.append("{0} {1:.4f} {2} {3} {4} {5}".format(
-            j[0], j[1], j[2][0], j[2][1], j[2][2], j[2][3]))
-
-    return " ".join(pred_strings)
-
-
 def define_logger(name: str, folder: str = None, filehandler: bool = True, streamhandler: bool = True):
     logger = logging.getLogger(name)
     logFormatter = logging.Formatter(
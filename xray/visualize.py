@@ -1,5 +1,3 @@
-import os
-import shelve
 from functools import lru_cache
 from typing import Dict, Optional, List
 
@@ -7,6 +5,8 @@ import numpy as np
 import torch
 from matplotlib import pyplot as plt, patches as patches
 
+from xray.image_store import ImageStore, image_store_dir
+
 
 def plot_target_vs_true(image_array, results_bboxes, results_labels, target_bboxes, target_labels):
     fig, (ax1, ax2) = plt.subplots(1, 2)
@@ -50,10 +50,10 @@ def get_results_plot(
     image_name: str,
     targets: Optional[Dict[str, torch.Tensor]],
     database_set: str = 'train',
-    database_dir: str = '../data/chest_xray/'
+    database_dir: str = '../data/chest_xray/',
+    image_size: int = 1024
 ):
-    db = get_database(database_set, database_dir)
-    image_array = db[image_name]['image']
+    image_array = get_image_store(database_set, database_dir, image_size).image(image_name)
     if targets is None:
         plot_image_with_bboxes(image_array, results['boxes'], results['labels'])
     else:
@@ -86,9 +86,6 @@ def plot_image_with_bboxes(image: np.array, bboxes: List[np.array], labels: List
 
 
 @lru_cache()
-def get_database(databaset: str = 'train', database_dir: str = '../data/chest_xray/'):
+def get_image_store(databaset: str = 'train', database_dir: str = '../data/chest_xray/', image_size: int = 1024):
     assert databaset in ['train', 'test']
-    db = shelve.open(
-        os.path.join(database_dir, 'train_data.db'), flag='r', writeback=False
-    )
-    return db
\ No newline at end of file
+    return ImageStore(image_store_dir(database_dir, databaset, image_size))